@@ -0,0 +1,49 @@
+"""
+Análisis de un email individual para SpamSense AI
+Features, veredicto, forense, adjuntos, geo/RDAP y atribuciones de un mensaje, sin dependencia de la UI
+"""
+
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from attachmentScan import default_attachment_scanner, AttachmentScanner, ATTACHMENT_COLUMNS
+from forensics import extract_forensics
+from linkAnalysis import default_link_analyzer
+
+
+def domain_age(enrichment, domain):
+    """Registration age as shown in the domain passport ("3a, 12d"), or a status text."""
+    if not domain: return "N/A"
+    try:
+        creation_date = enrichment.domain_registration(domain)
+        if creation_date:
+            age = datetime.now(timezone.utc) - creation_date
+            years = age.days // 365
+            days = age.days % 365
+            return f"{years}a, {days}d"
+        return "Unknown"
+    except Exception:
+        return "Error RDAP"
+
+
+def analyze_email(text, processor, model, enrichment, attributor=None):
+    """
+    Everything the single-email tab renders for one normalized message (see
+    resultCache.normalize_raw). Used by the app and by the load test, so both run the same code.
+    """
+    df = processor.transform_raw_email(text)
+    pred = int(model.predict(df)[0])
+    prob = float(model.predict_proba(df)[0][pred])
+    ip, urls, domain = extract_forensics(text)
+    header, _, body = text.partition("\n\n")
+    links = default_link_analyzer().features([(header, body)], [domain])
+    attachments = default_attachment_scanner().scan(header, body)
+    single_df = pd.DataFrame([{"ip": ip, "urls": urls, "domain": domain, **links.iloc[0],
+                               **dict(zip(ATTACHMENT_COLUMNS, AttachmentScanner.counts(attachments)))}])
+    return {
+        "features": df, "pred": pred, "prob": prob, "forensics": single_df, "attachments": attachments,
+        "lookups": {"geo": {ip: enrichment.geo(ip)} if ip else {},
+                    "age": {domain: domain_age(enrichment, domain)} if domain else {}},
+        "contributions": attributor.explain(df).iloc[0] if attributor is not None and attributor.available else None
+    }
@@ -0,0 +1,343 @@
+"""
+Análisis de adjuntos para SpamSense AI
+Recorre las partes MIME en streaming: SHA-256 incremental, tipo real por magic bytes y señales de riesgo
+"""
+
+import argparse
+import binascii
+import functools
+import hashlib
+import io
+import os
+import re
+from collections import namedtuple
+from email.header import decode_header, make_header
+from itertools import chain
+from urllib.parse import unquote
+
+import numpy as np
+import pandas as pd
+
+BAD_HASHES_PATH = os.environ.get("SPAMSENSE_BAD_HASHES", "data/attachment_hashes.txt")
+SNIFF_BYTES = 0x8006  # ISO 9660 images are only recognizable at offset 0x8001
+BASE64_BATCH = 512  # encoded lines decoded per call
+
+ATTACHMENT_COLUMNS = ["attachment_count", "attachment_bytes", "double_extension_attachments",
+                      "macro_attachments", "executable_attachments", "type_mismatch_attachments",
+                      "known_bad_attachments"]
+
+Attachment = namedtuple("Attachment", ["filename", "declared_type", "sniffed_type", "size", "sha256",
+                                       "double_extension", "macro_capable", "executable", "type_mismatch", "known_bad"])
+
+# (offset, magic, type), most specific first
+_MAGIC = (
+    (0, b"%PDF-", "pdf"),
+    (0, b"PK\x03\x04", "zip"),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "ole"),
+    (0, b"MZ", "pe"),
+    (0, b"\x7fELF", "elf"),
+    (0, b"L\x00\x00\x00\x01\x14\x02\x00", "lnk"),
+    (0, b"Rar!\x1a\x07", "rar"),
+    (0, b"7z\xbc\xaf\x27\x1c", "7z"),
+    (0, b"\x1f\x8b", "gzip"),
+    (0, b"{\\rtf", "rtf"),
+    (0, b"\x89PNG\r\n\x1a\n", "png"),
+    (0, b"\xff\xd8\xff", "jpeg"),
+    (0, b"GIF8", "gif"),
+    (0x8001, b"CD001", "iso"),
+)
+_ATTACHMENT_HINT_RE = re.compile(r"^content-(?:type:\s*(?:multipart|application|image|audio|video)/|disposition:\s*attachment)",
+                                 flags=re.IGNORECASE | re.MULTILINE)
+_HTML_MAGIC_RE = re.compile(rb"^\s*<(?:!doctype html|html|head|script|body)", flags=re.IGNORECASE)
+
+# Extension -> sniffed type it should have (a different known type is a mismatch)
+_EXPECTED_TYPE = {
+    "pdf": "pdf", "zip": "zip", "docx": "zip", "xlsx": "zip", "pptx": "zip", "docm": "zip", "xlsm": "zip",
+    "pptm": "zip", "jar": "zip", "doc": "ole", "xls": "ole", "ppt": "ole", "msi": "ole", "exe": "pe",
+    "dll": "pe", "scr": "pe", "cpl": "pe", "com": "pe", "lnk": "lnk", "rar": "rar", "7z": "7z", "gz": "gzip",
+    "tgz": "gzip", "rtf": "rtf", "png": "png", "jpg": "jpeg", "jpeg": "jpeg", "gif": "gif", "iso": "iso",
+    "htm": "html", "html": "html"
+}
+_DECLARED_TYPE = {
+    "application/pdf": "pdf", "application/zip": "zip", "application/x-zip-compressed": "zip",
+    "application/msword": "ole", "application/vnd.ms-excel": "ole", "application/vnd.ms-powerpoint": "ole",
+    "application/rtf": "rtf", "image/png": "png", "image/jpeg": "jpeg", "image/gif": "gif",
+    "application/x-msdownload": "pe", "application/gzip": "gzip", "application/x-rar-compressed": "rar",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "zip",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "zip",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": "zip"
+}
+_MACRO_EXTS = frozenset("docm dotm xlsm xltm xlam pptm potm ppsm sldm doc dot xls xlt ppt pot pps".split())
+_EXECUTABLE_EXTS = frozenset("exe scr com pif bat cmd cpl dll msi jar js jse vbs vbe wsf wsh hta ps1 lnk "
+                             "iso img vhd reg".split())
+_EXECUTABLE_TYPES = frozenset(("pe", "elf", "lnk"))
+_DECOY_EXTS = frozenset("pdf doc docx xls xlsx ppt pptx txt rtf csv jpg jpeg png gif zip rar htm html".split())
+_VBA_MARKER = b"vbaProject.bin"
+_RTLO = "\u202e"  # right-to-left override, used to disguise the real extension
+
+_PARAM_RE = {
+    name: re.compile(r'(?:^|;)\s*%s\*?\s*=\s*(?:"([^"]*)"|([^;\s]+))' % name, flags=re.IGNORECASE)
+    for name in ("boundary", "name", "filename")
+}
+
+
+def _param(value, name):
+    match = _PARAM_RE[name].search(value or "")
+    if not match:
+        return None
+    text = match.group(1) if match.group(1) is not None else match.group(2)
+    if "''" in text:  # RFC 2231: charset'language'value
+        text = unquote(text.split("''", 1)[1], errors="replace")
+    if "=?" in text:  # RFC 2047 encoded words
+        try:
+            text = str(make_header(decode_header(text)))
+        except Exception:
+            pass
+    return text
+
+
+def sniff_type(head):
+    """File type from the first bytes of a payload; "text" or "unknown" when nothing matches."""
+    for offset, magic, kind in _MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return kind
+    if _HTML_MAGIC_RE.match(head[:512]):
+        return "html"
+    try:
+        head[:1024].decode("utf-8")
+        return "text"
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut at the end of the sample is still text
+        return "text" if e.start >= min(len(head), 1024) - 3 else "unknown"
+
+
+def extension_flags(filename):
+    """(last extension, double extension) for an attachment file name."""
+    name = (filename or "").lower().replace(_RTLO, "")
+    parts = [p.strip() for p in name.rsplit(".", 2)]
+    ext = parts[-1] if len(parts) > 1 else ""
+    double = len(parts) == 3 and parts[1] in _DECOY_EXTS and ext != parts[1] and ext not in _DECOY_EXTS
+    return ext, double or _RTLO in (filename or "")
+
+
+class _PartDigest:
+    """
+    Incremental decoder + SHA-256 for one attachment part. Only the sniffing head,
+    a few bytes of overlap for the macro marker and a small base64 batch are kept.
+    """
+    def __init__(self, headers):
+        self.headers = headers
+        self.encoding = (headers.get("content-transfer-encoding") or "7bit").strip().lower()
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.head = bytearray()
+        self.vba = False
+        self.__tail = b""
+        self.__b64 = []
+        self.__b64_rest = ""
+        self.__newline = False
+
+    def feed(self, line):
+        """One payload line, without its line terminator."""
+        if self.encoding == "base64":
+            self.__b64.append(line.strip())
+            if len(self.__b64) >= BASE64_BATCH:
+                self.__flush_base64()
+            return
+        data = line.encode("utf-8", errors="surrogateescape")
+        if self.encoding == "quoted-printable":
+            soft = data.rstrip().endswith(b"=")
+            data = binascii.a2b_qp(data.rstrip()[:-1] if soft else data)
+        else:
+            soft = False
+        self.__emit((b"\n" if self.__newline else b"") + data)
+        self.__newline = not soft
+
+    def close(self):
+        if self.encoding == "base64":
+            self.__flush_base64(final=True)
+        return self
+
+    def __flush_base64(self, final=False):
+        data = self.__b64_rest + "".join(self.__b64)
+        self.__b64 = []
+        cut = len(data) if final else len(data) - len(data) % 4
+        self.__b64_rest = data[cut:]
+        if final and cut % 4:
+            data = data[:cut] + "=" * (-cut % 4)
+            cut = len(data)
+        try:
+            self.__emit(binascii.a2b_base64(data[:cut]))
+        except (binascii.Error, ValueError):
+            pass  # truncated or corrupt encoding: hash what decoded so far
+
+    def __emit(self, chunk):
+        if not chunk:
+            return
+        self.sha.update(chunk)
+        self.size += len(chunk)
+        if len(self.head) < SNIFF_BYTES:
+            self.head += chunk[:SNIFF_BYTES - len(self.head)]
+        if not self.vba:
+            window = self.__tail + chunk
+            self.vba = _VBA_MARKER in window
+            self.__tail = window[-len(_VBA_MARKER):]
+
+
+def iter_parts(lines):
+    """
+    Streaming MIME walk over an iterable of lines (a file or io.StringIO).
+    Yields _PartDigest objects for attachment parts; nothing else is buffered.
+    """
+    boundaries = []  # open multipart delimiters, innermost last
+    in_headers, raw_headers, part = True, [], None
+
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if boundaries and line.startswith("--"):
+            marker = line.rstrip()  # delimiter lines may carry trailing whitespace
+            hit = next((d for d in range(len(boundaries) - 1, -1, -1)
+                        if marker == boundaries[d] or marker == boundaries[d] + "--"), None)
+            if hit is not None:
+                if part is not None:
+                    yield part.close()
+                    part = None
+                closing = marker != boundaries[hit]
+                del boundaries[hit + (0 if closing else 1):]
+                in_headers, raw_headers = not closing, []
+                continue
+        if in_headers:
+            if line.strip():
+                if line[:1] in " \t" and raw_headers:
+                    raw_headers[-1] += " " + line.strip()
+                else:
+                    raw_headers.append(line)
+                continue
+            in_headers = False
+            headers = {}
+            for raw in raw_headers:
+                key, _, value = raw.partition(":")
+                headers.setdefault(key.strip().lower(), value.strip())
+            ctype = headers.get("content-type", "text/plain")
+            if ctype.lower().startswith("multipart/"):
+                boundary = _param(ctype, "boundary")
+                if boundary:
+                    boundaries.append("--" + boundary)
+            elif _is_attachment(headers, ctype):
+                part = _PartDigest(headers)
+            continue
+        if part is not None:
+            part.feed(line)
+    if part is not None:
+        yield part.close()
+
+
+def _is_attachment(headers, ctype):
+    disposition = headers.get("content-disposition", "")
+    if disposition.lower().startswith("attachment") or _param(disposition, "filename") or _param(ctype, "name"):
+        return True
+    # Inline text parts are the body; anything else (application/*, images...) is a file
+    return not ctype.lower().startswith(("text/plain", "text/html", "message/"))
+
+
+def _load_bad_hashes(path):
+    if not path or not os.path.exists(path):
+        return frozenset()
+    with open(path, encoding="utf-8") as fh:
+        return frozenset(line.split("#", 1)[0].strip().lower() for line in fh if line.split("#", 1)[0].strip())
+
+
+class AttachmentScanner:
+    """
+    AttachmentScanner Class:
+    1. Walks the MIME tree line by line, hashing each attachment as it is decoded (bounded memory).
+    2. Sniffs the real file type from magic bytes and compares it with the extension.
+    3. Flags double extensions, macro-capable and executable files, and hashes on the known-bad list.
+    """
+    def __init__(self, bad_hashes_path=BAD_HASHES_PATH):
+        self.__bad = _load_bad_hashes(bad_hashes_path)
+
+    def scan_lines(self, lines):
+        """Attachment records for one message given as an iterable of lines."""
+        return [self.__describe(part) for part in iter_parts(lines)]
+
+    def scan(self, header, body):
+        """Attachment records for one stored email (header and body are walked without joining them)."""
+        if not _ATTACHMENT_HINT_RE.search(header):
+            return []  # single text part: nothing to walk
+        return self.scan_lines(chain(io.StringIO(header.rstrip("\n") + "\n"), ["\n"], io.StringIO(body)))
+
+    def scan_file(self, path):
+        """Attachment records for a message on disk, read line by line (for very large .eml files)."""
+        with open(path, encoding="utf-8", errors="surrogateescape", newline="") as fh:
+            return self.scan_lines(fh)
+
+    def features(self, messages):
+        """
+        messages: (header, body) pairs.
+        Returns a float DataFrame with ATTACHMENT_COLUMNS, one row per email.
+        """
+        out = np.zeros((len(messages), len(ATTACHMENT_COLUMNS)))
+        for i, (header, body) in enumerate(messages):
+            out[i] = self.counts(self.scan(header, body))
+        return pd.DataFrame(out, columns=ATTACHMENT_COLUMNS)
+
+    @staticmethod
+    def counts(attachments):
+        return (len(attachments), sum(a.size for a in attachments),
+                sum(a.double_extension for a in attachments), sum(a.macro_capable for a in attachments),
+                sum(a.executable for a in attachments), sum(a.type_mismatch for a in attachments),
+                sum(a.known_bad for a in attachments))
+
+    # --- Internal Utilities ---
+
+    def __describe(self, part):
+        ctype = part.headers.get("content-type", "application/octet-stream")
+        filename = _param(part.headers.get("content-disposition"), "filename") or _param(ctype, "name") or ""
+        ext, double = extension_flags(filename)
+        sniffed = sniff_type(bytes(part.head))
+        if sniffed == "zip" and part.vba:
+            sniffed = "ooxml-macro"
+        digest = part.sha.hexdigest()
+        declared = ctype.split(";", 1)[0].strip().lower()
+        # The content disagrees with what the extension or the declared MIME type claim
+        actual = "zip" if sniffed == "ooxml-macro" else sniffed
+        mismatch = actual not in ("text", "unknown") and any(
+            expected is not None and expected != actual
+            for expected in (_EXPECTED_TYPE.get(ext), _DECLARED_TYPE.get(declared))
+        )
+        return Attachment(
+            filename=filename,
+            declared_type=declared,
+            sniffed_type=sniffed,
+            size=part.size,
+            sha256=digest,
+            double_extension=bool(double),
+            macro_capable=ext in _MACRO_EXTS or sniffed in ("ole", "ooxml-macro"),
+            executable=ext in _EXECUTABLE_EXTS or sniffed in _EXECUTABLE_TYPES or sniffed == "iso",
+            type_mismatch=mismatch,
+            known_bad=digest in self.__bad
+        )
+
+
+@functools.lru_cache(maxsize=1)
+def default_attachment_scanner():
+    """Process-wide scanner: the known-bad hash list is loaded once."""
+    return AttachmentScanner()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan the attachments of .eml files.")
+    parser.add_argument("emails", nargs="+", help="Raw .eml files (read line by line)")
+    args = parser.parse_args()
+
+    scanner = default_attachment_scanner()
+    rows = [{"email": path, **a._asdict()} for path in args.emails for a in scanner.scan_file(path)]
+    if not rows:
+        print("No attachments found.")
+        return
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""
+Pipeline por lotes con memoria acotada para SpamSense AI
+Procesa los emails por bloques y vuelca las features a un buffer float32 en disco
+"""
+
+import os
+import tempfile
+import time
+import weakref
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from attachmentScan import default_attachment_scanner, ATTACHMENT_COLUMNS
+from featureAttribution import FeatureAttributor
+from forensics import extract_forensics, routing_features, ROUTING_COLUMNS
+from linkAnalysis import default_link_analyzer, LINK_COLUMNS
+from modelAssets import load_bundle, model_stamp, model_version
+from resultStore import email_key, body_hash
+from senderReputation import default_reputation_index, ReputationIndex, PREFILTER_RATIO, REPUTATION_COLUMNS
+
+DEFAULT_CHUNK_SIZE = int(os.environ.get("SPAMSENSE_CHUNK_SIZE", "256"))
+SPILL_DIR = os.environ.get("SPAMSENSE_SPILL_DIR") or None
+
+RESULT_COLUMNS = ["name", "label", "confidence", "ip", "urls", "domain", "subject_length", "body_tokens"] + ROUTING_COLUMNS + LINK_COLUMNS + ATTACHMENT_COLUMNS + REPUTATION_COLUMNS + ["prefiltered"]
+
+BatchReport = namedtuple("BatchReport", ["results", "feature_means", "features", "errors", "reused", "attributions", "batch_id"])
+
+
+def decode_email(raw):
+    """Uploaded bytes (or str) to the normalized text the processor expects."""
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8", errors="replace")
+    return raw.replace("\r\n", "\n")
+
+
+def per_email(compute, items, width, on_error):
+    """
+    compute(items) -> one row of `width` values per item, called once for the whole list.
+    If that call fails it is retried item by item, so a bad email only loses its own row:
+    failed rows are NaN and reported through on_error(item index, message).
+    """
+    try:
+        return np.asarray(compute(items), dtype=np.float64).reshape(len(items), width)
+    except Exception as e:
+        if len(items) == 1:
+            on_error(0, str(e))
+            return np.full((1, width), np.nan)
+    return np.vstack([per_email(compute, [item], width, lambda _, message, j=j: on_error(j, message))
+                      for j, item in enumerate(items)]) if items else np.empty((0, width))
+
+
+class FeatureBuffer:
+    """
+    Preallocated float32 feature matrix backed by a memory-mapped temp file.
+    Rows are appended chunk by chunk; pages already written can be evicted by the OS,
+    so resident memory stays bounded by the chunk size instead of the batch size.
+    """
+    def __init__(self, capacity, columns, spill_dir=SPILL_DIR):
+        self.columns = list(columns)
+        fd, self.path = tempfile.mkstemp(prefix="spamsense_features_", suffix=".f32", dir=spill_dir)
+        os.close(fd)
+        self.__data = np.memmap(self.path, dtype=np.float32, mode="w+",
+                                shape=(max(capacity, 1), len(self.columns)))
+        self.__rows = 0
+        # The mapping keeps the inode alive; the path is removed as soon as the buffer is dropped
+        weakref.finalize(self, os.remove, self.path)
+
+    def __len__(self):
+        return self.__rows
+
+    def append(self, block):
+        n = len(block)
+        self.__data[self.__rows:self.__rows + n] = block
+        self.__rows += n
+
+    def frame(self):
+        """Zero-copy DataFrame over the written rows."""
+        return pd.DataFrame(self.__data[:self.__rows], columns=self.columns, copy=False)
+
+
+class BatchAggregator:
+    """Running sums for the dashboard, updated once per chunk."""
+    def __init__(self, feature_names):
+        self.feature_names = list(feature_names)
+        self.__sums = np.zeros(len(self.feature_names), dtype=np.float64)
+        self.n = 0
+
+    def update(self, header_block):
+        self.__sums += header_block.sum(axis=0, dtype=np.float64)
+        self.n += len(header_block)
+
+    def feature_means(self):
+        return pd.Series(self.__sums / max(self.n, 1), index=self.feature_names)
+
+
+class BatchPipeline:
+    """
+    BatchPipeline Class:
+    1. Reads emails lazily in chunks and releases raw content once featurized.
+    2. Reuses stored results and embeddings, encoding only the missing bodies per chunk.
+    3. Writes features into a FeatureBuffer and aggregates dashboard statistics incrementally.
+    4. Explains each chunk with an optional FeatureAttributor, reusing stored attributions.
+    5. Reads sender history before scoring (pre-filtering repeat offenders) and folds the verdicts back in.
+    """
+    def __init__(self, processor, model, store, model_version, embedder_name,
+                 chunk_size=DEFAULT_CHUNK_SIZE, attributor=None, model_path=None, link_analyzer=None,
+                 attachment_scanner=None, reputation=None, prefilter_ratio=PREFILTER_RATIO):
+        self.processor = processor
+        self.model = model
+        self.store = store
+        self.model_version = model_version
+        self.embedder_name = embedder_name
+        self.chunk_size = chunk_size
+        self.attributor = attributor if attributor is not None and attributor.available else None
+        self.link_analyzer = link_analyzer or default_link_analyzer()
+        self.attachment_scanner = attachment_scanner or default_attachment_scanner()
+        self.reputation = reputation or default_reputation_index()
+        # Senders at or above this recent spam ratio are labeled SPAM without embedding (None: off)
+        self.prefilter_ratio = prefilter_ratio
+        # With a model_path, reloaded() picks up retrained artifacts
+        self.model_path = model_path
+        self.model_stamp = model_stamp(model_path) if model_path else None
+
+    def run(self, emails, total, on_progress=None, source="upload"):
+        """
+        emails: iterable of (name, raw bytes or str), consumed lazily.
+        total: number of emails, used to preallocate the feature buffer.
+        on_progress: optional callback(done, total, name).
+        source: tag of the stored batch (see ResultStore.list_batches).
+        """
+        columns = self.processor.columns
+        n_header = len(self.processor.feature_names)
+        buffer = FeatureBuffer(total, columns)
+        aggregator = BatchAggregator(columns[:n_header])
+        batch_id = self.store.start_batch(self.model_version, source)
+        results, errors, reused = [], [], 0
+        attributions = []
+
+        chunk, done = [], 0
+        for position, (name, raw) in enumerate(emails):
+            chunk.append((position, name, raw))
+            if len(chunk) == self.chunk_size:
+                # __process_chunk empties the list to release the raw emails
+                done += len(chunk)
+                reused += self.__process_chunk(chunk, batch_id, buffer, aggregator, results, errors, attributions)
+                if on_progress:
+                    on_progress(done, total, name)
+                chunk = []
+        if chunk:
+            done, name = done + len(chunk), chunk[-1][1]
+            reused += self.__process_chunk(chunk, batch_id, buffer, aggregator, results, errors, attributions)
+            if on_progress:
+                on_progress(done, total, name)
+
+        return BatchReport(
+            results=pd.DataFrame(results, columns=RESULT_COLUMNS),
+            feature_means=aggregator.feature_means(),
+            features=buffer.frame(),
+            errors=errors,
+            reused=reused,
+            attributions=pd.DataFrame(
+                np.vstack(attributions) if attributions else np.empty((0, len(self.attributor.groups))),
+                columns=self.attributor.groups
+            ) if self.attributor else None,
+            batch_id=batch_id
+        )
+
+    def reloaded(self):
+        """
+        This pipeline, or a new one over the same store if the artifact at model_path was
+        replaced since it was loaded (with the processor matched to the new model's columns).
+        The pipeline itself is never mutated, so a job already running keeps the model
+        (and model version) it started with.
+        """
+        if self.model_path is None:
+            return self
+        stamp = model_stamp(self.model_path)
+        if stamp == self.model_stamp:
+            return self
+        model = load_bundle(self.model_path)
+        processor = self.processor.for_model(model)
+        attributor = FeatureAttributor(model, processor.columns) if self.attributor else None
+        pipeline = BatchPipeline(processor, model, self.store, model_version(self.model_path), self.embedder_name,
+                                 self.chunk_size, attributor, self.model_path, self.link_analyzer,
+                                 self.attachment_scanner, self.reputation, self.prefilter_ratio)
+        pipeline.model_stamp = stamp
+        return pipeline
+
+    # --- Internal Utilities ---
+
+    def __process_chunk(self, chunk, batch_id, buffer, aggregator, results, errors, attributions):
+        n_header = len(self.processor.feature_names)
+        parsed, cached_rows, headers, bodies = [], {}, [], []
+        for position, name, raw in chunk:
+            try:
+                content = decode_email(raw)
+                message_id, content_hash = email_key(content)
+            except Exception as e:
+                errors.append((name, str(e)))
+                continue
+            header, _, body = content.partition("\n\n")
+            headers.append(header)
+            bodies.append(body)
+            cached = self.store.lookup(message_id, content_hash, self.model_version)
+            # Pre-filtered verdicts (no embedding) are not reused: the sender's history may have changed
+            if cached and cached["embedding"] is not None:
+                cached_rows[len(parsed)] = cached
+                parsed.append((position, name, None, message_id, content_hash, None))
+            else:
+                emb_ref = body_hash(content, self.embedder_name + self.processor.embedding_tag)
+                parsed.append((position, name, content, message_id, content_hash, emb_ref))
+        chunk.clear()  # raw uploads are no longer referenced by the pipeline
+
+        if not parsed:
+            return 0
+
+        fresh = [i for i in range(len(parsed)) if i not in cached_rows]
+        block = np.empty((len(parsed), len(buffer.columns)), dtype=np.float32)
+        labels = [None] * len(parsed)
+        confidences = np.empty(len(parsed))
+        tokens = np.full(len(parsed), np.nan)
+        forensics = [None] * len(parsed)
+        failed = set()
+
+        for i, cached in cached_rows.items():
+            block[i, :n_header] = [cached["header_features"][c] for c in buffer.columns[:n_header]]
+            block[i, n_header:] = cached["embedding"]
+            labels[i] = cached["label"]
+            confidences[i] = cached["confidence"]
+            forensics[i] = (cached["ip"], cached["urls"], cached["domain"])
+            if cached["body_tokens"] is not None:
+                tokens[i] = cached["body_tokens"]
+        for i in list(fresh):
+            try:
+                forensics[i] = extract_forensics(parsed[i][2])
+            except Exception as e:
+                errors.append((parsed[i][1], str(e)))
+                failed.add(i)
+                fresh.remove(i)
+        # Failed emails keep empty forensics so the chunk-wide passes below stay aligned
+        forensics = [f or (None, [], None) for f in forensics]
+
+        # Sender history as it was before this chunk, so no email sees its own verdict
+        reputation = pd.DataFrame(per_email(
+            lambda rows: self.reputation.features([f[2] for f in rows], [f[0] for f in rows]).to_numpy(),
+            forensics, len(REPUTATION_COLUMNS), self.__report(errors, parsed, range(len(parsed)), "sender history")
+        ), columns=REPUTATION_COLUMNS)
+        offender, offender_score = ReputationIndex.offenders(reputation, self.prefilter_ratio)
+        prefiltered = [i for i in fresh if offender[i]]
+        fresh = [i for i in fresh if not offender[i]]
+        records = []
+
+        for i in prefiltered:
+            position, name, content, message_id, content_hash, _ = parsed[i]
+            try:
+                block[i, :n_header] = self.processor.row_features(headers[i], bodies[i])
+            except Exception as e:
+                errors.append((name, str(e)))
+                failed.add(i)
+                continue
+            block[i, n_header:] = 0  # never embedded
+            labels[i], confidences[i] = "SPAM", offender_score[i]
+            ip, urls, domain = forensics[i]
+            records.append({
+                "message_id": message_id, "content_hash": content_hash,
+                "label": "SPAM", "probability": offender_score[i],
+                "confidence": confidences[i], "ip": ip, "domain": domain, "urls": urls,
+                "header_features": dict(zip(buffer.columns[:n_header], block[i, :n_header].tolist())),
+                "embedding": None, "embedding_ref": None, "body_tokens": None
+            })
+
+        if fresh:
+            values, proba, body_tokens, failures = self.__score([parsed[i] for i in fresh])
+            # Decision at the bundle's tuned threshold, not a fixed argmax
+            preds, confs = self.model.decide(proba)
+            for j, i in enumerate(fresh):
+                position, name, content, message_id, content_hash, emb_ref = parsed[i]
+                if j in failures:
+                    errors.append((name, failures[j]))
+                    failed.add(i)
+                    continue
+                block[i] = values[j]
+                labels[i] = "SPAM" if preds[j] == 1 else "HAM"
+                confidences[i] = confs[j]
+                tokens[i] = body_tokens[j]
+                ip, urls, domain = forensics[i]
+                records.append({
+                    "message_id": message_id, "content_hash": content_hash,
+                    "label": labels[i], "probability": proba[j, 1],
+                    "confidence": confidences[i], "ip": ip, "domain": domain, "urls": urls,
+                    "header_features": dict(zip(buffer.columns[:n_header], values[j, :n_header].tolist())),
+                    "embedding": values[j, n_header:], "embedding_ref": emb_ref,
+                    "body_tokens": None if np.isnan(tokens[i]) else int(tokens[i])
+                })
+        if records:
+            self.store.save_many(self.model_version, records)
+
+        keep = [i for i in range(len(parsed)) if i not in failed]
+        if not keep:
+            return 0
+        block = block[keep]
+        buffer.append(block)
+        aggregator.update(block[:, :n_header])
+        if self.attributor:
+            attributions.append(self.__attribute(block, [parsed[i] for i in keep], [cached_rows.get(i) for i in keep],
+                                                 [bool(offender[i]) and i not in cached_rows for i in keep]))
+        now = time.time()
+        # Pre-filtered verdicts come from the index itself: folding them back in would only
+        # reinforce the sender's ratio, so only model verdicts become history
+        observed = [i for i in keep if i not in prefiltered]
+        observations = [(parsed[i][4], forensics[i][2], forensics[i][0], labels[i] == "SPAM", now) for i in observed]
+        try:
+            self.reputation.update(observations)
+        except Exception:
+            # The chunk's transaction was rolled back: fold the emails in one by one instead
+            for i, observation in zip(observed, observations):
+                try:
+                    self.reputation.update([observation])
+                except Exception as e:
+                    errors.append((parsed[i][1], f"sender history not updated: {e}"))
+
+        # Received-chain routing, body links and attachments are computed for the whole chunk (cached or not).
+        # These are report features: an email they fail on keeps its verdict, with NaN in that group.
+        routing = per_email(lambda rows: routing_features([headers[i] for i in rows]).to_numpy(),
+                            keep, len(ROUTING_COLUMNS), self.__report(errors, parsed, keep, "routing"))
+        links = per_email(lambda rows: self.link_analyzer.features([(headers[i], bodies[i]) for i in rows],
+                                                                   [forensics[i][2] for i in rows]).to_numpy(),
+                          keep, len(LINK_COLUMNS), self.__report(errors, parsed, keep, "links"))
+        if self.processor.attachments:
+            # Already model inputs: reuse the counts instead of walking the MIME parts again
+            attachments = block[:, [buffer.columns.index(c) for c in ATTACHMENT_COLUMNS]].astype(np.float64)
+        else:
+            attachments = per_email(
+                lambda rows: self.attachment_scanner.features([(headers[i], bodies[i]) for i in rows]).to_numpy(),
+                keep, len(ATTACHMENT_COLUMNS), self.__report(errors, parsed, keep, "attachments")
+            )
+        subject_col = buffer.columns.index("subject_length")
+        members, histories = [], []
+        history_values = reputation.to_numpy()
+        for row, i in enumerate(keep):
+            position, name, _, message_id, content_hash, _ = parsed[i]
+            ip, urls, domain = forensics[i]
+            history = (*history_values[i], int(i in prefiltered))
+            results.append((name, labels[i], confidences[i], ip, urls, domain, int(block[row, subject_col]),
+                            tokens[i], *routing[row], *links[row], *attachments[row], *history))
+            histories.append(dict(zip(REPUTATION_COLUMNS + ["prefiltered"], history)))
+            members.append((position, name, message_id, content_hash))
+        self.store.add_many_to_batch(batch_id, members)
+        self.store.save_routing([(m[3], dict(zip(ROUTING_COLUMNS, r))) for m, r in zip(members, routing.tolist())])
+        self.store.save_links([(m[3], dict(zip(LINK_COLUMNS, r))) for m, r in zip(members, links.tolist())])
+        self.store.save_attachments([(m[3], dict(zip(ATTACHMENT_COLUMNS, r)))
+                                     for m, r in zip(members, attachments.tolist())])
+        self.store.save_sender_history([(m[3], h) for m, h in zip(members, histories)])
+        return len(cached_rows)
+
+    @staticmethod
+    def __report(errors, parsed, rows, what):
+        """on_error callback for per_email(): records '<what> skipped: <message>' for that email."""
+        rows = list(rows)
+        return lambda j, message: errors.append((parsed[rows[j]][1], f"{what} skipped: {message}"))
+
+    def __attribute(self, block, items, cached, prefiltered):
+        """
+        Attributions for a chunk: stored ones are reused, the rest explained in one call.
+        Pre-filtered emails were not scored by the model, so their contributions are zero.
+        """
+        groups = self.attributor.groups
+        values = np.empty((len(block), len(groups)))
+        missing = []
+        for row, hit in enumerate(cached):
+            if prefiltered[row]:
+                values[row] = 0
+            elif hit and hit["attributions"]:
+                values[row] = [hit["attributions"].get(g, 0.0) for g in groups]
+            else:
+                missing.append(row)
+        if missing:
+            values[missing] = self.attributor.explain(block[missing]).to_numpy()
+        fresh = missing + [row for row in range(len(block)) if prefiltered[row]]
+        if fresh:
+            self.store.save_attributions(self.model_version, self.attributor.method, [
+                (items[row][3], items[row][4], dict(zip(groups, values[row].tolist()))) for row in fresh
+            ])
+        return values
+
+    def __score(self, items):
+        """
+        Featurizes and predicts a list of parsed emails in one pass.
+        If the chunk fails, emails are retried one by one so a bad message only fails itself.
+        Returns (feature values, probabilities, body token counts, {item index: error message}).
+        """
+        try:
+            contents = [item[2] for item in items]
+            embeddings = [self.store.lookup_embedding(item[5]) for item in items]
+            f_df = self.processor.transform_batch(contents, embeddings)
+            tokens = np.asarray(f_df.attrs.get("body_tokens", [np.nan] * len(items)), dtype=np.float64)
+            return f_df.to_numpy(dtype=np.float32), self.model.predict_proba(f_df), tokens, {}
+        except Exception as e:
+            error = str(e)
+
+        n_cols = len(self.processor.columns)
+        values = np.zeros((len(items), n_cols), dtype=np.float32)
+        proba = np.zeros((len(items), 2))
+        tokens = np.full(len(items), np.nan)
+        if len(items) == 1:
+            return values, proba, tokens, {0: error}
+        failures = {}
+        for j, item in enumerate(items):
+            v, p, t, failure = self.__score([item])
+            if failure:
+                failures[j] = failure[0]
+            else:
+                values[j], proba[j], tokens[j] = v[0], p[0], t[0]
+        return values, proba, tokens, failures
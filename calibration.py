@@ -0,0 +1,151 @@
+"""
+Calibración de probabilidades y ajuste de umbral para SpamSense AI
+Ajusta Platt/isotónica sobre features almacenadas y barre umbrales sin re-embeber
+"""
+
+import argparse
+import csv
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import StratifiedKFold
+
+from modelAssets import MODEL_PATH, ScoreCalibrator, SpamClassifier, load_bundle, save_bundle
+
+_EPS = 1e-6
+
+
+def threshold_sweep(probabilities, labels):
+    """
+    Precision / recall / FPR for every distinct threshold, in one sort + cumsum.
+    Row t describes the rule "spam if P(spam) >= threshold_t".
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    y = np.asarray(labels).astype(bool)
+    order = np.argsort(-probabilities, kind="mergesort")
+    scores, y = probabilities[order], y[order]
+    tp = np.cumsum(y)
+    fp = np.cumsum(~y)
+    last = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]
+    tp, fp, thresholds = tp[last], fp[last], scores[last]
+    positives, negatives = max(int(y.sum()), 1), max(int((~y).sum()), 1)
+    precision = tp / np.maximum(tp + fp, 1)
+    recall = tp / positives
+    return pd.DataFrame({
+        "threshold": thresholds,
+        "precision": precision,
+        "recall": recall,
+        "fpr": fp / negatives,
+        "f1": 2 * precision * recall / np.maximum(precision + recall, _EPS),
+        "tp": tp,
+        "fp": fp
+    })
+
+
+def pick_threshold(sweep, max_fpr=None, min_precision=None):
+    """Highest-recall threshold within the FPR / precision limits; best F1 when unconstrained."""
+    ok = np.ones(len(sweep), dtype=bool)
+    if max_fpr is not None:
+        ok &= sweep["fpr"].to_numpy() <= max_fpr
+    if min_precision is not None:
+        ok &= sweep["precision"].to_numpy() >= min_precision
+    if not ok.any():
+        raise ValueError("No threshold satisfies the requested limits")
+    candidates = sweep[ok]
+    key = "recall" if (max_fpr is not None or min_precision is not None) else "f1"
+    return float(candidates.loc[candidates[key].idxmax(), "threshold"])
+
+
+def cross_fitted_probabilities(scores, labels, method, folds=5, seed=42):
+    """Out-of-fold calibrated probabilities, so the threshold sweep is not fit on its own data."""
+    labels = np.asarray(labels)
+    out = np.empty(len(scores))
+    n_splits = min(folds, np.bincount(labels, minlength=2).min())
+    if n_splits < 2:
+        return ScoreCalibrator(method).fit(scores, labels).transform(scores)
+    for fit_idx, eval_idx in StratifiedKFold(n_splits, shuffle=True, random_state=seed).split(scores, labels):
+        out[eval_idx] = ScoreCalibrator(method).fit(scores[fit_idx], labels[fit_idx]).transform(scores[eval_idx])
+    return out
+
+
+def fit_calibration(raw, labels, method="isotonic", max_fpr=None, min_precision=None):
+    """
+    Calibrator and decision threshold for raw model scores on labeled data.
+    Returns (calibrator or None for method "none", threshold, threshold sweep).
+    """
+    raw, labels = np.asarray(raw, dtype=np.float64), np.asarray(labels)
+    if method == "none":
+        calibrator, probabilities = None, raw
+    else:
+        calibrator = ScoreCalibrator(method).fit(raw, labels)
+        probabilities = cross_fitted_probabilities(raw, labels, method)
+    sweep = threshold_sweep(probabilities, labels)
+    return calibrator, pick_threshold(sweep, max_fpr, min_precision), sweep
+
+
+def read_label_csv(store, path):
+    """
+    Analyst labels from a CSV with a label column (SPAM/HAM or 1/0) and either
+    content_hash or message_id. Returns (content_hash, 0/1) pairs for scored emails.
+    """
+    pairs, by_message_id = [], {}
+    with open(path, newline="", encoding="utf-8") as fh:
+        for row in csv.DictReader(fh):
+            value = str(row["label"]).strip().upper()
+            label = 1 if value in ("1", "SPAM", "TRUE") else 0
+            if row.get("content_hash"):
+                pairs.append((row["content_hash"].strip(), label))
+            elif row.get("message_id"):
+                by_message_id[row["message_id"].strip()] = label
+    resolved = store.resolve_message_ids(by_message_id)
+    pairs += [(h, by_message_id[m]) for m, h in resolved.items()]
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the spam model and tune its decision threshold.")
+    parser.add_argument("--labels", help="CSV of analyst labels to import before calibrating")
+    parser.add_argument("--method", choices=["isotonic", "platt", "none"], default="isotonic")
+    parser.add_argument("--max-fpr", type=float, help="Highest acceptable false-positive rate")
+    parser.add_argument("--min-precision", type=float, help="Lowest acceptable spam precision")
+    parser.add_argument("--sweep-csv", help="Write the full threshold sweep here")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--dry-run", action="store_true", help="Report only, do not update the bundle")
+    args = parser.parse_args()
+
+    from emailProcessor import HEADER_FEATURES
+    from resultStore import ResultStore
+
+    store = ResultStore()
+    if args.labels:
+        store.set_labels(read_label_csv(store, args.labels))
+
+    bundle = load_bundle(args.model)
+    columns = list(bundle.feature_names_in_)
+    expected = [f.name for f in HEADER_FEATURES]
+    if columns[:len(expected)] != expected:
+        mismatched = [(want, got) for want, got in zip(expected, columns) if want != got]
+        raise ValueError(f"Model columns do not start with the header features; (expected, found): "
+                         f"{mismatched or expected[len(columns):]}")
+    _, X, y = store.labeled_matrix(columns)
+    if len(y) == 0:
+        raise SystemExit("No labeled emails with stored features. Import labels with --labels first.")
+
+    # Raw scores from stored features: one predict_proba call, no transformer inference
+    raw = SpamClassifier(bundle.estimator).spam_proba(X)
+    calibrator, threshold, sweep = fit_calibration(raw, y, args.method, args.max_fpr, args.min_precision)
+    chosen = sweep.loc[sweep["threshold"] == threshold].iloc[0]
+    print(f"{len(y)} labeled emails ({int(y.sum())} spam), method={args.method}")
+    print(f"threshold={threshold:.4f} precision={chosen.precision:.3f} "
+          f"recall={chosen.recall:.3f} fpr={chosen.fpr:.4f}")
+    if args.sweep_csv:
+        sweep.to_csv(args.sweep_csv, index=False)
+
+    if not args.dry_run:
+        metadata = dict(bundle.metadata, calibration=args.method, calibrated_on=len(y))
+        save_bundle(SpamClassifier(bundle.estimator, calibrator, threshold, metadata), args.model)
+        print(f"Bundle updated: {args.model}")
+
+
+if __name__ == "__main__":
+    main()
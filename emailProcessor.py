@@ -1,46 +1,237 @@
+import numpy as np
 import pandas as pd
-import re 
+import re
+from collections import namedtuple
+
+from attachmentScan import default_attachment_scanner, ATTACHMENT_COLUMNS
+from normalization import NORMALIZATION, normalization_tag, normalize_body
+
+# First prefix (in characters per window token) tokenized when counting body tokens
+TOKEN_PREFIX_CHARS = 8
+
+# --- Precompiled patterns ---
+_DOMAIN_RE = re.compile(r"@([\w\.-]+)")
+_RECIPIENT_RE = re.compile(r"@[\w\.-]+")
+_IPV4_RE = re.compile(r"\b(\d{1,3}(?:\.\d{1,3}){3})\b")
+_PRIVATE_IP_RE = re.compile(r"^(?:10\.|192\.168\.|172\.(?:1[6-9]|2\d|3[0-1])\.)")
+_RE_FWD_RE = re.compile(r"^(re:|fwd:)", flags=re.IGNORECASE)
+_LETTER_RE = re.compile(r"[A-Za-z]")
+_DIGIT_RE = re.compile(r"\d")
+_WILDCARD_TAIL_RE = re.compile(r"[A-Za-z\-]+", flags=re.IGNORECASE)
+
+# A header feature: output column, headers it reads ("List-*" = List- plus letters/hyphens)
+# and a function of the parsed HeaderView returning an int.
+FeatureSpec = namedtuple("FeatureSpec", ["name", "headers", "compute"])
+
+
+class HeaderView:
+    """
+    Single-pass view over a raw header block.
+    Only the headers requested by the feature plan are indexed; shared
+    intermediates (first value, sender domains) are computed once and memoized.
+    """
+    def __init__(self, header, wanted, wildcards):
+        self.__lines = header.split("\n")
+        self.__first = {}
+        self.__counts = dict.fromkeys(wanted, 0)
+        self.__counts.update(dict.fromkeys(wildcards, 0))
+        self.__values = {}
+        self.__domains = {}
+        self.received = []
+
+        for i, line in enumerate(self.__lines):
+            idx = line.find(":")
+            if idx <= 0:
+                continue
+            key = line[:idx].lower()
+            if key in wanted:
+                self.__counts[key] += 1
+                self.__first.setdefault(key, (i, idx))
+                if key == "received" and line[idx + 1:idx + 2] == " ":
+                    self.received.append(line[idx + 2:])
+            else:
+                for prefix in wildcards:
+                    if key.startswith(prefix) and _WILDCARD_TAIL_RE.fullmatch(key, len(prefix)):
+                        self.__counts[prefix] += 1
+
+    def get(self, name):
+        """Value of the first `name:` line, or None (same rules as ^name:\\s*(.*)$)."""
+        key = name.lower()
+        if key not in self.__values:
+            self.__values[key] = self.__resolve(key)
+        return self.__values[key]
+
+    def count(self, name):
+        return self.__counts.get(name.lower().rstrip("*"), 0)
+
+    def domain(self, name):
+        """Lower-cased first @domain of a header, or None."""
+        key = name.lower()
+        if key not in self.__domains:
+            value = self.get(key)
+            match = _DOMAIN_RE.search(value) if value else None
+            self.__domains[key] = match.group(1).lower() if match else None
+        return self.__domains[key]
+
+    def __resolve(self, key):
+        pos = self.__first.get(key)
+        if pos is None:
+            return None
+        i, idx = pos
+        rest = self.__lines[i][idx + 1:].strip()
+        if rest:
+            return rest
+        # Empty value: the leading \s* of the original pattern runs into the next non-blank line
+        for line in self.__lines[i + 1:]:
+            if line.strip():
+                return line.strip()
+        return ""
+
+
+# --- Header Feature Engineering ---
+
+def _domains_differ(h, a, b):
+    d_a, d_b = h.domain(a), h.domain(b)
+    if not d_a or not d_b: return 0
+    return int(d_a != d_b)
+
+def _received_first_ip_is_private(h):
+    if not h.received:
+        return 0
+    ip_match = _IPV4_RE.search(h.received[-1])
+    if not ip_match:
+        return 0
+    return int(bool(_PRIVATE_IP_RE.match(ip_match.group(1))))
+
+def _message_id_is_random(h):
+    msgid = h.get("Message-ID")
+    if not msgid: return 0
+    local = msgid.split("@")[0]
+    return int(bool(len(local) > 25 and _LETTER_RE.search(local) and _DIGIT_RE.search(local)))
+
+def _subject_length(h):
+    sub = h.get("Subject")
+    return len(sub) if sub else 0
+
+def _num_recipients(h):
+    to = h.get("To") or ""
+    cc = h.get("CC") or ""
+    return len(_RECIPIENT_RE.findall(to)) + len(_RECIPIENT_RE.findall(cc))
+
+# Order matters: it is the column order the classifier was trained on.
+HEADER_FEATURES = (
+    FeatureSpec("num_received_headers", ("Received",), lambda h: h.count("Received")),
+    FeatureSpec("received_first_ip_is_private", ("Received",), _received_first_ip_is_private),
+    FeatureSpec("from_returnpath_match", ("From", "Return-Path"), lambda h: _domains_differ(h, "From", "Return-Path")),
+    FeatureSpec("reply_to_differs_from_from", ("From", "Reply-To"), lambda h: _domains_differ(h, "From", "Reply-To")),
+    FeatureSpec("message_id_missing", ("Message-ID",), lambda h: int(h.get("Message-ID") is None)),
+    FeatureSpec("message_id_matches_from", ("From", "Message-ID"), lambda h: _domains_differ(h, "From", "Message-ID")),
+    FeatureSpec("message_id_is_random", ("Message-ID",), _message_id_is_random),
+    FeatureSpec("subject_length", ("Subject",), _subject_length),
+    FeatureSpec("subject_starts_with_re_fwd", ("Subject",), lambda h: int(bool(_RE_FWD_RE.match(h.get("Subject") or "")))),
+    FeatureSpec("num_recipients", ("To", "CC"), _num_recipients),
+    FeatureSpec("to_contains_undisclosed_recipients", ("To",), lambda h: int("undisclosed" in (h.get("To") or "").lower())),
+    FeatureSpec("is_html", ("Content-Type",), lambda h: int("text/html" in (h.get("Content-Type") or "").lower())),
+    FeatureSpec("is_multipart", ("Content-Type",), lambda h: int("multipart/" in (h.get("Content-Type") or "").lower())),
+    FeatureSpec("num_list_headers", ("List-*",), lambda h: h.count("List-*")),
+)
+
 
 class EmailProcessor:
     """
-    EmailProcessor Class: 
+    EmailProcessor Class:
     1. Extracts header and body from raw email strings.
-    2. Performs feature engineering on headers.
-    3. Generates text embeddings for the email body.
+    2. Performs feature engineering on headers (and, optionally, attachment counts).
+    3. Normalizes the email body and generates its text embedding.
     """
-    def __init__(self, embedding_model):
+    def __init__(self, embedding_model, features=HEADER_FEATURES, normalization=NORMALIZATION, attachments=False):
         self.__embedding_model = embedding_model
-    
-    def transform_raw_email(self, raw_input):
-        """Main pipeline to transform raw string into a feature dictionary."""
-        email_split = self.__dividir_correo(raw_input)
-        header = email_split["header"]
-        body = email_split["body"]
-
-        # Add the new engineered features
-        transformed_email = {
-            "num_received_headers": self.__num_received_headers(header),
-            "received_first_ip_is_private": self.__received_first_ip_is_private(header),
-            "from_returnpath_match": self.__from_returnpath_match(header),
-            "reply_to_differs_from_from": self.__reply_to_differs_from_from(header),
-            "message_id_missing": self.__message_id_missing(header),
-            "message_id_matches_from": self.__message_id_matches_from(header),
-            "message_id_is_random": self.__message_id_is_random(header),
-            "subject_length": self.__subject_length(header),
-            "subject_starts_with_re_fwd": self.__subject_starts_with_re_fwd(header),
-            "num_recipients": self.__num_recipients(header),
-            "to_contains_undisclosed_recipients": self.__to_contains_undisclosed_recipients(header),
-            "is_html": self.__is_html(header),
-            "is_multipart": self.__is_multipart(header),
-            "num_list_headers": self.__num_list_headers(header)
-        }
+        self.normalization = normalization
+        # Attachment counts are model inputs only for classifiers trained with them
+        self.attachments = attachments
+        self.__features = tuple(features)
+        # Evaluation plan: the union of headers every feature declares, indexed in one pass
+        declared = {h.lower() for spec in self.__features for h in spec.headers}
+        self.__wanted = frozenset(h for h in declared if not h.endswith("*"))
+        self.__wildcards = tuple(sorted(h[:-1] for h in declared if h.endswith("*")))
+
+    @property
+    def feature_names(self):
+        """Non-embedding columns: header features, then ATTACHMENT_COLUMNS when enabled."""
+        return [spec.name for spec in self.__features] + (ATTACHMENT_COLUMNS if self.attachments else [])
+
+    def for_model(self, model):
+        """
+        This processor, or a sibling sharing the embedding model, whose columns match
+        the features `model` was trained on (with or without attachment counts).
+        """
+        wanted = "attachment_count" in getattr(model, "feature_names_in_", ())
+        if wanted == self.attachments:
+            return self
+        return EmailProcessor(self.__embedding_model, self.__features, self.normalization, attachments=wanted)
 
-        # Add the body embedding
-        emb_vector = self.__embed_correo(body)
-        for i in range(len(emb_vector)):
-            transformed_email[f"emb_{i}"] = emb_vector[i]
-        
-        return pd.DataFrame([transformed_email])
+    @property
+    def embedding_tag(self):
+        """Distinguishes cached embeddings produced under different body normalizations."""
+        return normalization_tag(self.normalization)
+
+    @property
+    def columns(self):
+        """Full model input columns: feature_names followed by emb_0..emb_{d-1}."""
+        dim = self.__embedding_model.get_sentence_embedding_dimension()
+        return self.feature_names + [f"emb_{i}" for i in range(dim)]
+
+    def transform_raw_email(self, raw_input, embedding=None):
+        """
+        Main pipeline to transform raw string into a one-row float32 feature frame.
+        A previously computed body embedding can be passed to skip the encoder.
+        """
+        return self.transform_batch([raw_input], None if embedding is None else [embedding])
+
+    def transform_batch(self, raw_inputs, embeddings=None):
+        """
+        Chunked variant of transform_raw_email.
+        Bodies without a precomputed embedding are encoded in a single encoder call;
+        their encoder token counts are in attrs["body_tokens"] (NaN for the others).
+        """
+        embeddings = list(embeddings) if embeddings is not None else [None] * len(raw_inputs)
+        headers, pending, pending_idx = [], [], []
+        for i, raw_input in enumerate(raw_inputs):
+            email_split = self.__dividir_correo(raw_input)
+            headers.append(self.row_features(email_split["header"], email_split["body"]))
+            if embeddings[i] is None:
+                pending.append(normalize_body(email_split["header"], email_split["body"], self.normalization))
+                pending_idx.append(i)
+
+        tokens = np.full(len(raw_inputs), np.nan)
+        if pending:
+            encoded = self.__embedding_model.encode(pending, convert_to_numpy=True)
+            for i, vector in zip(pending_idx, encoded):
+                embeddings[i] = vector
+            tokens[pending_idx] = self.count_tokens(pending)
+
+        columns = self.columns
+        n_header = len(self.feature_names)
+        matrix = np.empty((len(raw_inputs), len(columns)), dtype=np.float32)
+        if len(raw_inputs):
+            matrix[:, :n_header] = headers
+            matrix[:, n_header:] = np.asarray(embeddings, dtype=np.float32)
+        frame = pd.DataFrame(matrix, columns=columns, copy=False)
+        frame.attrs["body_tokens"] = tokens.tolist()
+        return frame
+
+    def row_features(self, header, body):
+        """Values of feature_names for one email (everything but the embedding)."""
+        values = list(self.header_features(header).values())
+        if self.attachments:
+            scanner = default_attachment_scanner()
+            values += scanner.counts(scanner.scan(header, body))
+        return values
+
+    def header_features(self, header):
+        """Evaluates every registered header feature over a single parse of the header."""
+        view = HeaderView(header, self.__wanted, self.__wildcards)
+        return {spec.name: spec.compute(view) for spec in self.__features}
 
     # --- Internal Utilities ---
 
@@ -52,99 +243,31 @@ class EmailProcessor:
             "body": parts[1] if len(parts) > 1 else ""
         }
 
-    def __get_cabecera(self, cabecera_str, nombre_cabecera):
-        patron = rf"^{nombre_cabecera}:\s*(.*)$"
-        match = re.search(patron, cabecera_str, flags=re.IGNORECASE | re.MULTILINE)
-        return match.group(1).strip() if match else None
-
-    # --- Header Feature Engineering ---
-
-    def __num_received_headers(self, header):
-        return len(re.findall(r'^Received:', header, flags=re.IGNORECASE | re.MULTILINE))
-
-    def __received_first_ip_is_private(self, header):
-        patrones_privados = [r'^10\.', r'^192\.168\.', r'^172\.(1[6-9]|2\d|3[0-1])\.']
-        received_headers = re.findall(r'^Received: (.*)$', header, flags=re.IGNORECASE | re.MULTILINE)
-        if not received_headers:
-            return 0
-        first_hop = received_headers[-1]
-        ip_match = re.search(r"\b(\d{1,3}(?:\.\d{1,3}){3})\b", first_hop)
-        if not ip_match:
-            return 0
-        ip = ip_match.group(1)
-        return int(any(re.match(p, ip) for p in patrones_privados))
-
-    def __from_returnpath_match(self, header):
-        from_c = self.__get_cabecera(header, "From")
-        rpath = self.__get_cabecera(header, "Return-Path")
-        if not from_c or not rpath: return 0
-        d_from = re.findall(r"@([\w\.-]+)", from_c)
-        d_rp = re.findall(r"@([\w\.-]+)", rpath)
-        if not d_from or not d_rp: return 0
-        return int(d_from[0].lower() != d_rp[0].lower())
-
-    def __reply_to_differs_from_from(self, header):
-        from_c = self.__get_cabecera(header, "From")
-        reply_to = self.__get_cabecera(header, "Reply-To")
-        if not from_c or not reply_to: return 0
-        d_from = re.findall(r"@([\w\.-]+)", from_c)
-        d_rt = re.findall(r"@([\w\.-]+)", reply_to)
-        if not d_from or not d_rt: return 0
-        return int(d_from[0].lower() != d_rt[0].lower())
-
-    def __message_id_missing(self, header):
-        return int(self.__get_cabecera(header, 'Message-ID') is None)
-
-    def __message_id_matches_from(self, header):
-        from_c = self.__get_cabecera(header, "From")
-        msgid = self.__get_cabecera(header, "Message-ID")
-        if not from_c or not msgid: return 0
-        d_from = re.findall(r"@([\w\.-]+)", from_c)
-        d_msg = re.findall(r"@([\w\.-]+)", msgid)
-        if not d_from or not d_msg: return 0
-        return int(d_from[0].lower() != d_msg[0].lower())
-
-    def __message_id_is_random(self, header):
-        msgid = self.__get_cabecera(header, "Message-ID")
-        if not msgid: return 0
-        local = msgid.split("@")[0]
-        return int(bool(len(local) > 25 and re.search(r"[A-Za-z]", local) and re.search(r"\d", local)))
-
-    def __subject_length(self, header):
-        sub = self.__get_cabecera(header, "Subject")
-        return len(sub) if sub else 0
-
-    def __subject_starts_with_re_fwd(self, header):
-        sub = self.__get_cabecera(header, "Subject") or ""
-        return int(bool(re.match(r"^(re:|fwd:)", sub, flags=re.IGNORECASE)))
-
-    def __num_recipients(self, header):
-        to = self.__get_cabecera(header, "To") or ""
-        cc = self.__get_cabecera(header, "CC") or ""
-        return len(re.findall(r"@[\w\.-]+", to)) + len(re.findall(r"@[\w\.-]+", cc))
-
-    def __to_contains_undisclosed_recipients(self, header):
-        to = self.__get_cabecera(header, "To") or ""
-        return int("undisclosed" in to.lower())
-
-    def __is_html(self, header):
-        ct = self.__get_cabecera(header, "Content-Type") or ""
-        return int("text/html" in ct.lower())
-
-    def __is_multipart(self, header):
-        ct = self.__get_cabecera(header, "Content-Type") or ""
-        return int("multipart/" in ct.lower())
-
-    def __num_list_headers(self, header):
-        return len(re.findall(r"^List-[A-Za-z\-]+:", header, flags=re.IGNORECASE | re.MULTILINE))
-
     # --- Body Feature Engineering ---
 
-    def __limpiar_texto(self, texto):
-        texto = re.sub(r"<.*?>", "", texto)
-        texto = re.sub(r"\s+", " ", texto)
-        return texto.strip()
-    
-    def __embed_correo(self, body):
-        cuerpo_limpio = self.__limpiar_texto(body)
-        return self.__embedding_model.encode(cuerpo_limpio, convert_to_numpy=True).tolist()
\ No newline at end of file
+    def count_tokens(self, texts):
+        """
+        Encoder tokens per normalized body, capped at the model window + 1 (anything past the
+        window is truncated by the encoder). Only a prefix of each body is tokenized, grown
+        while it still fits the window, so long bodies are not tokenized in full a second time.
+        """
+        tokenizer = getattr(self.__embedding_model, "tokenizer", None)
+        if tokenizer is None:
+            return [len(t.split()) for t in texts]
+        window = getattr(self.__embedding_model, "max_seq_length", None)
+        if not window:
+            return [len(ids) for ids in tokenizer(list(texts), add_special_tokens=True, truncation=False)["input_ids"]]
+        counts = [0] * len(texts)
+        pending, limit = list(range(len(texts))), window * TOKEN_PREFIX_CHARS
+        while pending:
+            ids = tokenizer([texts[i][:limit] for i in pending], add_special_tokens=True, truncation=False)["input_ids"]
+            grow = []
+            for i, seq in zip(pending, ids):
+                if len(seq) > window:
+                    counts[i] = window + 1
+                elif len(texts[i]) <= limit:
+                    counts[i] = len(seq)
+                else:
+                    grow.append(i)
+            pending, limit = grow, limit * 4
+        return counts
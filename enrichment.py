@@ -0,0 +1,261 @@
+"""
+Enriquecimiento de IPs y dominios para SpamSense AI
+Backend HTTP (ip-api.com / rdap.net), offline a partir de ficheros locales o stub para pruebas de carga
+"""
+
+import argparse
+import csv
+import ipaddress
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import requests
+
+ENRICHMENT_MODE = os.environ.get("SPAMSENSE_ENRICHMENT", "http")
+ENRICHMENT_DIR = os.environ.get("SPAMSENSE_ENRICHMENT_DIR", "data/enrichment")
+STUB_LATENCY_MS = float(os.environ.get("SPAMSENSE_STUB_LATENCY_MS", "50"))  # simulated round trip of the stub backend
+
+IP_TABLE = "ip_ranges.csv"
+DOMAIN_TABLE = "domains.csv"
+_COMPILED = "compiled.npz"
+_GEO_FIELDS = ("country", "city", "lat", "lon", "isp", "asn")
+
+
+def _ipv4_to_int(ip):
+    """Dotted quad to int without ipaddress overhead; None if not a valid IPv4."""
+    parts = ip.split(".")
+    if len(parts) != 4:
+        return None
+    value = 0
+    for part in parts:
+        if not part.isdigit() or int(part) > 255:
+            return None
+        value = (value << 8) | int(part)
+    return value
+
+
+def _parse_date(value):
+    date = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+class HttpEnrichment:
+    """Online lookups against ip-api.com and rdap.net, memoized per process."""
+    name = "http"
+
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self.__geo = {}
+        self.__domains = {}
+
+    def geo(self, ip):
+        """ip-api style dict (country, city, lat, lon, isp) or None."""
+        if not ip: return None
+        if ip not in self.__geo:
+            try:
+                res = requests.get(f"http://ip-api.com/json/{ip}?fields=status,country,city,lat,lon,isp", timeout=self.timeout)
+                data = res.json()
+                self.__geo[ip] = data if data.get("status") == "success" else None
+            except Exception:
+                return None
+        return self.__geo[ip]
+
+    def domain_registration(self, domain):
+        """Registration datetime, None if unknown. Raises on lookup failure."""
+        if domain not in self.__domains:
+            registered = None
+            response = requests.get(f"https://rdap.net/domain/{domain}", timeout=self.timeout)
+            if response.status_code == 200:
+                for event in response.json().get("events", []):
+                    if event.get("eventAction") == "registration":
+                        registered = _parse_date(event.get("eventDate"))
+                        break
+            self.__domains[domain] = registered
+        return self.__domains[domain]
+
+
+class OfflineEnrichment:
+    """
+    OfflineEnrichment Class:
+    1. Answers geo/ASN lookups from a non-overlapping IPv4 range table with a binary search.
+    2. Answers domain registration dates from a local table, falling back to parent domains.
+    3. Reloads transparently when the files in data_dir are refreshed.
+    """
+    name = "offline"
+
+    def __init__(self, data_dir=ENRICHMENT_DIR):
+        self.data_dir = data_dir
+        self.__lock = threading.Lock()
+        self.__stamp = None
+        self.refresh()
+
+    def refresh(self):
+        """Reloads the tables if their files changed since the last load."""
+        stamp = tuple(self.__mtime(name) for name in (IP_TABLE, DOMAIN_TABLE, _COMPILED))
+        if stamp == self.__stamp:
+            return False
+        with self.__lock:
+            # Tables are swapped in whole, so concurrent lookups never see a half-loaded state
+            self.__ip_table = self.__load_ip_table()
+            self.__domains = self.__load_domain_table()
+            self.__stamp = tuple(self.__mtime(name) for name in (IP_TABLE, DOMAIN_TABLE, _COMPILED))
+        return True
+
+    def geo(self, ip):
+        if not ip: return None
+        value = _ipv4_to_int(ip)
+        if value is None:
+            return None
+        starts, ends, rows = self.__ip_table
+        idx = int(starts.searchsorted(np.uint32(value), side="right")) - 1
+        if idx < 0 or value > ends[idx]:
+            return None
+        row = rows[idx]
+        return {"status": "success", **dict(zip(_GEO_FIELDS, row))}
+
+    def domain_registration(self, domain):
+        labels = domain.lower().rstrip(".").split(".")
+        for i in range(len(labels) - 1):
+            registered = self.__domains.get(".".join(labels[i:]))
+            if registered is not None:
+                return registered
+        return None
+
+    # --- Internal Utilities ---
+
+    def __mtime(self, name):
+        path = os.path.join(self.data_dir, name)
+        return os.path.getmtime(path) if os.path.exists(path) else None
+
+    def __load_ip_table(self):
+        compiled = os.path.join(self.data_dir, _COMPILED)
+        csv_path = os.path.join(self.data_dir, IP_TABLE)
+        if os.path.exists(compiled) and (not os.path.exists(csv_path)
+                                         or os.path.getmtime(compiled) >= os.path.getmtime(csv_path)):
+            data = np.load(compiled, allow_pickle=False)
+            rows = [
+                (str(c), str(ci), float(la), float(lo), str(i), str(a))
+                for c, ci, la, lo, i, a in zip(data["country"], data["city"], data["lat"],
+                                               data["lon"], data["isp"], data["asn"])
+            ]
+            return data["starts"], data["ends"], rows
+        starts, ends, rows = read_ip_ranges(csv_path) if os.path.exists(csv_path) else ([], [], [])
+        return np.asarray(starts, dtype=np.uint32), np.asarray(ends, dtype=np.uint32), rows
+
+    def __load_domain_table(self):
+        domains = {}
+        path = os.path.join(self.data_dir, DOMAIN_TABLE)
+        if not os.path.exists(path):
+            return domains
+        with open(path, newline="", encoding="utf-8") as fh:
+            for row in csv.DictReader(fh):
+                try:
+                    domains[row["domain"].strip().lower()] = _parse_date(row["registered"])
+                except (KeyError, ValueError):
+                    continue
+        return domains
+
+
+class StubEnrichment:
+    """Deterministic local answers after a fixed delay, standing in for ip-api/RDAP in load tests."""
+    name = "stub"
+
+    def __init__(self, latency_ms=STUB_LATENCY_MS):
+        self.latency = latency_ms / 1000.0
+
+    def geo(self, ip):
+        if not ip: return None
+        value = _ipv4_to_int(ip)
+        if value is None:
+            return None
+        self.__wait()
+        return {"status": "success", "country": "Stubland", "city": f"Stub {value % 97}",
+                "lat": value % 180 - 90.0, "lon": value % 360 - 180.0, "isp": "Stub ISP", "asn": f"AS{value % 65536}"}
+
+    def domain_registration(self, domain):
+        self.__wait()
+        return datetime(2000 + len(domain) % 25, 1, 1, tzinfo=timezone.utc)
+
+    # --- Internal Utilities ---
+
+    def __wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+def read_ip_ranges(path):
+    """
+    Reads an IPv4 range table sorted by start address.
+    Rows give either start_ip/end_ip or a CIDR network, plus country, city, lat, lon, isp, asn.
+    """
+    entries = []
+    with open(path, newline="", encoding="utf-8") as fh:
+        for row in csv.DictReader(fh):
+            try:
+                if row.get("network"):
+                    net = ipaddress.IPv4Network(row["network"].strip(), strict=False)
+                    start, end = int(net.network_address), int(net.broadcast_address)
+                else:
+                    start = int(ipaddress.IPv4Address(row["start_ip"].strip()))
+                    end = int(ipaddress.IPv4Address(row["end_ip"].strip()))
+                lat, lon = float(row.get("lat") or 0), float(row.get("lon") or 0)
+            except (KeyError, ValueError):
+                continue  # malformed rows (bad address, network or coordinates) are skipped
+            geo = (row.get("country", ""), row.get("city", ""), lat, lon, row.get("isp", ""), row.get("asn", ""))
+            entries.append((start, end, geo))
+    entries.sort(key=lambda e: e[0])
+    return [e[0] for e in entries], [e[1] for e in entries], [e[2] for e in entries]
+
+
+def compile_tables(data_dir):
+    """Pre-sorts the IP table into a .npz so app startup skips CSV parsing."""
+    starts, ends, rows = read_ip_ranges(os.path.join(data_dir, IP_TABLE))
+    columns = list(zip(*rows)) if rows else [()] * len(_GEO_FIELDS)
+    path = os.path.join(data_dir, _COMPILED)
+    with open(path + ".tmp", "wb") as fh:
+        np.savez(
+            fh,
+            starts=np.asarray(starts, dtype=np.uint32), ends=np.asarray(ends, dtype=np.uint32),
+            country=np.asarray(columns[0], dtype=str), city=np.asarray(columns[1], dtype=str),
+            lat=np.asarray(columns[2], dtype=np.float64), lon=np.asarray(columns[3], dtype=np.float64),
+            isp=np.asarray(columns[4], dtype=str), asn=np.asarray(columns[5], dtype=str)
+        )
+    os.replace(path + ".tmp", path)
+    return len(starts)
+
+
+def make_enrichment(mode=ENRICHMENT_MODE, data_dir=ENRICHMENT_DIR):
+    """Backend selected by SPAMSENSE_ENRICHMENT ("http", "offline" or "stub")."""
+    if mode == "offline":
+        return OfflineEnrichment(data_dir)
+    if mode == "http":
+        return HttpEnrichment()
+    if mode == "stub":
+        return StubEnrichment()
+    raise ValueError(f"Unknown enrichment mode: {mode}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the offline enrichment tables.")
+    parser.add_argument("--ip-csv", help="IPv4 range table (start_ip,end_ip or network + geo columns)")
+    parser.add_argument("--domain-csv", help="Domain table (domain,registered)")
+    parser.add_argument("--data-dir", default=ENRICHMENT_DIR)
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    # Copy to a temp name and rename so a running app never reads a half-written file
+    for src, name in ((args.ip_csv, IP_TABLE), (args.domain_csv, DOMAIN_TABLE)):
+        if src:
+            dst = os.path.join(args.data_dir, name)
+            shutil.copyfile(src, dst + ".tmp")
+            os.replace(dst + ".tmp", dst)
+    if os.path.exists(os.path.join(args.data_dir, IP_TABLE)):
+        print(f"Compiled {compile_tables(args.data_dir)} IP ranges into {args.data_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Exportación columnar para SpamSense AI
+Escribe resultados + matriz completa de features/embeddings en Parquet o Arrow IPC
+"""
+
+import io
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from batchPipeline import RESULT_COLUMNS
+from quantization import EMBEDDING_PRECISION, quantize
+
+DEFAULT_ROW_GROUP_SIZE = 4096
+
+_STRING_RESULTS = ("name", "label", "ip", "domain")
+_EMBEDDING_TYPES = {"float32": pa.float32(), "float16": pa.float16(), "int8": pa.int8()}
+
+
+def _result_type(col, results_df):
+    if col == "urls":
+        return pa.list_(pa.string())
+    if col in _STRING_RESULTS:
+        return pa.string()
+    if col in results_df.columns and pd.api.types.is_numeric_dtype(results_df[col].dtype):
+        return pa.from_numpy_dtype(results_df[col].dtype)
+    return pa.float64()
+
+
+def export_schema(results_df, features_df, metadata=None, precision=EMBEDDING_PRECISION):
+    """
+    Arrow schema: the result columns (batchPipeline.RESULT_COLUMNS), one column per header
+    feature not already among them and a fixed-size embedding list at `precision`.
+    int8 embeddings come with a per-row embedding_scale column.
+    """
+    header_cols = [c for c in features_df.columns if not c.startswith("emb_") and c not in RESULT_COLUMNS]
+    dim = sum(1 for c in features_df.columns if c.startswith("emb_"))
+    fields = [pa.field(col, _result_type(col, results_df)) for col in RESULT_COLUMNS]
+    for col in header_cols:
+        fields.append(pa.field(col, pa.from_numpy_dtype(features_df[col].dtype)))
+    fields.append(pa.field("embedding", pa.list_(_EMBEDDING_TYPES[precision], dim)))
+    if precision == "int8":
+        fields.append(pa.field("embedding_scale", pa.float32()))
+    meta = {k: str(v) for k, v in (metadata or {}).items()}
+    meta["embedding_precision"] = precision
+    return pa.schema(fields, metadata=meta)
+
+
+def iter_record_batches(results_df, features_df, schema, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    """
+    Yields one RecordBatch per row group without materializing the whole table. Missing values
+    (NaN / None, e.g. an email without a sender domain) become nulls; result columns a stored
+    report predates are all null.
+    """
+    precision = schema.metadata[b"embedding_precision"].decode()
+    emb_cols = [c for c in features_df.columns if c.startswith("emb_")]
+    header_cols = [c for c in features_df.columns if not c.startswith("emb_") and c not in RESULT_COLUMNS]
+    dim = len(emb_cols)
+
+    for start in range(0, len(results_df), row_group_size):
+        stop = min(start + row_group_size, len(results_df))
+        res = results_df.iloc[start:stop]
+        feats = features_df.iloc[start:stop]
+
+        # Quantized one row group at a time, so the export never holds a full-size copy
+        codes, scales = quantize(feats[emb_cols].to_numpy(dtype=np.float32), precision)
+        emb_array = pa.FixedSizeListArray.from_arrays(pa.array(np.ascontiguousarray(codes).ravel()), dim)
+
+        columns = []
+        for col in RESULT_COLUMNS:
+            kind = schema.field(col).type
+            if col not in res.columns:
+                columns.append(pa.nulls(len(res), kind))
+            elif col == "urls":
+                columns.append(pa.array([list(u) if isinstance(u, (list, tuple)) else [] for u in res[col]], kind))
+            else:
+                columns.append(pa.array(res[col], type=kind, from_pandas=True))
+        columns += [pa.array(feats[col].to_numpy()) for col in header_cols]
+        columns.append(emb_array)
+        if scales is not None:
+            columns.append(pa.array(scales))
+        yield pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def write_parquet(results_df, features_df, sink, row_group_size=DEFAULT_ROW_GROUP_SIZE, metadata=None,
+                  precision=EMBEDDING_PRECISION):
+    """Streams results + features into a Parquet file, one row group per chunk."""
+    schema = export_schema(results_df, features_df, metadata, precision)
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for batch in iter_record_batches(results_df, features_df, schema, row_group_size):
+            writer.write_batch(batch, row_group_size=row_group_size)
+
+
+def write_arrow(results_df, features_df, sink, row_group_size=DEFAULT_ROW_GROUP_SIZE, metadata=None,
+                precision=EMBEDDING_PRECISION):
+    """Streams results + features into an Arrow IPC (Feather v2) file for zero-copy reads."""
+    schema = export_schema(results_df, features_df, metadata, precision)
+    with pa.ipc.new_file(sink, schema) as writer:
+        for batch in iter_record_batches(results_df, features_df, schema, row_group_size):
+            writer.write_batch(batch)
+
+
+def export_bytes(results_df, features_df, fmt="parquet", **kwargs):
+    """In-memory export for st.download_button."""
+    buffer = io.BytesIO()
+    if fmt == "parquet":
+        write_parquet(results_df, features_df, buffer, **kwargs)
+    elif fmt == "arrow":
+        write_arrow(results_df, features_df, buffer, **kwargs)
+    else:
+        raise ValueError(f"Unknown export format: {fmt}")
+    return buffer.getvalue()
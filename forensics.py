@@ -0,0 +1,172 @@
+"""
+Extracción forense para SpamSense AI
+Funciones sin dependencia de la UI: IP de origen, URLs, dominio del remitente y cadena Received
+"""
+
+import ipaddress
+import re
+from email.utils import parsedate_to_datetime
+
+import numpy as np
+import pandas as pd
+
+_RECEIVED_IP_RE = re.compile(r'Received: from .*? \[(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\]')
+_URL_RE = re.compile(r'https?://[^\s<>"]+|www\.[^\s<>"]+')
+_FROM_DOMAIN_RE = re.compile(r'From:.*@([a-zA-Z0-9.-]+\.[a-zA-Z]{2,})')
+
+
+def extract_forensics(raw_text):
+    """Extracts IP, URLs and Domain from remitter."""
+    # Origin IP from the parsed Received chain; fall back to the first bracketed IP
+    ip = origin_ip(parse_received_chain(raw_text.split("\n\n", 1)[0]))
+    if ip is None:
+        ip_match = _RECEIVED_IP_RE.search(raw_text)
+        ip = ip_match.group(1) if ip_match else None
+    urls = list(set(_URL_RE.findall(raw_text)))
+
+    domain = None
+    from_match = _FROM_DOMAIN_RE.search(raw_text)
+    if from_match:
+        domain = from_match.group(1)
+    return ip, urls, domain
+
+
+# ───────────────── RECEIVED CHAIN ─────────────────
+_RECEIVED_LINE_RE = re.compile(r'^Received:[ \t]*', flags=re.IGNORECASE)
+_HOP_FROM_RE = re.compile(r'\bfrom\s+([^\s;()\[\]]+)', flags=re.IGNORECASE)
+_HOP_BRACKET_IP_RE = re.compile(r'\[(?:IPv6:)?([0-9A-Fa-f:.]+)\]')
+_HOP_BARE_IP_RE = re.compile(r'\b(\d{1,3}(?:\.\d{1,3}){3})\b')
+
+IP_PUBLIC, IP_PRIVATE, IP_BOGON = 0, 1, 2
+
+# Non-routable space as integer [lo, hi] ranges, checked with one NumPy broadcast per batch
+_PRIVATE_NETS = ["10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16", "127.0.0.0/8",
+                 "169.254.0.0/16", "100.64.0.0/10"]
+_BOGON_NETS = ["0.0.0.0/8", "192.0.0.0/24", "192.0.2.0/24", "198.18.0.0/15",
+               "198.51.100.0/24", "203.0.113.0/24", "224.0.0.0/4", "240.0.0.0/4"]
+
+
+def _net_bounds(nets):
+    networks = [ipaddress.IPv4Network(n) for n in nets]
+    lo = np.array([int(n.network_address) for n in networks], dtype=np.uint32)
+    hi = np.array([int(n.broadcast_address) for n in networks], dtype=np.uint32)
+    return lo, hi
+
+
+_PRIVATE_LO, _PRIVATE_HI = _net_bounds(_PRIVATE_NETS)
+_BOGON_LO, _BOGON_HI = _net_bounds(_BOGON_NETS)
+
+
+def parse_received_chain(header):
+    """
+    Every Received hop of a header block, most recent first.
+    Folded continuation lines are joined; each hop is (ip, host, unix timestamp or None).
+    """
+    values, current = [], None
+    for line in header.split("\n"):
+        if current is not None and line[:1] in (" ", "\t"):
+            current.append(line.strip())
+            continue
+        if current is not None:
+            values.append(" ".join(current))
+            current = None
+        match = _RECEIVED_LINE_RE.match(line)
+        if match:
+            current = [line[match.end():].strip()]
+    if current is not None:
+        values.append(" ".join(current))
+
+    hops = []
+    for value in values:
+        clause, _, date_part = value.rpartition(";") if ";" in value else (value, "", "")
+        host_match = _HOP_FROM_RE.search(clause)
+        ip_match = _HOP_BRACKET_IP_RE.search(clause) or _HOP_BARE_IP_RE.search(clause)
+        timestamp = None
+        if date_part.strip():
+            try:
+                timestamp = parsedate_to_datetime(date_part.strip()).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                timestamp = None
+        hops.append((
+            ip_match.group(1) if ip_match else None,
+            host_match.group(1) if host_match else None,
+            timestamp
+        ))
+    return hops
+
+
+def classify_ips(ips):
+    """Vectorized IP_PUBLIC / IP_PRIVATE / IP_BOGON codes; -1 for missing or unparsable IPs."""
+    codes = np.full(len(ips), -1, dtype=np.int8)
+    v4_idx, v4_val = [], []
+    for i, ip in enumerate(ips):
+        if not ip:
+            continue
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            continue
+        if addr.version == 4:
+            v4_idx.append(i)
+            v4_val.append(int(addr))
+        else:
+            codes[i] = IP_PRIVATE if addr.is_private else IP_BOGON if addr.is_reserved else IP_PUBLIC
+    if v4_idx:
+        values = np.asarray(v4_val, dtype=np.uint32)[:, None]
+        private = ((values >= _PRIVATE_LO) & (values <= _PRIVATE_HI)).any(axis=1)
+        bogon = ((values >= _BOGON_LO) & (values <= _BOGON_HI)).any(axis=1)
+        codes[v4_idx] = np.where(private, IP_PRIVATE, np.where(bogon, IP_BOGON, IP_PUBLIC))
+    return codes
+
+
+ROUTING_COLUMNS = ["hop_count", "private_hops", "bogon_hops", "public_hops",
+                   "transit_delay_s", "max_hop_delay_s", "time_skew_s", "origin_ip_is_private"]
+
+
+def routing_features(headers):
+    """
+    Batch routing features for a list of header blocks, one row per header:
+    hop counts per IP class, end-to-end transit delay, slowest hop and the largest
+    backwards clock step between consecutive hops (time skew, a forgery hint).
+    """
+    email_idx, hop_ips, hop_times = [], [], []
+    for i, header in enumerate(headers):
+        for ip, _, timestamp in parse_received_chain(header):
+            email_idx.append(i)
+            hop_ips.append(ip)
+            hop_times.append(np.nan if timestamp is None else timestamp)
+
+    out = pd.DataFrame(0.0, index=range(len(headers)), columns=ROUTING_COLUMNS)
+    out[["transit_delay_s", "max_hop_delay_s"]] = np.nan
+    if not email_idx:
+        return out
+
+    email_idx = np.asarray(email_idx)
+    codes = classify_ips(hop_ips)
+    times = np.asarray(hop_times, dtype=np.float64)
+
+    out["hop_count"] = np.bincount(email_idx, minlength=len(headers))
+    for column, code in (("private_hops", IP_PRIVATE), ("bogon_hops", IP_BOGON), ("public_hops", IP_PUBLIC)):
+        out[column] = np.bincount(email_idx, weights=codes == code, minlength=len(headers))
+
+    # Hops are listed newest first: step = newer time - older time for consecutive hops of one email
+    same = email_idx[:-1] == email_idx[1:]
+    step = np.where(same, times[:-1] - times[1:], np.nan)
+    hops = pd.DataFrame({"email": email_idx[:-1], "step": step})
+    out["max_hop_delay_s"] = hops.groupby("email")["step"].max()
+    out["time_skew_s"] = (-hops["step"]).clip(lower=0).groupby(hops["email"]).max().reindex(out.index).fillna(0.0)
+
+    chain = pd.DataFrame({"email": email_idx, "t": times, "code": codes})
+    grouped = chain.groupby("email")
+    out["transit_delay_s"] = grouped["t"].max() - grouped["t"].min()
+    out["origin_ip_is_private"] = (grouped["code"].last() == IP_PRIVATE).astype(float)
+    return out.fillna({"origin_ip_is_private": 0.0})
+
+
+def origin_ip(hops):
+    """Most recent hop with a public IP: the first address outside the recipient's own network."""
+    ips = [ip for ip, _, _ in hops]
+    for ip, code in zip(ips, classify_ips(ips)):
+        if code == IP_PUBLIC:
+            return ip
+    return None
@@ -0,0 +1,378 @@
+"""
+Cola de trabajos por lotes para SpamSense AI
+Cola en SQLite y procesos worker que ejecutan los lotes fuera del script de Streamlit
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+
+DEFAULT_QUEUE_PATH = os.environ.get("SPAMSENSE_QUEUE_DB", "data/jobs.db")
+POLL_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 15  # seconds between heartbeats of a running job (from a background thread)
+STALE_AFTER = 300  # seconds without a heartbeat before a running job is handed to another worker
+INPUT_PAGE_SIZE = 64
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    current TEXT,
+    batch_id INTEGER,
+    reused INTEGER,
+    errors TEXT,
+    worker TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat REAL,
+    finished_at REAL,
+    profile INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at);
+CREATE TABLE IF NOT EXISTS job_inputs (
+    job_id INTEGER NOT NULL REFERENCES jobs(job_id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    content BLOB NOT NULL,
+    PRIMARY KEY (job_id, position)
+);
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+"""
+
+
+class JobQueue:
+    """
+    JobQueue Class:
+    1. Persists submitted batches (raw uploads included) so they outlive the Streamlit run.
+    2. Hands jobs to workers atomically, serving the owner with the fewest running jobs first.
+    3. Records progress and outcome so any UI process can poll a job by id.
+    """
+    def __init__(self, path=DEFAULT_QUEUE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.__lock = threading.Lock()
+        # Autocommit mode: claims open their own BEGIN IMMEDIATE transaction
+        self.__conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.__conn.row_factory = sqlite3.Row
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        self.__conn.executescript(_SCHEMA)
+        if "profile" not in {row[1] for row in self.__conn.execute("PRAGMA table_info(jobs)")}:
+            self.__conn.execute("ALTER TABLE jobs ADD COLUMN profile INTEGER NOT NULL DEFAULT 0")
+
+    # --- Producer side (UI) ---
+
+    def submit(self, owner, emails, profile=False):
+        """
+        emails: iterable of (name, raw bytes). Returns the job id.
+        profile: the worker records a profile of the run (see pipelineProfiler.profile_path).
+        """
+        with self.__lock:
+            self.__conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self.__conn.execute(
+                    "INSERT INTO jobs (owner, status, total, created_at, profile) VALUES (?, ?, 0, ?, ?)",
+                    (owner, QUEUED, time.time(), int(bool(profile)))
+                )
+                job_id = cur.lastrowid
+                total = 0
+                for position, (name, content) in enumerate(emails):
+                    self.__conn.execute(
+                        "INSERT INTO job_inputs VALUES (?, ?, ?, ?)", (job_id, position, name, content)
+                    )
+                    total += 1
+                self.__conn.execute("UPDATE jobs SET total = ? WHERE job_id = ?", (total, job_id))
+                self.__conn.execute("COMMIT")
+            except Exception:
+                self.__conn.execute("ROLLBACK")
+                raise
+        return job_id
+
+    def status(self, job_id):
+        """Job row as a dict (errors decoded), or None."""
+        with self.__lock:
+            row = self.__conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["errors"] = json.loads(job["errors"]) if job["errors"] else []
+        return job
+
+    def list_jobs(self, owner=None, limit=20):
+        query = "SELECT job_id, owner, status, total, done, batch_id, created_at FROM jobs"
+        params = ()
+        if owner is not None:
+            query += " WHERE owner = ?"
+            params = (owner,)
+        with self.__lock:
+            rows = self.__conn.execute(query + " ORDER BY job_id DESC LIMIT ?", params + (limit,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued job; a running job stops at its next progress update.
+        Returns False (and leaves the job alone) if it had already finished.
+        """
+        with self.__lock:
+            self.__conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self.__conn.execute(
+                    "UPDATE jobs SET status = ?, finished_at = ? WHERE job_id = ? AND status IN (?, ?)",
+                    (CANCELLED, time.time(), job_id, QUEUED, RUNNING)
+                )
+                if cur.rowcount == 1:
+                    self.__conn.execute("DELETE FROM job_inputs WHERE job_id = ?", (job_id,))
+                self.__conn.execute("COMMIT")
+            except Exception:
+                self.__conn.execute("ROLLBACK")
+                raise
+        return cur.rowcount == 1
+
+    def workers_alive(self, within=STALE_AFTER):
+        with self.__lock:
+            return self.__conn.execute(
+                "SELECT COUNT(*) FROM workers WHERE heartbeat > ?", (time.time() - within,)
+            ).fetchone()[0]
+
+    # --- Consumer side (workers) ---
+
+    def claim(self, worker_id):
+        """
+        Atomically moves the next job to running and returns its id, or None.
+        Fairness: owners with fewer running jobs go first, then the owner served least
+        recently, then submission order, so one large uploader cannot starve the others.
+        """
+        now = time.time()
+        with self.__lock:
+            self.__conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.__conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (worker_id, now))
+                # Jobs whose worker died are put back in the queue
+                self.__conn.execute(
+                    "UPDATE jobs SET status = ?, worker = NULL, done = 0 WHERE status = ? AND heartbeat < ?",
+                    (QUEUED, RUNNING, now - STALE_AFTER)
+                )
+                row = self.__conn.execute(
+                    "SELECT j.job_id FROM jobs j WHERE j.status = ? ORDER BY "
+                    "(SELECT COUNT(*) FROM jobs r WHERE r.owner = j.owner AND r.status = ?), "
+                    "COALESCE((SELECT MAX(s.started_at) FROM jobs s WHERE s.owner = j.owner), 0), "
+                    "j.created_at LIMIT 1",
+                    (QUEUED, RUNNING)
+                ).fetchone()
+                if row is not None:
+                    self.__conn.execute(
+                        "UPDATE jobs SET status = ?, worker = ?, started_at = ?, heartbeat = ? WHERE job_id = ?",
+                        (RUNNING, worker_id, now, now, row[0])
+                    )
+                self.__conn.execute("COMMIT")
+            except Exception:
+                self.__conn.execute("ROLLBACK")
+                raise
+        return row[0] if row is not None else None
+
+    def iter_inputs(self, job_id, page_size=INPUT_PAGE_SIZE):
+        """Yields (name, content) in upload order, reading one page at a time."""
+        position = -1
+        while True:
+            with self.__lock:
+                rows = self.__conn.execute(
+                    "SELECT position, name, content FROM job_inputs WHERE job_id = ? AND position > ? "
+                    "ORDER BY position LIMIT ?", (job_id, position, page_size)
+                ).fetchall()
+            if not rows:
+                return
+            for position, name, content in rows:
+                yield name, content
+
+    def progress(self, job_id, worker_id, done, current=None):
+        """
+        Records progress and heartbeats. Returns False if the job was cancelled or, after a
+        missed heartbeat, handed to another worker: either way this worker must stop.
+        """
+        with self.__lock:
+            cur = self.__conn.execute(
+                "UPDATE jobs SET done = ?, current = ?, heartbeat = ? WHERE job_id = ? AND status = ? AND worker = ?",
+                (done, current, time.time(), job_id, RUNNING, worker_id)
+            )
+        return cur.rowcount == 1
+
+    def heartbeat(self, worker_id, job_id=None):
+        """
+        Marks the worker alive and, with job_id, keeps that running job from being requeued.
+        Returns False if the job is no longer this worker's (cancelled, finished or reassigned).
+        """
+        now = time.time()
+        with self.__lock:
+            self.__conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (worker_id, now))
+            if job_id is None:
+                return True
+            cur = self.__conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE job_id = ? AND status = ? AND worker = ?",
+                (now, job_id, RUNNING, worker_id)
+            )
+        return cur.rowcount == 1
+
+    def complete(self, job_id, worker_id, batch_id, reused, errors):
+        """Returns False if the job is no longer this worker's (cancelled or reassigned)."""
+        return self.__finish(job_id, worker_id, DONE, batch_id=batch_id, reused=reused, errors=errors)
+
+    def fail(self, job_id, worker_id, error):
+        return self.__finish(job_id, worker_id, FAILED, errors=[["job", error]])
+
+    # --- Internal Utilities ---
+
+    def __finish(self, job_id, worker_id, status, batch_id=None, reused=None, errors=()):
+        with self.__lock:
+            self.__conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self.__conn.execute(
+                    "UPDATE jobs SET status = ?, batch_id = ?, reused = ?, errors = ?, finished_at = ?, done = "
+                    "CASE WHEN ? = 'done' THEN total ELSE done END WHERE job_id = ? AND status = ? AND worker = ?",
+                    (status, batch_id, reused, json.dumps([list(e) for e in errors]), time.time(),
+                     status, job_id, RUNNING, worker_id)
+                )
+                # Raw uploads are only needed until the job ends; a reassigned job still needs them
+                if cur.rowcount == 1:
+                    self.__conn.execute("DELETE FROM job_inputs WHERE job_id = ?", (job_id,))
+                self.__conn.execute("COMMIT")
+            except Exception:
+                self.__conn.execute("ROLLBACK")
+                raise
+        return cur.rowcount == 1
+
+
+class JobCancelled(Exception):
+    """The job was cancelled, or requeued to another worker, while this one was running it."""
+
+
+@contextlib.contextmanager
+def _keep_alive(queue, job_id, worker_id, interval=HEARTBEAT_INTERVAL):
+    """
+    Heartbeats a running job from a background thread for as long as the block runs, so a
+    chunk slower than STALE_AFTER (CPU embeddings, HTTP enrichment) does not get the job requeued.
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                if not queue.heartbeat(worker_id, job_id):
+                    return  # cancelled or reassigned: the next progress update stops the run
+            except sqlite3.Error:
+                continue  # a busy database only delays this beat
+
+    thread = threading.Thread(target=beat, name=f"spamsense-heartbeat-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def build_pipeline():
+    """BatchPipeline as the app configures it, for worker processes."""
+    from batchPipeline import BatchPipeline
+    from emailProcessor import EmailProcessor
+    from featureAttribution import FeatureAttributor
+    from modelAssets import load_models, model_version, EMBEDDING_MODEL, MODEL_PATH
+    from resultStore import ResultStore
+
+    spam_model, emb_model = load_models()
+    processor = EmailProcessor(emb_model).for_model(spam_model)
+    return BatchPipeline(processor, spam_model, ResultStore(), model_version(), EMBEDDING_MODEL,
+                         attributor=FeatureAttributor(spam_model, processor.columns), model_path=MODEL_PATH)
+
+
+def run_worker(queue_path=DEFAULT_QUEUE_PATH, poll_interval=POLL_INTERVAL, stop=None, pipeline=None):
+    """
+    Worker loop: claims and runs jobs until stopped. Models are loaded once per worker;
+    a retrained classifier is picked up between jobs (see BatchPipeline.reloaded).
+    """
+    queue = JobQueue(queue_path)
+    pipeline = pipeline or build_pipeline()
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    stop = stop or threading.Event()
+
+    while not stop.is_set():
+        pipeline = pipeline.reloaded()
+        job_id = queue.claim(worker_id)
+        if job_id is None:
+            stop.wait(poll_interval)
+            continue
+
+        def on_progress(done, total, name):
+            queue.heartbeat(worker_id)
+            if not queue.progress(job_id, worker_id, done, name):
+                raise JobCancelled()
+
+        job = queue.status(job_id)
+        profiler = None
+        if job["profile"]:
+            from pipelineProfiler import Profiler
+            profiler = Profiler(label=f"job {job_id}")
+        report = error = None
+        try:
+            with _keep_alive(queue, job_id, worker_id), profiler or contextlib.nullcontext():
+                report = pipeline.run(queue.iter_inputs(job_id), job["total"], on_progress)
+        except JobCancelled:
+            pass
+        except Exception as e:
+            error = str(e)
+        if profiler:
+            # Written before the job is finished, so a client that sees it done finds the profile;
+            # failed and cancelled runs keep theirs too: it shows where they spent the time
+            from pipelineProfiler import profile_path
+            profiler.report.save(profile_path(job_id))
+        if report is not None:
+            queue.complete(job_id, worker_id, report.batch_id, report.reused, report.errors)
+        elif error is not None:
+            queue.fail(job_id, worker_id, error)
+        queue.heartbeat(worker_id)
+
+
+def _worker_process(queue_path, poll_interval):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    run_worker(queue_path, poll_interval, stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run batch report workers.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes to start")
+    parser.add_argument("--queue", default=DEFAULT_QUEUE_PATH)
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        _worker_process(args.queue, args.poll_interval)
+        return
+    processes = [
+        multiprocessing.Process(target=_worker_process, args=(args.queue, args.poll_interval), daemon=False)
+        for _ in range(args.workers)
+    ]
+    for p in processes:
+        p.start()
+    signal.signal(signal.SIGTERM, lambda *_: [p.terminate() for p in processes])
+    for p in processes:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Análisis de enlaces para SpamSense AI
+Extrae URLs del cuerpo, resuelve dominios registrables con un trie de sufijos públicos y calcula features por lote
+"""
+
+import functools
+import hashlib
+import os
+import re
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from normalization import decode_parts
+
+PSL_PATH = os.environ.get("SPAMSENSE_PSL", "data/public_suffix_list.dat")
+BLOCKLIST_PATH = os.environ.get("SPAMSENSE_LINK_BLOCKLIST", "data/link_blocklist.txt")
+HOST_CACHE_SIZE = 50000
+
+LINK_COLUMNS = ["link_count", "distinct_link_domains", "offdomain_link_ratio",
+                "ip_links", "shortener_links", "blocklisted_links"]
+
+# Used when no public_suffix_list.dat is available: generic TLDs, the common country
+# second levels and the hosting suffixes phishing kits favour. Same syntax as the PSL.
+_BUILTIN_RULES = """
+com net org edu gov mil int info biz name pro mobi app dev io co me tv cc ws xyz top online site shop club
+live store tech icu vip work link click buzz fun space website email cloud page blog news
+uk co.uk org.uk me.uk ltd.uk plc.uk ac.uk gov.uk nhs.uk net.uk sch.uk
+au com.au net.au org.au edu.au gov.au jp co.jp ne.jp or.jp ac.jp go.jp
+br com.br net.br org.br gov.br cn com.cn net.cn org.cn gov.cn in co.in net.in org.in gov.in
+nz co.nz org.nz net.nz za co.za org.za mx com.mx org.mx ar com.ar tr com.tr net.tr org.tr
+es com.es org.es nom.es de fr it nl be ch at se no dk fi pl pt ie ru su ua kr co.kr or.kr
+hk com.hk sg com.sg tw com.tw eu us ca ly gl gd be to ai gg im ms sh
+*.ck !www.ck
+github.io gitlab.io blogspot.com appspot.com herokuapp.com netlify.app vercel.app pages.dev
+web.app firebaseapp.com azurewebsites.net cloudfront.net s3.amazonaws.com ngrok.io ngrok-free.app
+glitch.me repl.co workers.dev 000webhostapp.com weebly.com wixsite.com
+"""
+
+SHORTENERS = frozenset("""
+bit.ly bitly.com t.co goo.gl tinyurl.com ow.ly is.gd buff.ly rebrand.ly cutt.ly shorturl.at tiny.cc
+rb.gy t.ly bit.do lnkd.in s.id v.gd qr.ae adf.ly bl.ink shorte.st soo.gd clck.ru u.to x.co trib.al
+""".split())
+
+_END = None  # trie key marking a rule ("+") or an exception ("!") ending at that node
+# Both patterns start with a literal, so the regex engine scans for it at C speed;
+# a lookbehind or an alternation here makes extraction several times slower.
+_URL_HOST_RE = re.compile(r"""https?://(\[[0-9a-f:.]+\]|[^\s/?#<>"'\\]+)""")
+_WWW_HOST_RE = re.compile(r"""www\.[^\s/?#<>"'\\]+""")
+_HOST_CHARS = frozenset("/.@-_0123456789abcdefghijklmnopqrstuvwxyz")
+_IP_HOST_RE = re.compile(r"^(?:\d{1,3}(?:\.\d{1,3}){3}|0x[0-9a-f]{1,8}|\d{8,10}|\[[0-9a-f:.]+\])$")
+_HOST_TRAILING = ".,;:!)]}'\""
+
+
+def host_hash(name):
+    """64-bit hash of a host name, the key of the reputation list."""
+    return int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class SuffixTrie:
+    """
+    Public-suffix rules in a reversed-label trie (com -> co -> ...), built once.
+    Supports the PSL syntax: plain rules, wildcards (*.ck) and exceptions (!www.ck).
+    """
+    def __init__(self, rules):
+        self.__root = {}
+        for rule in rules:
+            exception = rule.startswith("!")
+            node = self.__root
+            for label in reversed(rule.lstrip("!").split(".")):
+                node = node.setdefault(label, {})
+            node[_END] = "!" if exception else "+"
+
+    @classmethod
+    def from_file(cls, path):
+        """Reads a public_suffix_list.dat (comments and blank lines skipped)."""
+        with open(path, encoding="utf-8") as fh:
+            return cls(line.split()[0].lower() for line in fh if line.strip() and not line.startswith("//"))
+
+    def suffix_labels(self, labels):
+        """Number of trailing labels forming the public suffix (the implicit "*" rule gives 1)."""
+        node, length = self.__root, 1
+        for depth, label in enumerate(reversed(labels), 1):
+            wildcard = node.get("*")
+            if wildcard is not None and wildcard.get(_END) == "+":
+                length = depth
+            child = node.get(label)
+            if child is None:
+                break
+            mark = child.get(_END)
+            if mark == "!":
+                return depth - 1
+            if mark == "+":
+                length = depth
+            node = child
+        return length
+
+    def registrable_domain(self, host):
+        """example.co.uk for www.mail.example.co.uk; None when the host is itself a public suffix."""
+        labels = host.split(".")
+        n = self.suffix_labels(labels)
+        return ".".join(labels[-(n + 1):]) if len(labels) > n else None
+
+
+def _load_blocklist(path):
+    """Hashes of the listed hosts/domains (one per line, # comments) as a set of 64-bit ints."""
+    if not path or not os.path.exists(path):
+        return frozenset()
+    with open(path, encoding="utf-8") as fh:
+        names = {line.split("#", 1)[0].strip().lower().rstrip(".") for line in fh}
+    return frozenset(host_hash(n) for n in names if n)
+
+
+class LinkAnalyzer:
+    """
+    LinkAnalyzer Class:
+    1. Extracts link hosts from the HTML or plain parts of each body with literal-prefix regexes.
+    2. Resolves registrable domains through the suffix trie and checks the reputation list,
+       once per distinct host (memoized), so repeated links cost a dict lookup.
+    3. Computes the LINK_COLUMNS features for a batch of emails.
+    """
+    def __init__(self, psl_path=PSL_PATH, blocklist_path=BLOCKLIST_PATH):
+        self.trie = SuffixTrie.from_file(psl_path) if psl_path and os.path.exists(psl_path) \
+            else SuffixTrie(_BUILTIN_RULES.split())
+        self.__blocked = _load_blocklist(blocklist_path)
+        self.__hosts = {}
+
+    def links(self, header, body):
+        """
+        Link hosts of one email, in order. HTML parts are scanned first and plain parts only
+        if the HTML has no links, so multipart/alternative copies are not counted twice.
+        """
+        plain, rich = decode_parts(header, body)
+        for parts in (rich, plain):
+            if parts:
+                hosts = self.__hosts_in("\n".join(parts).lower())
+                if hosts:
+                    return hosts
+        return []
+
+    def host_info(self, host):
+        """(registrable domain, or the host for IP literals; is IP literal; is shortener; is listed)."""
+        info = self.__hosts.get(host)
+        if info is None:
+            if len(self.__hosts) >= HOST_CACHE_SIZE:
+                self.__hosts.clear()
+            is_ip = bool(_IP_HOST_RE.match(host))
+            domain = host if is_ip else (self.trie.registrable_domain(host) or host)
+            # A link is listed if its host or its registrable domain is on the list
+            listed = bool(self.__blocked) and (host_hash(host) in self.__blocked or host_hash(domain) in self.__blocked)
+            info = (domain, is_ip, host in SHORTENERS or domain in SHORTENERS, listed)
+            self.__hosts[host] = info
+        return info
+
+    def registrable_domain(self, host):
+        return self.host_info(host.lower().rstrip("."))[0] if host else None
+
+    def features(self, messages, sender_domains):
+        """
+        messages: (header, body) pairs; sender_domains: From domain per email (or None).
+        Returns a float DataFrame with LINK_COLUMNS, one row per email.
+        """
+        out = np.zeros((len(messages), len(LINK_COLUMNS)))
+        for i, ((header, body), sender) in enumerate(zip(messages, sender_domains)):
+            hosts = self.links(header, body)
+            if not hosts:
+                continue
+            sender_domain = self.registrable_domain(sender)
+            domains, off, ips, short, listed = set(), 0, 0, 0, 0
+            for host, n in Counter(hosts).items():
+                domain, is_ip, is_short, is_listed = self.host_info(host)
+                domains.add(domain)
+                off += n * (domain != sender_domain)
+                ips += n * is_ip
+                short += n * is_short
+                listed += n * is_listed
+            out[i] = (len(hosts), len(domains), off / len(hosts), ips, short, listed)
+        return pd.DataFrame(out, columns=LINK_COLUMNS)
+
+    # --- Internal Utilities ---
+
+    def __hosts_in(self, text):
+        authorities = _URL_HOST_RE.findall(text)
+        if "www." in text:
+            # Bare www.<host> links, skipping the ones already inside an http(s) URL
+            authorities += [m.group() for m in _WWW_HOST_RE.finditer(text)
+                            if m.start() == 0 or text[m.start() - 1] not in _HOST_CHARS]
+        return [self.__clean(a) for a in authorities]
+
+    @staticmethod
+    def __clean(authority):
+        """Host of a (lowercased) URL authority: userinfo, port and trailing punctuation removed."""
+        host = authority.rpartition("@")[2]
+        if not host.startswith("["):
+            host = host.split(":", 1)[0]
+        return host.rstrip(_HOST_TRAILING)
+
+
+@functools.lru_cache(maxsize=1)
+def default_link_analyzer():
+    """Process-wide analyzer: the suffix list and reputation list are loaded once."""
+    return LinkAnalyzer()
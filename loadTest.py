@@ -0,0 +1,403 @@
+"""
+Pruebas de carga para SpamSense AI
+Simula usuarios concurrentes en los flujos de email individual y por lotes y mide latencia, CPU y memoria
+"""
+
+import argparse
+import base64
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_MIX = "plain:0.6,html:0.3,mime:0.1"
+SAMPLE_INTERVAL = 0.5
+PERCENTILES = (50, 90, 99)
+
+_HAM_WORDS = ("meeting agenda attached project update quarterly review please find notes team schedule "
+              "invoice lunch thanks regards tomorrow deadline draft budget report call").split()
+_SPAM_WORDS = ("winner claim prize free offer limited urgent account verify password click bonus "
+               "bitcoin investment guaranteed discount act now exclusive unsubscribe lottery").split()
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+# --- Corpus ---
+
+def parse_mix(spec):
+    """"plain:0.6,html:0.3,mime:0.1" -> {kind: weight}, normalized to sum 1."""
+    mix = {}
+    for item in spec.split(","):
+        kind, _, weight = item.partition(":")
+        if kind not in ("plain", "html", "mime"):
+            raise ValueError(f"Unknown corpus kind: {kind}")
+        mix[kind] = float(weight or 1)
+    total = sum(mix.values())
+    return {kind: weight / total for kind, weight in mix.items()}
+
+
+def synthetic_email(rng, kind, index):
+    """One raw email of the given kind (plain text, HTML, or base64 multipart MIME)."""
+    spam = rng.random() < 0.5
+    words = _SPAM_WORDS if spam else _HAM_WORDS
+    domain = f"{rng.choice(['mail', 'news', 'promo', 'corp'])}{rng.randrange(500)}.{rng.choice(['com', 'net', 'co.uk', 'biz'])}"
+    ip = f"{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+    subject = " ".join(rng.choices(words, k=rng.randrange(2, 8))).capitalize()
+    text = " ".join(rng.choices(words, k=rng.randrange(40, 400)))
+    url = f"http://{domain}/{rng.choice(words)}?id={rng.randrange(10 ** 6)}"
+    header = (f"Received: from relay.{domain} (relay.{domain} [{ip}]) by mx.example.org; "
+              f"Mon, 6 Jan 2025 10:{index % 60:02d}:00 +0000\n"
+              f"From: {rng.choice(words)}@{domain}\nTo: user@example.org\n"
+              f"Subject: {subject}\nMessage-ID: <{index}.{rng.randrange(10 ** 9)}@{domain}>\n"
+              f"Date: Mon, 6 Jan 2025 10:{index % 60:02d}:00 +0000\n")
+    if kind == "plain":
+        return header + "\n" + f"{text}\n{url}\n"
+    if kind == "html":
+        return (header + "Content-Type: text/html; charset=utf-8\n\n"
+                f"<html><head><style>p {{color: #333}}</style></head><body><p>{text}</p>"
+                f"<a href=\"{url}\">{rng.choice(words)}</a>\u200b</body></html>\n")
+    encoded = base64.encodebytes(f"{text}\n{url}\n".encode("utf-8")).decode("ascii")
+    return (header + "MIME-Version: 1.0\nContent-Type: multipart/alternative; boundary=\"b1\"\n\n"
+            "--b1\nContent-Type: text/plain; charset=utf-8\nContent-Transfer-Encoding: base64\n\n"
+            f"{encoded}\n--b1\nContent-Type: text/html; charset=utf-8\n\n<p>{text}</p>\n--b1--\n")
+
+
+def synthetic_corpus(size, mix=DEFAULT_MIX, seed=42):
+    """(name, raw) pairs drawn with the requested mix of body kinds."""
+    rng = random.Random(seed)
+    weights = parse_mix(mix)
+    kinds = rng.choices(list(weights), weights=list(weights.values()), k=size)
+    return [(f"{kind}_{i:05d}.eml", synthetic_email(rng, kind, i)) for i, kind in enumerate(kinds)]
+
+
+def load_corpus(directory):
+    """(name, raw) pairs for every .eml / .txt file in a directory."""
+    from batchPipeline import decode_email
+    emails = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith((".eml", ".txt")):
+            with open(os.path.join(directory, name), "rb") as fh:
+                emails.append((name, decode_email(fh.read())))
+    return emails
+
+
+class CorpusFeed:
+    """
+    Thread-safe round robin over the corpus. Unless repeat is set, every pass after the
+    first salts the bodies, so embedding caches do not turn the test into a lookup benchmark.
+    """
+    def __init__(self, emails, repeat=False):
+        self.__emails = emails
+        self.__repeat = repeat
+        self.__counter = itertools.count()
+        self.__lock = threading.Lock()
+
+    def next(self, n=1):
+        with self.__lock:
+            positions = [next(self.__counter) for _ in range(n)]
+        out = []
+        for position in positions:
+            rounds, index = divmod(position, len(self.__emails))
+            name, raw = self.__emails[index]
+            if rounds and not self.__repeat:
+                name, raw = f"r{rounds}_{name}", f"{raw}\nref {rounds}-{index}\n"
+            out.append((name, raw))
+        return out
+
+
+# --- Resource sampling ---
+
+def _rss_bytes():
+    """Current resident set size; peak RSS where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ResourceSampler(threading.Thread):
+    """Background thread recording process CPU % (all threads) and RSS at a fixed interval."""
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.stage = None
+        self.completed = 0
+        self.__stop = threading.Event()
+        self.__start = time.perf_counter()
+
+    def run(self):
+        wall, cpu = time.perf_counter(), self.__cpu()
+        while not self.__stop.wait(self.interval):
+            now, used = time.perf_counter(), self.__cpu()
+            self.samples.append({
+                "t": round(now - self.__start, 3),
+                "stage": self.stage,
+                "cpu_percent": round(100.0 * (used - cpu) / max(now - wall, 1e-9), 1),
+                "rss_mb": round(_rss_bytes() / 2 ** 20, 1),
+                "completed": self.completed
+            })
+            wall, cpu = now, used
+
+    def stop(self):
+        self.__stop.set()
+        self.join()
+
+    def stage_samples(self, stage):
+        return [s for s in self.samples if s["stage"] == stage]
+
+    @staticmethod
+    def __cpu():
+        times = os.times()
+        return times.user + times.system
+
+
+# --- Targets ---
+
+class ScoringTarget:
+    """
+    ScoringTarget Class:
+    1. Loads the models, processor, attributor and stub enrichment once, as the app caches them.
+    2. single(): the single-email tab (features, prediction, forensics, links, geo/RDAP, attributions).
+    3. batch(): the batch tab (job submitted to the queue, inline workers, stored report, forensics).
+    """
+    def __init__(self, workdir, workers=1, stub_latency_ms=None):
+        from batchPipeline import BatchPipeline
+        from emailProcessor import EmailProcessor
+        from enrichment import StubEnrichment, STUB_LATENCY_MS
+        from featureAttribution import FeatureAttributor
+        from jobQueue import JobQueue, run_worker
+        from modelAssets import load_models, model_version, EMBEDDING_MODEL
+        from resultStore import ResultStore
+        from senderReputation import ReputationIndex
+
+        started = time.perf_counter()
+        self.spam_model, emb_model = load_models()
+        self.load_seconds = time.perf_counter() - started
+        self.processor = EmailProcessor(emb_model).for_model(self.spam_model)
+        self.attributor = FeatureAttributor(self.spam_model, self.processor.columns)
+        self.enrichment = StubEnrichment(STUB_LATENCY_MS if stub_latency_ms is None else stub_latency_ms)
+        self.store = ResultStore(os.path.join(workdir, "results.db"))
+        self.queue = JobQueue(os.path.join(workdir, "jobs.db"))
+        pipeline = BatchPipeline(self.processor, self.spam_model, self.store, model_version(), EMBEDDING_MODEL,
+                                 attributor=self.attributor,
+                                 reputation=ReputationIndex(os.path.join(workdir, "reputation.db")))
+        self.__stop = threading.Event()
+        self.__workers = [
+            threading.Thread(target=run_worker, daemon=True,
+                             kwargs={"queue_path": self.queue.path, "poll_interval": 0.05,
+                                     "stop": self.__stop, "pipeline": pipeline})
+            for _ in range(workers)
+        ]
+        for t in self.__workers:
+            t.start()
+
+    def single(self, emails):
+        # The app's own analysis (analyze_single), minus the result cache and rendering
+        from analysis import analyze_email
+        from resultCache import normalize_raw
+        for _, raw in emails:
+            analyze_email(normalize_raw(raw), self.processor, self.spam_model, self.enrichment, self.attributor)
+        return len(emails)
+
+    def batch(self, emails, owner="loadtest", poll_interval=0.05):
+        from jobQueue import DONE, FAILED, CANCELLED
+        job_id = self.queue.submit(owner, ((name, raw.encode("utf-8")) for name, raw in emails))
+        while True:
+            job = self.queue.status(job_id)
+            if job["status"] in (DONE, FAILED, CANCELLED):
+                break
+            time.sleep(poll_interval)
+        if job["status"] != DONE:
+            raise RuntimeError(f"Job {job_id} {job['status']}: {job['errors']}")
+        results, _ = self.store.load_batch(job["batch_id"])
+        self.__enrich(results["ip"].dropna().unique(), results["domain"].dropna().unique())
+        return len(emails)
+
+    def close(self):
+        self.__stop.set()
+        for t in self.__workers:
+            t.join()
+
+    def __enrich(self, ips, domains):
+        for ip in ips:
+            self.enrichment.geo(ip)
+        for domain in domains:
+            if domain:
+                self.enrichment.domain_registration(domain)
+
+
+class AppTarget:
+    """Single-email tab driven through the Streamlit script itself (script reruns and rendering included)."""
+    def __init__(self, script="streamlit_app.py", timeout=120):
+        from streamlit.testing.v1 import AppTest
+        self.__app_test = AppTest
+        self.script = os.path.abspath(script)
+        self.timeout = timeout
+        started = time.perf_counter()
+        self.__session().run()  # first run loads the cached models
+        self.load_seconds = time.perf_counter() - started
+
+    def single(self, emails):
+        for _, raw in emails:
+            at = self.__session().run()
+            at.text_area[0].input(raw).run()
+            at.button[0].click().run()
+            if at.exception or at.error:
+                raise RuntimeError(str(at.exception or at.error[0].value))
+        return len(emails)
+
+    def close(self):
+        pass
+
+    def __session(self):
+        return self.__app_test.from_file(self.script, default_timeout=self.timeout)
+
+
+# --- Runner ---
+
+def run_stage(call, feed, users, batch_size=1, duration=None, requests=None, sampler=None):
+    """
+    Runs `users` virtual users, each calling call(emails) back to back until the duration
+    elapses or the request budget is spent. Returns one row per request.
+    """
+    if requests is None and not duration:
+        raise ValueError("run_stage needs a duration or a request budget")
+    if requests == 0:
+        return [], 0.0
+    deadline = time.perf_counter() + duration if duration else None
+    budget = itertools.count() if requests is not None else None
+    rows, lock = [], threading.Lock()
+
+    def user(user_id):
+        while True:
+            if deadline and time.perf_counter() >= deadline:
+                return
+            if budget is not None and next(budget) >= requests:
+                return
+            emails = feed.next(batch_size)
+            started = time.perf_counter()
+            error = None
+            try:
+                call(emails)
+            except Exception as e:
+                error = str(e)
+            with lock:
+                rows.append({"user": user_id, "started": started, "latency": time.perf_counter() - started,
+                             "emails": len(emails), "error": error})
+                if sampler:
+                    sampler.completed += len(emails)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        list(pool.map(user, range(users)))
+    return rows, time.perf_counter() - started
+
+
+def summarize(flow, users, rows, elapsed, samples=()):
+    """Throughput, latency percentiles and resource peaks of one stage."""
+    ok = [r for r in rows if r["error"] is None]
+    latencies = np.array([r["latency"] for r in ok]) * 1000 if ok else np.zeros(1)
+    summary = {
+        "flow": flow,
+        "users": users,
+        "requests": len(rows),
+        "errors": len(rows) - len(ok),
+        "seconds": round(elapsed, 2),
+        "req_per_s": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "emails_per_s": round(sum(r["emails"] for r in ok) / elapsed, 2) if elapsed else 0.0,
+        **{f"p{p}_ms": round(float(np.percentile(latencies, p)), 1) for p in PERCENTILES},
+        "max_ms": round(float(latencies.max()), 1),
+        "cpu_mean_percent": round(float(np.mean([s["cpu_percent"] for s in samples])), 1) if samples else None,
+        "rss_peak_mb": max((s["rss_mb"] for s in samples), default=None)
+    }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the SpamSense scoring paths.")
+    parser.add_argument("--flows", default="single,batch", help="Comma list of single, batch, app")
+    parser.add_argument("--users", default="1,2,4", help="Concurrency levels to sweep")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds per stage")
+    parser.add_argument("--requests", type=int, help="Requests per stage (instead of --duration)")
+    parser.add_argument("--batch-size", type=int, default=20, help="Emails per batch request")
+    parser.add_argument("--workers", type=int, default=1, help="Inline batch workers")
+    parser.add_argument("--corpus", help="Directory of .eml/.txt files (default: synthetic corpus)")
+    parser.add_argument("--corpus-size", type=int, default=500)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Synthetic corpus mix, e.g. plain:0.6,html:0.3,mime:0.1")
+    parser.add_argument("--repeat", action="store_true", help="Replay emails verbatim (warm embedding cache)")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed requests per flow")
+    parser.add_argument("--stub-latency-ms", type=float, help="Simulated geo/RDAP round trip")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="Prefix for <out>_summary.csv and <out>_timeline.csv")
+    args = parser.parse_args()
+
+    flows = [f.strip() for f in args.flows.split(",") if f.strip()]
+    levels = [int(u) for u in args.users.split(",")]
+    workdir = tempfile.mkdtemp(prefix="spamsense_load_")
+    # Before any app module is imported: the app reads these at import time
+    os.environ.update({"SPAMSENSE_ENRICHMENT": "stub", "SPAMSENSE_INLINE_WORKERS": "0",
+                       "SPAMSENSE_DB": os.path.join(workdir, "app_results.db"),
+                       "SPAMSENSE_QUEUE_DB": os.path.join(workdir, "app_jobs.db"),
+                       "SPAMSENSE_REPUTATION_DB": os.path.join(workdir, "app_reputation.db")})
+    if args.stub_latency_ms is not None:
+        os.environ["SPAMSENSE_STUB_LATENCY_MS"] = str(args.stub_latency_ms)
+
+    emails = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.corpus_size, args.mix, args.seed)
+    if not emails:
+        raise SystemExit("Empty corpus.")
+    feed = CorpusFeed(emails, repeat=args.repeat)
+    print(f"Corpus: {len(emails)} emails ({args.corpus or args.mix}), {os.cpu_count()} CPUs, workdir {workdir}")
+
+    sampler = ResourceSampler()
+    sampler.stage = "load"
+    sampler.start()
+    targets, summaries = {}, []
+    try:
+        if {"single", "batch"} & set(flows):
+            targets["scoring"] = ScoringTarget(workdir, args.workers, args.stub_latency_ms)
+            print(f"Models loaded in {targets['scoring'].load_seconds:.1f}s")
+        if "app" in flows:
+            targets["app"] = AppTarget()
+            print(f"App first run in {targets['app'].load_seconds:.1f}s")
+
+        for flow in flows:
+            target = targets["app" if flow == "app" else "scoring"]
+            call = target.batch if flow == "batch" else target.single
+            batch_size = args.batch_size if flow == "batch" else 1
+            sampler.stage = f"{flow}:warmup"
+            run_stage(call, feed, 1, batch_size, requests=args.warmup)
+            for users in levels:
+                stage = f"{flow}:{users}"
+                sampler.stage = stage
+                rows, elapsed = run_stage(call, feed, users, batch_size,
+                                          None if args.requests else args.duration, args.requests, sampler)
+                summary = summarize(flow, users, rows, elapsed, sampler.stage_samples(stage))
+                summaries.append(summary)
+                print(f"{stage:<10} {summary['req_per_s']:>8.2f} req/s  p50 {summary['p50_ms']:.0f} ms  "
+                      f"p99 {summary['p99_ms']:.0f} ms  errors {summary['errors']}")
+                failures = [r["error"] for r in rows if r["error"]]
+                if failures:
+                    print(f"  first error: {failures[0]}")
+    finally:
+        sampler.stop()
+        for target in targets.values():
+            target.close()
+
+    print()
+    print(pd.DataFrame(summaries).to_string(index=False))
+    if args.out:
+        pd.DataFrame(summaries).to_csv(f"{args.out}_summary.csv", index=False)
+        pd.DataFrame(sampler.samples).to_csv(f"{args.out}_timeline.csv", index=False)
+        print(f"Written {args.out}_summary.csv and {args.out}_timeline.csv")
+
+
+if __name__ == "__main__":
+    main()
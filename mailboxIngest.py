@@ -0,0 +1,388 @@
+"""
+Ingesta continua de buzones IMAP para SpamSense AI
+Sondea carpetas IMAP con asyncio, clasifica solo el correo nuevo y marca el resultado con flags
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import ssl
+import sys
+
+from batchPipeline import BatchPipeline
+
+DEFAULT_STATE_PATH = os.environ.get("SPAMSENSE_IMAP_STATE", "data/imap_state.json")
+SPAM_FLAG = "$Junk"
+HAM_FLAG = "$NotJunk"
+FETCH_WINDOW = 32  # commands in flight per connection
+MAX_ATTEMPTS = 3  # polls that may fail to classify a message before it is left unflagged
+
+_LITERAL_RE = re.compile(rb"\{(\d+)\}\r\n$")
+_TAGGED_RE = re.compile(rb"^(A\d+) (OK|NO|BAD)\b(.*)")
+_UID_RE = re.compile(rb"\bUID (\d+)")
+_UIDVALIDITY_RE = re.compile(rb"\[UIDVALIDITY (\d+)\]")
+
+
+class ImapError(Exception):
+    pass
+
+
+def _quote(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class AsyncImapClient:
+    """
+    Minimal asyncio IMAP4rev1 client.
+    Commands can be pipelined: several tagged commands are written before any
+    response is read, and untagged FETCH replies are matched back by UID.
+    """
+    def __init__(self, host, port=993, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.__reader = None
+        self.__writer = None
+        self.__tag = 0
+
+    async def connect(self):
+        context = ssl.create_default_context() if self.use_ssl else None
+        self.__reader, self.__writer = await asyncio.open_connection(self.host, self.port, ssl=context)
+        greeting = await self.__reader.readline()
+        if not greeting.startswith(b"* OK"):
+            raise ImapError(f"Unexpected greeting: {greeting!r}")
+
+    async def login(self, user, password):
+        await self.__command(f"LOGIN {_quote(user)} {_quote(password)}")
+
+    async def select(self, folder):
+        """Selects a folder and returns its UIDVALIDITY."""
+        untagged = await self.__command(f"SELECT {_quote(folder)}")
+        for text, _ in untagged:
+            match = _UIDVALIDITY_RE.search(text)
+            if match:
+                return int(match.group(1))
+        return 0
+
+    async def uids_after(self, last_uid):
+        """UIDs strictly greater than last_uid (n:* may echo the highest UID, so filter)."""
+        untagged = await self.__command(f"UID SEARCH UID {last_uid + 1}:*")
+        uids = []
+        for text, _ in untagged:
+            if text.startswith(b"* SEARCH"):
+                uids += [int(u) for u in text.split()[2:]]
+        return sorted(u for u in uids if u > last_uid)
+
+    async def fetch(self, uids, window=FETCH_WINDOW):
+        """Raw RFC 822 bytes per UID, fetched with up to `window` pipelined commands."""
+        messages = {}
+        for start in range(0, len(uids), window):
+            group = uids[start:start + window]
+            untagged = await self.__pipeline([f"UID FETCH {uid} (UID BODY.PEEK[])" for uid in group])
+            for text, literals in untagged:
+                uid_match = _UID_RE.search(text)
+                if uid_match and literals:
+                    messages[int(uid_match.group(1))] = literals[0]
+        return messages
+
+    async def add_flags(self, flags_by_uid, window=FETCH_WINDOW):
+        items = list(flags_by_uid.items())
+        for start in range(0, len(items), window):
+            await self.__pipeline([
+                f"UID STORE {uid} +FLAGS.SILENT ({' '.join(flags)})" for uid, flags in items[start:start + window]
+            ])
+
+    async def logout(self):
+        try:
+            await self.__command("LOGOUT")
+        finally:
+            self.__writer.close()
+
+    # --- Internal Utilities ---
+
+    async def __command(self, command):
+        return await self.__pipeline([command])
+
+    async def __pipeline(self, commands):
+        tags = []
+        for command in commands:
+            self.__tag += 1
+            tag = f"A{self.__tag:04d}"
+            tags.append(tag.encode())
+            self.__writer.write(f"{tag} {command}\r\n".encode())
+        await self.__writer.drain()
+
+        pending, untagged, failure = set(tags), [], None
+        while pending:
+            text, literals = await self.__read_response()
+            tagged = _TAGGED_RE.match(text)
+            if tagged and tagged.group(1) in pending:
+                pending.discard(tagged.group(1))
+                if tagged.group(2) != b"OK" and failure is None:
+                    failure = text.decode(errors="replace").strip()
+            else:
+                untagged.append((text, literals))
+        if failure:
+            raise ImapError(failure)
+        return untagged
+
+    async def __read_response(self):
+        """One response line (continued across literals) as (text, [literal bytes])."""
+        text, literals = b"", []
+        while True:
+            line = await self.__reader.readline()
+            if not line:
+                raise ImapError("Connection closed by server")
+            text += line
+            literal = _LITERAL_RE.search(line)
+            if not literal:
+                return text, literals
+            literals.append(await self.__reader.readexactly(int(literal.group(1))))
+
+
+class UidState:
+    """
+    Last processed UID per account/folder, reset when the server changes UIDVALIDITY.
+    Messages that failed to classify are kept in a retry set, so the checkpoint can move
+    past them without losing them.
+    """
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        self.path = path
+        self.__state = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fh:
+                self.__state = json.load(fh)
+
+    def last_uid(self, account, folder, uidvalidity):
+        entry = self.__state.get(f"{account}/{folder}")
+        if not entry or entry["uidvalidity"] != uidvalidity:
+            return 0
+        return entry["last_uid"]
+
+    def retry_uids(self, account, folder, uidvalidity):
+        """UIDs below the checkpoint still waiting for a successful classification."""
+        entry = self.__state.get(f"{account}/{folder}")
+        if not entry or entry["uidvalidity"] != uidvalidity:
+            return []
+        return sorted(int(uid) for uid in entry.get("retry", {}))
+
+    def advance(self, account, folder, uidvalidity, processed, failed=()):
+        """
+        Records a classified group: the checkpoint moves to its highest UID, failed UIDs
+        join the retry set (dropped after MAX_ATTEMPTS) and the others leave it.
+        """
+        entry = self.__state.get(f"{account}/{folder}")
+        if not entry or entry["uidvalidity"] != uidvalidity:
+            entry = {"uidvalidity": uidvalidity, "last_uid": 0}
+        retry = dict(entry.get("retry", {}))
+        failed = set(failed)
+        for uid in processed:
+            if uid in failed and retry.get(str(uid), 0) + 1 < MAX_ATTEMPTS:
+                retry[str(uid)] = retry.get(str(uid), 0) + 1
+            else:
+                retry.pop(str(uid), None)
+        self.__state[f"{account}/{folder}"] = {"uidvalidity": uidvalidity,
+                                               "last_uid": max(entry["last_uid"], *processed), "retry": retry}
+        self.__save()
+
+    # --- Internal Utilities ---
+
+    def __save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as fh:
+            json.dump(self.__state, fh, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class MailboxPoller:
+    """
+    MailboxPoller Class:
+    1. Polls each folder over its own connection, fetching only UIDs newer than the saved state.
+    2. Classifies new mail in batches through BatchPipeline (EmailProcessor + classifier + store).
+    3. Writes the verdict back as IMAP keywords ($Junk / $NotJunk by default).
+    """
+    def __init__(self, pipeline, host, user, password, folders=("INBOX",), port=993, use_ssl=True,
+                 state=None, spam_flag=SPAM_FLAG, ham_flag=HAM_FLAG, batch_size=256):
+        self.pipeline = pipeline
+        self.host, self.port, self.use_ssl = host, port, use_ssl
+        self.user, self.password = user, password
+        self.folders = list(folders)
+        self.state = state or UidState()
+        self.flags = {"SPAM": spam_flag, "HAM": ham_flag}
+        self.batch_size = batch_size
+        self.__classify_lock = asyncio.Lock()
+
+    async def poll_once(self):
+        """One pass over every folder; returns {folder: number of messages classified}."""
+        self.pipeline = self.pipeline.reloaded()  # retrained classifier, between passes only
+        counts = await asyncio.gather(*(self.__poll_folder(folder) for folder in self.folders))
+        return dict(zip(self.folders, counts))
+
+    async def run_forever(self, interval=60, on_cycle=None, on_error=None):
+        while True:
+            try:
+                counts = await self.poll_once()
+                if on_cycle:
+                    on_cycle(counts)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # A dropped connection, rejected command or pipeline error only skips this cycle
+                if on_error:
+                    on_error(e)
+            await asyncio.sleep(interval)
+
+    # --- Internal Utilities ---
+
+    async def __poll_folder(self, folder):
+        client = AsyncImapClient(self.host, self.port, self.use_ssl)
+        await client.connect()
+        try:
+            await client.login(self.user, self.password)
+            uidvalidity = await client.select(folder)
+            # Earlier failures first, then the new mail
+            uids = self.state.retry_uids(self.user, folder, uidvalidity) + \
+                await client.uids_after(self.state.last_uid(self.user, folder, uidvalidity))
+            total = 0
+            for start in range(0, len(uids), self.batch_size):
+                group = uids[start:start + self.batch_size]
+                messages = await client.fetch(group)
+                labels = await self.__classify(folder, messages)
+                await client.add_flags({uid: [self.flags[label]] for uid, label in labels.items()})
+                # Fetched but not classified: retried on the next polls. Not fetched: expunged meanwhile
+                self.state.advance(self.user, folder, uidvalidity, group, failed=set(messages) - set(labels))
+                total += len(labels)
+            return total
+        finally:
+            await client.logout()
+
+    async def __classify(self, folder, messages):
+        """Runs the (CPU-bound) pipeline in a worker thread so other folders keep fetching."""
+        if not messages:
+            return {}
+        emails = [(f"{folder}:{uid}", raw) for uid, raw in messages.items()]
+        async with self.__classify_lock:
+            # Tagged so the app's Report History does not fill up with one batch per poll
+            report = await asyncio.to_thread(self.pipeline.run, emails, len(emails), source="imap")
+        return {int(name.rsplit(":", 1)[1]): label for name, label in zip(report.results["name"], report.results["label"])}
+
+
+# ───────────────── LOCAL IMAP STAND-IN ─────────────────
+class LocalImapServer:
+    """
+    In-process IMAP stand-in for tests and demos.
+    Implements just what the poller uses: LOGIN, SELECT, UID SEARCH/FETCH/STORE, NOOP, LOGOUT.
+    """
+    def __init__(self, mailboxes=None, user="user", password="pass", uidvalidity=1):
+        self.mailboxes = {name: dict(msgs) for name, msgs in (mailboxes or {"INBOX": {}}).items()}
+        self.flags = {name: {} for name in self.mailboxes}
+        self.user, self.password, self.uidvalidity = user, password, uidvalidity
+        self.__server = None
+
+    def add_message(self, folder, raw):
+        box = self.mailboxes.setdefault(folder, {})
+        self.flags.setdefault(folder, {})
+        uid = max(box, default=0) + 1
+        box[uid] = raw if isinstance(raw, bytes) else raw.encode()
+        return uid
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.__server = await asyncio.start_server(self.__handle, host, port)
+        return self.__server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.__server.close()
+        await self.__server.wait_closed()
+
+    async def __handle(self, reader, writer):
+        writer.write(b"* OK LocalImapServer ready\r\n")
+        selected = None
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            tag, _, rest = line.decode().strip().partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            if command == "UID":
+                command, _, args = args.partition(" ")
+                command = "UID " + command.upper()
+
+            if command == "LOGIN":
+                user, password = re.findall(r'"((?:[^"\\]|\\.)*)"', args)
+                ok = user == self.user and password == self.password
+                writer.write(f"{tag} {'OK' if ok else 'NO'} LOGIN\r\n".encode())
+            elif command == "SELECT":
+                selected = args.strip('"')
+                if selected not in self.mailboxes:
+                    writer.write(f"{tag} NO no such mailbox\r\n".encode())
+                    selected = None
+                else:
+                    writer.write(f"* {len(self.mailboxes[selected])} EXISTS\r\n".encode())
+                    writer.write(f"* OK [UIDVALIDITY {self.uidvalidity}] UIDs valid\r\n".encode())
+                    writer.write(f"{tag} OK [READ-WRITE] SELECT\r\n".encode())
+            elif command == "UID SEARCH" and selected:
+                low = int(args.split()[1].split(":")[0])
+                uids = sorted(self.mailboxes[selected])
+                hits = [u for u in uids if u >= low] or uids[-1:]
+                writer.write(("* SEARCH " + " ".join(map(str, hits))).rstrip().encode() + b"\r\n")
+                writer.write(f"{tag} OK SEARCH\r\n".encode())
+            elif command == "UID FETCH" and selected:
+                uid = int(args.split()[0])
+                raw = self.mailboxes[selected].get(uid)
+                if raw is not None:
+                    seq = sorted(self.mailboxes[selected]).index(uid) + 1
+                    writer.write(f"* {seq} FETCH (UID {uid} BODY[] {{{len(raw)}}}\r\n".encode() + raw + b")\r\n")
+                writer.write(f"{tag} OK FETCH\r\n".encode())
+            elif command == "UID STORE" and selected:
+                uid, _, flag_part = args.partition(" ")
+                flags = re.search(r"\((.*)\)", flag_part).group(1).split()
+                self.flags[selected].setdefault(int(uid), set()).update(flags)
+                writer.write(f"{tag} OK STORE\r\n".encode())
+            elif command == "NOOP":
+                writer.write(f"{tag} OK NOOP\r\n".encode())
+            elif command == "LOGOUT":
+                writer.write(f"* BYE\r\n{tag} OK LOGOUT\r\n".encode())
+                await writer.drain()
+                break
+            else:
+                writer.write(f"{tag} BAD unsupported\r\n".encode())
+            await writer.drain()
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Continuously classify new IMAP mail.")
+    parser.add_argument("--host", required=True)
+    parser.add_argument("--port", type=int, default=993)
+    parser.add_argument("--no-ssl", action="store_true")
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--password-env", default="SPAMSENSE_IMAP_PASSWORD",
+                        help="Environment variable holding the password")
+    parser.add_argument("--folders", nargs="+", default=["INBOX"])
+    parser.add_argument("--interval", type=int, default=60, help="Seconds between polls")
+    parser.add_argument("--once", action="store_true", help="Poll once and exit")
+    args = parser.parse_args()
+
+    from emailProcessor import EmailProcessor
+    from modelAssets import load_models, model_version, EMBEDDING_MODEL, MODEL_PATH
+    from resultStore import ResultStore
+
+    spam_model, emb_model = load_models()
+    pipeline = BatchPipeline(EmailProcessor(emb_model).for_model(spam_model), spam_model, ResultStore(), model_version(), EMBEDDING_MODEL,
+                             model_path=MODEL_PATH)
+    poller = MailboxPoller(pipeline, args.host, args.user, os.environ[args.password_env],
+                           folders=args.folders, port=args.port, use_ssl=not args.no_ssl)
+    report = lambda counts: print(", ".join(f"{f}: {n} classified" for f, n in counts.items()), flush=True)
+    if args.once:
+        report(asyncio.run(poller.poll_once()))
+    else:
+        asyncio.run(poller.run_forever(args.interval, on_cycle=report,
+                                       on_error=lambda e: print(f"Poll failed: {e}", file=sys.stderr, flush=True)))
+
+
+if __name__ == "__main__":
+    main()
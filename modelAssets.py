@@ -0,0 +1,122 @@
+"""
+Carga de modelos para SpamSense AI
+Punto único para cargar el clasificador y el modelo de embeddings fuera de la UI
+"""
+
+import os
+
+import joblib
+import numpy as np
+from sklearn.isotonic import IsotonicRegression
+from sklearn.linear_model import LogisticRegression
+
+from normalization import normalization_tag
+from resultStore import fingerprint_file
+
+MODEL_PATH = "model/spam_model.pkl"
+EMBEDDING_MODEL = "all-mpnet-base-v2"
+MODEL_CACHE = "./model_cache"
+_LOGIT_EPS = 1e-6
+
+
+class ScoreCalibrator:
+    """
+    Maps raw P(spam) scores to calibrated probabilities (isotonic or Platt scaling).
+    Lives next to SpamClassifier so pickled bundles load without the calibration CLI.
+    """
+    def __init__(self, method="isotonic"):
+        if method not in ("isotonic", "platt"):
+            raise ValueError(f"Unknown calibration method: {method}")
+        self.method = method
+        self.__model = None
+
+    def fit(self, scores, labels):
+        scores = np.asarray(scores, dtype=np.float64)
+        if self.method == "isotonic":
+            self.__model = IsotonicRegression(y_min=0.0, y_max=1.0, out_of_bounds="clip").fit(scores, labels)
+        else:
+            self.__model = LogisticRegression().fit(self.__logit(scores), labels)
+        return self
+
+    def transform(self, scores):
+        scores = np.asarray(scores, dtype=np.float64)
+        if self.method == "isotonic":
+            return self.__model.predict(scores)
+        return self.__model.predict_proba(self.__logit(scores))[:, 1]
+
+    def __logit(self, scores):
+        p = np.clip(scores, _LOGIT_EPS, 1 - _LOGIT_EPS)
+        return np.log(p / (1 - p)).reshape(-1, 1)
+
+
+class SpamClassifier:
+    """
+    Model bundle: the trained estimator plus an optional probability calibrator
+    and the decision threshold on P(spam). Exposes the sklearn predict/predict_proba API,
+    so a bundle drops in wherever the bare estimator was used.
+    """
+    def __init__(self, estimator, calibrator=None, threshold=0.5, metadata=None):
+        self.estimator = estimator
+        self.calibrator = calibrator
+        self.threshold = float(threshold)
+        self.metadata = dict(metadata or {})
+        self.classes_ = np.array([0, 1])
+
+    @property
+    def feature_names_in_(self):
+        return self.estimator.feature_names_in_
+
+    def spam_proba(self, X):
+        """Calibrated P(spam) per row."""
+        spam_col = list(self.estimator.classes_).index(1)
+        scores = self.estimator.predict_proba(X)[:, spam_col]
+        return self.calibrator.transform(scores) if self.calibrator is not None else scores
+
+    def predict_proba(self, X):
+        p = self.spam_proba(X)
+        return np.column_stack([1 - p, p])
+
+    def predict(self, X):
+        return (self.spam_proba(X) >= self.threshold).astype(int)
+
+    def decide(self, proba):
+        """Labels (1 = spam) and confidence in that label from a predict_proba matrix."""
+        pred = (proba[:, 1] >= self.threshold).astype(int)
+        return pred, proba[np.arange(len(pred)), pred]
+
+
+def load_bundle(model_path=MODEL_PATH):
+    """Loads a SpamClassifier; a bare pickled estimator becomes a bundle with threshold 0.5."""
+    bundle = joblib.load(model_path)
+    return bundle if isinstance(bundle, SpamClassifier) else SpamClassifier(bundle)
+
+
+def save_bundle(bundle, model_path=MODEL_PATH):
+    """Writes the bundle atomically so a running app never loads a partial file."""
+    joblib.dump(bundle, model_path + ".tmp")
+    os.replace(model_path + ".tmp", model_path)
+
+
+def model_stamp(model_path=MODEL_PATH):
+    """Cheap change marker for the artifact: save_bundle replaces the file, so its inode and mtime change."""
+    stat = os.stat(model_path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def load_embedding_model():
+    # Imported lazily: sentence-transformers pulls in torch
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(
+        EMBEDDING_MODEL,
+        cache_folder=MODEL_CACHE
+    )
+
+
+def load_models(model_path=MODEL_PATH):
+    """Returns (spam_model, embedding_model)."""
+    return load_bundle(model_path), load_embedding_model()
+
+
+def model_version(model_path=MODEL_PATH):
+    """Version tag for stored results: classifier artifact + embedding model and body normalization."""
+    return fingerprint_file(model_path, extra=EMBEDDING_MODEL + normalization_tag())
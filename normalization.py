@@ -0,0 +1,188 @@
+"""
+Normalización del cuerpo del email para SpamSense AI
+Decodifica charsets y limpia ruido invisible antes de generar embeddings
+"""
+
+import argparse
+import email
+import html
+import os
+import re
+import unicodedata
+
+# "legacy" is what the bundled classifier was trained on; switch to "fast" once parity_report() agrees
+NORMALIZATION = os.environ.get("SPAMSENSE_NORMALIZATION", "legacy")  # "legacy" or "fast"
+NORMALIZER_VERSION = "1"
+
+MAX_BODY_CHARS = 40000  # far past what fits in the encoder window (384 tokens)
+MAX_REPEATS = 3
+
+# --- Precompiled patterns ---
+_MIME_HINT_RE = re.compile(r"^content-(?:transfer-encoding:\s*(?:base64|quoted-printable)|type:\s*multipart/)",
+                           flags=re.IGNORECASE | re.MULTILINE)
+_HTML_TYPE_RE = re.compile(r"^content-type:\s*text/html", flags=re.IGNORECASE | re.MULTILINE)
+_HIDDEN_BLOCK_RE = re.compile(r"<(style|script|head|title)\b.*?</\1\s*>", flags=re.IGNORECASE | re.DOTALL)
+_COMMENT_RE = re.compile(r"<!--.*?-->", flags=re.DOTALL)
+_TAG_RE = re.compile(r"<[^<>]*>")
+_URL_NOISE_RE = re.compile(r"(https?://[^\s?#<>\"']+)[?#][^\s<>\"']*", flags=re.IGNORECASE)
+_BLOB_RE = re.compile(r"[A-Za-z0-9+/=_\-]{60,}")
+_CHAR_RUN_RE = re.compile(r"(\S)\1{%d,}" % MAX_REPEATS)
+_SPACES_RE = re.compile(r"\s+")
+_LEGACY_TAG_RE = re.compile(r"<.*?>")
+
+
+def _invisible_table():
+    """Translate table dropping zero-width, bidi, soft-hyphen and other format/control characters."""
+    table = {}
+    # Format characters outside the BMP live in the musical-symbol and tag/selector blocks
+    for cp in (*range(0x10000), *range(0x1D173, 0x1D17B), *range(0xE0000, 0xE01F0)):
+        if 0xD800 <= cp <= 0xDFFF:
+            continue
+        category = unicodedata.category(chr(cp))
+        if category == "Cf" or (category == "Cc" and chr(cp) not in "\t\n\r"):
+            table[cp] = None
+    # Variation selectors only restyle the previous glyph
+    table.update({cp: None for cp in (*range(0xFE00, 0xFE10), *range(0xE0100, 0xE01F0))})
+    table[0x00A0] = " "  # no-break space
+    return table
+
+
+_INVISIBLE = _invisible_table()
+
+
+def normalization_tag(mode=NORMALIZATION):
+    """Suffix for embedding cache keys and model versions; empty for the legacy cleaner."""
+    return "" if mode == "legacy" else f"+norm{NORMALIZER_VERSION}"
+
+
+def decode_parts(header, body):
+    """
+    (plain, html) lists with the text of every inline text part, decoded with its declared
+    charset (base64, quoted-printable, multipart); attachments are skipped. Plain 8-bit
+    bodies are returned as they are (fast path), as plain or html after their Content-Type.
+    """
+    if not _MIME_HINT_RE.search(header):
+        return ([], [body]) if _HTML_TYPE_RE.search(header) else ([body], [])
+    message = email.message_from_string(header + "\n\n" + body)
+    plain, rich = [], []
+    for part in message.walk():
+        if part.is_multipart() or part.get_content_disposition() == "attachment":
+            continue
+        ctype = part.get_content_type()
+        if ctype not in ("text/plain", "text/html"):
+            continue
+        payload = part.get_payload(decode=True) or b""
+        try:
+            text = payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+        except LookupError:
+            text = payload.decode("latin-1")
+        (plain if ctype == "text/plain" else rich).append(text)
+    return plain, rich
+
+
+def decode_body(header, body):
+    """Text of the body, preferring text/plain parts over text/html."""
+    plain, rich = decode_parts(header, body)
+    return "\n".join(plain or rich)
+
+
+def collapse_repeats(text, max_repeats=MAX_REPEATS):
+    """Single pass over whitespace tokens keeping at most max_repeats identical tokens in a row."""
+    out, previous, run = [], None, 0
+    for token in text.split(" "):
+        run = run + 1 if token == previous else 1
+        previous = token
+        if run <= max_repeats:
+            out.append(token)
+    return " ".join(out)
+
+
+def clean_text(text):
+    """Markup, invisible characters, URL query noise, encoded blobs and repetition removed."""
+    text = text[:MAX_BODY_CHARS]
+    text = _COMMENT_RE.sub(" ", text)
+    text = _HIDDEN_BLOCK_RE.sub(" ", text)
+    text = _TAG_RE.sub(" ", text)
+    text = html.unescape(text).translate(_INVISIBLE)
+    text = _URL_NOISE_RE.sub(r"\1", text)
+    text = _BLOB_RE.sub(" ", text)
+    text = _CHAR_RUN_RE.sub(lambda m: m.group(1) * MAX_REPEATS, text)
+    text = _SPACES_RE.sub(" ", text).strip()
+    return collapse_repeats(text)
+
+
+def legacy_clean_text(text):
+    """The original cleaner (tags and whitespace only), kept for embeddings the model was trained on."""
+    text = _LEGACY_TAG_RE.sub("", text)
+    text = _SPACES_RE.sub(" ", text)
+    return text.strip()
+
+
+def normalize_body(header, body, mode=NORMALIZATION):
+    """Encoder input for an email body."""
+    if mode == "legacy":
+        return legacy_clean_text(body)
+    if mode != "fast":
+        raise ValueError(f"Unknown normalization mode: {mode}")
+    return clean_text(decode_body(header, body))
+
+
+def parity_report(model, embedding_model, raws, y=None, modes=("legacy", "fast")):
+    """
+    Classifier agreement when the same emails are normalized with each mode; the first
+    mode is the reference. Cosine is between the encoder outputs of the two inputs.
+    """
+    import numpy as np
+    import pandas as pd
+    from emailProcessor import EmailProcessor
+
+    columns = list(model.feature_names_in_)
+    frames = {mode: EmailProcessor(embedding_model, normalization=mode).for_model(model).transform_batch(raws)[columns]
+              for mode in modes}
+    reference = frames[modes[0]]
+    ref_proba = model.predict_proba(reference)[:, 1]
+    ref_pred = model.predict(reference)
+    ref_emb = reference.filter(like="emb_").to_numpy()
+    rows = []
+    for mode, frame in frames.items():
+        proba = model.predict_proba(frame)[:, 1]
+        pred = model.predict(frame)
+        emb = frame.filter(like="emb_").to_numpy()
+        cosine = (emb * ref_emb).sum(1) / np.maximum(
+            np.linalg.norm(emb, axis=1) * np.linalg.norm(ref_emb, axis=1), 1e-12)
+        row = {
+            "normalization": mode,
+            "label_agreement": float((pred == ref_pred).mean()),
+            "max_abs_dprob": float(np.abs(proba - ref_proba).max()),
+            "median_cosine": float(np.median(cosine))
+        }
+        if y is not None:
+            row["accuracy"] = float((pred == np.asarray(y)).mean())
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check classifier parity of the fast body normalization.")
+    parser.add_argument("emails", nargs="+", help="Raw .eml files")
+    parser.add_argument("--labels", help="CSV with name and label (SPAM/HAM or 1/0) columns, to add accuracy")
+    args = parser.parse_args()
+
+    from batchPipeline import decode_email
+    from modelAssets import load_bundle, load_embedding_model
+
+    raws, names = [], []
+    for path in args.emails:
+        with open(path, "rb") as fh:
+            raws.append(decode_email(fh.read()))
+        names.append(os.path.basename(path))
+    y = None
+    if args.labels:
+        import pandas as pd
+        labels = pd.read_csv(args.labels).set_index("name")["label"].astype(str).str.upper()
+        y = [int(labels[n] in ("SPAM", "1")) for n in names]
+    print(parity_report(load_bundle(), load_embedding_model(), raws, y).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+"""
+Perfilado de lotes para SpamSense AI
+Muestrea las pilas de un hilo durante una ejecución, atribuye el tiempo a etapas del pipeline y genera un flame graph SVG
+"""
+
+import argparse
+import cProfile
+import html
+import json
+import os
+import pstats
+import sys
+import sysconfig
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+import pandas as pd
+
+PROFILE_DIR = os.environ.get("SPAMSENSE_PROFILE_DIR", "data/profiles")
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+TOP_N = 25
+
+# Pipeline stages, matched against each sampled stack from the innermost frame outwards;
+# the first frame that matches decides the stage. Entries ending in "/" are path prefixes,
+# entries ending in ".py" are repo modules and anything else is a function name.
+STAGES = (
+    ("regex", ("re/", "sre_compile.py", "sre_parse.py")),
+    ("tokenization", ("tokenizers/", "transformers/tokenization_utils.py", "transformers/tokenization_utils_base.py",
+                      "transformers/tokenization_utils_fast.py", "count_tokens")),
+    ("embedding", ("torch/", "sentence_transformers/", "transformers/", "quantization.py")),
+    ("model", ("sklearn/", "modelAssets.py")),
+    ("attribution", ("featureAttribution.py", "shap/")),
+    ("pandas", ("pandas/",)),
+    ("rendering", ("plotly/", "render_dashboard", "render_explanations", "render_forensic_section", "components.py",
+                   "styles.py")),
+    ("normalization", ("normalization.py",)),
+    ("header features", ("emailProcessor.py",)),
+    ("forensics", ("forensics.py", "linkAnalysis.py", "attachmentScan.py", "enrichment.py")),
+    ("reputation", ("senderReputation.py",)),
+    ("store", ("resultStore.py", "jobQueue.py", "sqlite3/", "featureExport.py")),
+    ("batch loop", ("batchPipeline.py",)),
+    ("rendering", ("streamlit/",)),  # the script runner itself, once nothing more specific matched
+)
+OTHER = "other"
+STAGE_COLORS = {
+    "regex": "#e45756", "tokenization": "#f58518", "embedding": "#eeca3b", "model": "#54a24b",
+    "attribution": "#88d27a", "pandas": "#4c78a8", "rendering": "#b279a2", "normalization": "#ff9da6",
+    "header features": "#d67195", "forensics": "#9ecae9", "reputation": "#72b7b2", "store": "#bab0ac",
+    "batch loop": "#79706e", OTHER: "#d8d8d8"
+}
+
+
+def profile_path(job_id, profile_dir=PROFILE_DIR):
+    """Where a worker leaves the profile of a batch job."""
+    return os.path.join(profile_dir, f"job_{job_id}.json")
+
+
+def _source_roots():
+    """sys.path entries plus the stdlib, longest first, to shorten file names."""
+    roots = {os.path.abspath(p) for p in sys.path if p and os.path.isdir(p)}
+    roots.add(sysconfig.get_paths()["stdlib"])
+    return sorted(roots, key=len, reverse=True)
+
+
+class Profiler:
+    """
+    Profiler Class:
+    1. Samples the Python stack of one thread every `interval` seconds from a helper thread
+       (wall-clock, low overhead; C extensions show up as the Python frame calling them).
+    2. Optionally runs cProfile on the same thread for exact call counts (deterministic=True).
+    3. Leaves a ProfileReport in .report when the `with` block exits, even if it raised.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL, deterministic=False, thread_id=None, label=""):
+        self.interval = interval
+        self.deterministic = deterministic
+        self.thread_id = thread_id
+        self.label = label
+        self.report = None
+        self.__stacks = Counter()
+        self.__stop = threading.Event()
+        self.__sampler = None
+        self.__cprofile = None
+        self.__started = 0.0
+
+    def __enter__(self):
+        self.thread_id = self.thread_id or threading.get_ident()
+        self.__started = time.perf_counter()
+        self.__sampler = threading.Thread(target=self.__sample, name="spamsense-profiler", daemon=True)
+        self.__sampler.start()
+        if self.deterministic:
+            self.__cprofile = cProfile.Profile()
+            self.__cprofile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.__cprofile:
+            self.__cprofile.disable()
+        self.__stop.set()
+        self.__sampler.join()
+        duration = time.perf_counter() - self.__started
+        roots = _source_roots()
+        labels = {}
+        stacks = Counter()
+        for codes, count in self.__stacks.items():
+            stacks[tuple(labels.get(c) or labels.setdefault(c, self.__label(c, roots)) for c in codes)] += count
+        calls = None
+        if self.__cprofile:
+            calls = {}
+            for (filename, line, name), (_, ncalls, tottime, cumtime, _) in pstats.Stats(self.__cprofile).stats.items():
+                # Keyed by location: cProfile names methods without their class
+                calls[_location(self.__label(_CodeKey(filename, line, name), roots))] = (ncalls, tottime, cumtime)
+        self.report = ProfileReport(stacks, duration, calls, self.label)
+        return False
+
+    # --- Internal Utilities ---
+
+    def __sample(self):
+        while not self.__stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            if codes:
+                self.__stacks[tuple(reversed(codes))] += 1
+
+    @staticmethod
+    def __label(code, roots):
+        path = os.path.abspath(code.co_filename) if not code.co_filename.startswith("<") else code.co_filename
+        for root in roots:
+            if path.startswith(root + os.sep):
+                path = path[len(root) + 1:]
+                break
+        name = getattr(code, "co_qualname", code.co_name)
+        return f"{name} ({path.replace(os.sep, '/')}:{code.co_firstlineno})"
+
+
+class _CodeKey:
+    """cProfile entry shaped like a code object, so both profiles share frame labels."""
+    def __init__(self, filename, line, name):
+        self.co_filename, self.co_firstlineno, self.co_name = filename, line, name
+
+
+def _frame_parts(label):
+    """'fn (pkg/mod.py:12)' -> ('fn', 'pkg/mod.py')."""
+    name, _, where = label.rpartition(" (")
+    return name.rsplit(".", 1)[-1], where.rsplit(":", 1)[0]
+
+
+def _location(label):
+    """'fn (pkg/mod.py:12)' -> 'pkg/mod.py:12'."""
+    return label.rpartition(" (")[2].rstrip(")")
+
+
+def stage_of_frame(label):
+    """Stage a single frame belongs to, or None."""
+    name, path = _frame_parts(label)
+    for stage, rules in STAGES:
+        for rule in rules:
+            if (path.startswith(rule) if rule.endswith("/") else path == rule if rule.endswith(".py")
+                    else name == rule):
+                return stage
+    return None
+
+
+class ProfileReport:
+    """
+    ProfileReport Class:
+    1. Holds sampled stacks (root first) with their sample counts, plus optional cProfile counts.
+    2. Attributes samples to pipeline stages (STAGES) and ranks hot functions (self and total time).
+    3. Renders folded stacks (flamegraph.pl / speedscope input) and a self-contained SVG flame graph.
+    """
+    def __init__(self, stacks, duration, calls=None, label=""):
+        self.stacks = Counter(stacks)
+        self.duration = duration
+        self.calls = calls
+        self.label = label
+        self.__stages = {}
+
+    @property
+    def samples(self):
+        return sum(self.stacks.values())
+
+    @property
+    def seconds_per_sample(self):
+        return self.duration / self.samples if self.samples else 0.0
+
+    def stage(self, stack):
+        """Stage of a sampled stack: the innermost frame matching STAGES decides."""
+        if stack not in self.__stages:
+            self.__stages[stack] = next((s for s in map(stage_of_frame, reversed(stack)) if s), OTHER)
+        return self.__stages[stack]
+
+    def merge(self, other):
+        """
+        One report over both runs (e.g. the worker's batch run and the dashboard render);
+        cProfile entries seen in both add up their calls and times.
+        """
+        calls = None
+        if self.calls or other.calls:
+            calls = dict(self.calls or {})
+            for location, counts in (other.calls or {}).items():
+                calls[location] = tuple(map(sum, zip(calls[location], counts))) if location in calls else counts
+        return ProfileReport(self.stacks + other.stacks, self.duration + other.duration, calls,
+                             " + ".join(filter(None, (self.label, other.label))))
+
+    def stages(self):
+        """Seconds and share of samples per stage, largest first."""
+        counts = Counter()
+        for stack, n in self.stacks.items():
+            counts[self.stage(stack)] += n
+        total = max(self.samples, 1)
+        df = pd.DataFrame([(s, n * self.seconds_per_sample, n / total) for s, n in counts.most_common()],
+                          columns=["stage", "seconds", "share"])
+        return df
+
+    def top(self, n=TOP_N):
+        """
+        Hot functions by self time (leaf samples), with total (inclusive) time and their stage;
+        helpers outside STAGES (numpy, the stdlib) get the stage they mostly ran under.
+        """
+        self_counts, total_counts, stages = Counter(), Counter(), defaultdict(Counter)
+        for stack, count in self.stacks.items():
+            self_counts[stack[-1]] += count
+            stages[stack[-1]][self.stage(stack)] += count
+            for frame in set(stack):
+                total_counts[frame] += count
+        total = max(self.samples, 1)
+        rows = []
+        for frame, count in self_counts.most_common(n):
+            row = {"function": frame, "stage": stage_of_frame(frame) or stages[frame].most_common(1)[0][0],
+                   "self_s": count * self.seconds_per_sample, "self_share": count / total,
+                   "total_s": total_counts[frame] * self.seconds_per_sample,
+                   "total_share": total_counts[frame] / total}
+            if self.calls is not None:
+                ncalls, tottime, cumtime = self.calls.get(_location(frame), (None, None, None))
+                row.update(calls=ncalls, cprofile_self_s=tottime, cprofile_total_s=cumtime)
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def folded(self):
+        """Folded stacks, one 'root;...;leaf count' line per distinct stack."""
+        return "".join(f"{';'.join(stack)} {n}\n" for stack, n in sorted(self.stacks.items()))
+
+    def flame_svg(self, width=1200, row_height=16, min_width=0.5):
+        """Flame graph (root at the bottom) coloured by stage; hover a frame for its name and time."""
+        tree = _node()
+        for stack, n in self.stacks.items():
+            node = tree
+            node["n"] += n
+            for frame in stack:
+                node = node["children"][frame]
+                node["n"] += n
+            node["stage"] = self.stage(stack)
+        depth = max((len(s) for s in self.stacks), default=0)
+        height = (depth + 3) * row_height
+        scale = width / max(tree["n"], 1)
+        rects = []
+
+        def place(node, x, level, stage):
+            for frame, child in sorted(node["children"].items()):
+                w = child["n"] * scale
+                if w >= min_width:
+                    child_stage = stage_of_frame(frame) or stage
+                    y = height - (level + 2) * row_height
+                    seconds = child["n"] * self.seconds_per_sample
+                    tip = html.escape(f"{frame}\n{seconds:.3f}s ({child['n'] / tree['n']:.1%}) · {child_stage}")
+                    text = html.escape(frame.split(" (", 1)[0][:int(w / 7)]) if w > 35 else ""
+                    rects.append(
+                        f'<g><title>{tip}</title><rect x="{x:.2f}" y="{y}" width="{w:.2f}" height="{row_height - 1}" '
+                        f'fill="{STAGE_COLORS.get(child_stage, STAGE_COLORS[OTHER])}" rx="2"/>'
+                        f'<text x="{x + 3:.2f}" y="{y + row_height - 4}">{text}</text></g>'
+                    )
+                    place(child, x, level + 1, child_stage)
+                x += w
+
+        place(tree, 0.0, 0, OTHER)
+        title = html.escape(f"SpamSense profile {self.label} · {self.duration:.2f}s · {self.samples} samples")
+        legend = " · ".join(f"{html.escape(s)} {share:.0%}" for s, share in self.stages()[["stage", "share"]].values)
+        return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+                f'font-family="monospace" font-size="11">'
+                f'<rect width="100%" height="100%" fill="#ffffff"/>'
+                f'<text x="4" y="{row_height - 4}" font-size="13">{title}</text>'
+                f'<text x="4" y="{2 * row_height - 4}" fill="#555">{legend}</text>'
+                + "".join(rects) + "</svg>")
+
+    def to_json(self):
+        return json.dumps({"label": self.label, "duration": self.duration, "calls": self.calls,
+                           "stacks": [[list(s), n] for s, n in self.stacks.items()]})
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        calls = {k: tuple(v) for k, v in data["calls"].items()} if data.get("calls") else None
+        return cls({tuple(s): n for s, n in data["stacks"]}, data["duration"], calls, data.get("label", ""))
+
+    def save(self, path):
+        """Writes the report atomically, so a reader polling for the file never loads half of it."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as fh:
+            fh.write(self.to_json())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as fh:
+            return cls.from_json(fh.read())
+
+
+def _node():
+    return {"n": 0, "children": defaultdict(_node)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile one batch run and write a flame graph.")
+    parser.add_argument("inputs", nargs="*", help="Directories or .eml/.txt files (default: a synthetic corpus)")
+    parser.add_argument("--synthetic", type=int, default=500, help="Synthetic emails when no inputs are given")
+    parser.add_argument("--deterministic", action="store_true", help="Also run cProfile for exact call counts")
+    parser.add_argument("--interval-ms", type=float, default=SAMPLE_INTERVAL * 1000)
+    parser.add_argument("--top", type=int, default=TOP_N)
+    parser.add_argument("--fresh", action="store_true",
+                        help="Score into a temporary store, so stored results and embeddings are not reused")
+    parser.add_argument("--out", default=None, help="Output prefix (default profile_<timestamp>)")
+    args = parser.parse_args()
+
+    if args.fresh:
+        # Before the pipeline modules are imported: they read these at import time
+        workdir = tempfile.mkdtemp(prefix="spamsense_profile_")
+        os.environ.update({"SPAMSENSE_DB": os.path.join(workdir, "results.db"),
+                           "SPAMSENSE_REPUTATION_DB": os.path.join(workdir, "reputation.db")})
+
+    from jobQueue import build_pipeline
+    from loadTest import load_corpus, synthetic_corpus
+
+    emails = []
+    for item in args.inputs:
+        if os.path.isdir(item):
+            emails += load_corpus(item)
+        else:
+            with open(item, "rb") as fh:
+                emails.append((os.path.basename(item), fh.read()))
+    emails = emails or synthetic_corpus(args.synthetic)
+
+    pipeline = build_pipeline()  # model loading is not part of the profile
+    with Profiler(args.interval_ms / 1000, args.deterministic, label=f"{len(emails)} emails") as profiler:
+        report = pipeline.run(emails, len(emails))
+    profile = profiler.report
+
+    out = args.out or time.strftime("profile_%Y%m%d_%H%M%S")
+    with open(out + ".svg", "w", encoding="utf-8") as fh:
+        fh.write(profile.flame_svg())
+    with open(out + ".folded", "w", encoding="utf-8") as fh:
+        fh.write(profile.folded())
+    top = profile.top(args.top)
+    top.to_csv(out + "_top.csv", index=False)
+
+    print(f"{len(report.results)} emails in {profile.duration:.2f}s ({profile.samples} samples, "
+          f"{report.reused} reused)\n")
+    print(profile.stages().to_string(index=False, formatters={"share": "{:.1%}".format, "seconds": "{:.3f}".format}))
+    print()
+    print(top.to_string(index=False, max_colwidth=70, float_format="{:.3f}".format))
+    print(f"\nWrote {out}.svg, {out}.folded and {out}_top.csv")
+
+
+if __name__ == "__main__":
+    main()
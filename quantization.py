@@ -0,0 +1,165 @@
+"""
+Precisión adaptativa de embeddings para SpamSense AI
+Almacena vectores en float16 o int8 con escala y los decodifica solo al clasificar
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+PRECISIONS = ("float32", "float16", "int8")
+EMBEDDING_PRECISION = os.environ.get("SPAMSENSE_EMBEDDING_PRECISION", "float16")
+
+_SCALE_BYTES = 4  # int8 blobs start with their float32 scale
+
+
+def quantize(matrix, precision=EMBEDDING_PRECISION):
+    """
+    (n, d) float matrix -> (codes, scales). int8 uses one symmetric scale per row
+    (max |value| / 127); scales is None for the float precisions.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if precision == "float32":
+        return matrix, None
+    if precision == "float16":
+        return matrix.astype(np.float16), None
+    if precision == "int8":
+        peak = np.abs(matrix).max(axis=-1, keepdims=True)
+        scales = np.where(peak > 0, peak / 127.0, 1.0).astype(np.float32)
+        codes = np.clip(np.rint(matrix / scales), -127, 127).astype(np.int8)
+        return codes, scales[..., 0]
+    raise ValueError(f"Unknown embedding precision: {precision}")
+
+
+def dequantize(codes, scales=None):
+    """Back to float32 for the classifier."""
+    if scales is None:
+        return np.asarray(codes, dtype=np.float32)
+    return codes.astype(np.float32) * np.asarray(scales, dtype=np.float32)[..., None]
+
+
+def encode_vector(vector, precision=EMBEDDING_PRECISION):
+    """One embedding as a storage blob."""
+    codes, scales = quantize(np.asarray(vector).reshape(1, -1), precision)
+    if scales is None:
+        return codes.tobytes()
+    return scales.astype(np.float32).tobytes() + codes.tobytes()
+
+
+def blob_precision(blob, dim):
+    """Precision of a stored blob, read from its size."""
+    return size_precision(len(blob), dim)
+
+
+def size_precision(size, dim):
+    """Precision of a blob of `size` bytes (float32: 4d, float16: 2d, int8: d + 4 bytes)."""
+    if size == 4 * dim:
+        return "float32"
+    if size == 2 * dim:
+        return "float16"
+    if size == dim + _SCALE_BYTES:
+        return "int8"
+    raise ValueError(f"Embedding blob of {size} bytes does not match dimension {dim}")
+
+
+def decode_vector(blob, dim, out=None):
+    """Stored blob -> float32 vector, written into `out` when given (no intermediate lists)."""
+    precision = blob_precision(blob, dim)
+    if precision == "int8":
+        scale = np.frombuffer(blob, dtype=np.float32, count=1)[0]
+        values = np.frombuffer(blob, dtype=np.int8, offset=_SCALE_BYTES)
+    else:
+        scale, values = None, np.frombuffer(blob, dtype=precision)
+    if out is None:
+        out = np.empty(dim, dtype=np.float32)
+    if scale is None:
+        out[:] = values
+    else:
+        np.multiply(values, scale, out=out)
+    return out
+
+
+def bytes_per_vector(dim, precision):
+    return {"float32": 4 * dim, "float16": 2 * dim, "int8": dim + _SCALE_BYTES}[precision]
+
+
+def parity_report(model, X, n_header, y=None, precisions=PRECISIONS):
+    """
+    Classifier agreement when the embedding columns of X go through each precision.
+    X must hold full-precision embeddings; the float32 row is the reference.
+    """
+    X = np.asarray(X, dtype=np.float32)
+    dim = X.shape[1] - n_header
+    columns = list(getattr(model, "feature_names_in_", range(X.shape[1])))
+    reference = model.predict_proba(pd.DataFrame(X, columns=columns))[:, 1]
+    ref_pred = model.predict(pd.DataFrame(X, columns=columns))
+    emb = X[:, n_header:]
+    rows = []
+    for precision in precisions:
+        Xq = X.copy()
+        restored = dequantize(*quantize(emb, precision))
+        Xq[:, n_header:] = restored
+        frame = pd.DataFrame(Xq, columns=columns)
+        proba = model.predict_proba(frame)[:, 1]
+        pred = model.predict(frame)
+        cosine = (emb * restored).sum(1) / np.maximum(
+            np.linalg.norm(emb, axis=1) * np.linalg.norm(restored, axis=1), 1e-12)
+        row = {
+            "precision": precision,
+            "bytes_per_vector": bytes_per_vector(dim, precision),
+            "compression": bytes_per_vector(dim, "float32") / bytes_per_vector(dim, precision),
+            "label_agreement": float((pred == ref_pred).mean()),
+            "max_abs_dprob": float(np.abs(proba - reference).max()),
+            "min_cosine": float(cosine.min())
+        }
+        if y is not None:
+            row["accuracy"] = float((pred == np.asarray(y)).mean())
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check classifier parity of quantized embeddings.")
+    parser.add_argument("--emails", nargs="+", help="Raw .eml files, encoded at full precision for the check")
+    parser.add_argument("--labeled", action="store_true", help="Use the labeled emails of the result store")
+    parser.add_argument("--limit", type=int, default=5000, help="Stored emails to use otherwise")
+    args = parser.parse_args()
+
+    from modelAssets import load_bundle
+    from resultStore import ResultStore
+
+    bundle = load_bundle()
+    columns = list(bundle.feature_names_in_)
+    # Header features (plus attachment counts for a bundle trained with them) precede the embedding
+    n_header = sum(1 for c in columns if not c.startswith("emb_"))
+    y = None
+    if args.emails:
+        from batchPipeline import decode_email
+        from emailProcessor import EmailProcessor
+        from modelAssets import load_embedding_model
+        emb_model = load_embedding_model()
+        raws = []
+        for path in args.emails:
+            with open(path, "rb") as fh:
+                raws.append(decode_email(fh.read()))
+        X = EmailProcessor(emb_model).for_model(bundle).transform_batch(raws)[columns].to_numpy()
+    else:
+        store = ResultStore()
+        stored = store.embedding_precisions()
+        if set(stored) - {"float32"}:
+            print(f"Stored embeddings by precision: {stored}. Quantized rows are compared against "
+                  "themselves; use --emails for a full-precision reference.")
+        if args.labeled:
+            _, frame, y = store.labeled_matrix(columns)
+        else:
+            frame = store.feature_matrix(columns, args.limit)
+        X = frame.to_numpy()
+    if len(X) == 0:
+        raise SystemExit("No embeddings to check.")
+    print(parity_report(bundle, X, n_header, y).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Caché de resultados por email para SpamSense AI
+LRU acotada y compartida entre sesiones, indexada por el hash del mensaje normalizado y la versión del modelo
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+RESULT_CACHE_SIZE = int(os.environ.get("SPAMSENSE_RESULT_CACHE_SIZE", "256"))
+
+CacheStats = namedtuple("CacheStats", ["hits", "misses", "evictions", "size", "capacity"])
+
+
+def normalize_raw(raw):
+    """
+    Canonical text of a pasted email: CRLF line endings and surrounding blank space removed,
+    so the same message copied from different clients gives the same key (and the same result).
+    """
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8", errors="replace")
+    return raw.replace("\r\n", "\n").strip()
+
+
+def result_key(normalized, model_version):
+    """Cache key: SHA-256 of the normalized message, scoped to the model version that scored it."""
+    return hashlib.sha256(normalized.encode("utf-8", errors="replace")).hexdigest() + ":" + model_version
+
+
+class ResultCache:
+    """
+    ResultCache Class:
+    1. Keeps the most recently used results in an OrderedDict, evicting the oldest past max_entries.
+    2. Is safe to share between Streamlit sessions (one lock around every access).
+    3. Counts hits, misses and evictions for the sidebar.
+    """
+    def __init__(self, max_entries=RESULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = self.__misses = self.__evictions = 0
+
+    def get(self, key):
+        """Cached result for key (marked as recently used), or None."""
+        with self.__lock:
+            value = self.__entries.get(key)
+            if value is None:
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+                self.__evictions += 1
+
+    def get_or_compute(self, key, compute):
+        """
+        (result, hit). On a miss compute() runs outside the lock, so a slow analysis does not
+        block other sessions; two sessions missing the same key at once both compute it.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value, True
+        value = compute()
+        self.put(key, value)
+        return value, False
+
+    def stats(self):
+        with self.__lock:
+            return CacheStats(self.__hits, self.__misses, self.__evictions, len(self.__entries), self.max_entries)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
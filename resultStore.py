@@ -0,0 +1,451 @@
+"""
+Almacén local de resultados para SpamSense AI
+Persiste en SQLite cada email puntuado para no volver a calcularlo
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from quantization import EMBEDDING_PRECISION, PRECISIONS, decode_vector, encode_vector, size_precision
+
+DEFAULT_DB_PATH = os.environ.get("SPAMSENSE_DB", "data/spamsense.db")
+
+_MESSAGE_ID_RE = re.compile(r"^Message-ID:\s*(.*)$", flags=re.IGNORECASE | re.MULTILINE)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    body_hash TEXT PRIMARY KEY,
+    dim INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    tokens INTEGER
+);
+CREATE TABLE IF NOT EXISTS results (
+    message_id TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    model_version TEXT NOT NULL,
+    label TEXT NOT NULL,
+    probability REAL NOT NULL,
+    confidence REAL NOT NULL,
+    ip TEXT,
+    domain TEXT,
+    urls TEXT,
+    header_features TEXT NOT NULL,
+    embedding_ref TEXT REFERENCES embeddings(body_hash),
+    scored_at REAL NOT NULL,
+    PRIMARY KEY (message_id, content_hash, model_version)
+);
+CREATE INDEX IF NOT EXISTS idx_results_content ON results(content_hash);
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    model_version TEXT NOT NULL,
+    n_emails INTEGER NOT NULL DEFAULT 0,
+    source TEXT NOT NULL DEFAULT 'upload'
+);
+CREATE TABLE IF NOT EXISTS labels (
+    content_hash TEXT PRIMARY KEY,
+    label INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attributions (
+    message_id TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    model_version TEXT NOT NULL,
+    method TEXT NOT NULL,
+    contributions TEXT NOT NULL,
+    PRIMARY KEY (message_id, content_hash, model_version)
+);
+CREATE TABLE IF NOT EXISTS routing (
+    content_hash TEXT PRIMARY KEY,
+    features TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS links (
+    content_hash TEXT PRIMARY KEY,
+    features TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    content_hash TEXT PRIMARY KEY,
+    features TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sender_history (
+    content_hash TEXT PRIMARY KEY,
+    features TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS batch_members (
+    batch_id INTEGER NOT NULL REFERENCES batches(batch_id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    PRIMARY KEY (batch_id, position)
+);
+"""
+
+
+def fingerprint_file(path, extra=""):
+    """Short, stable version tag for a model artifact (content hash + optional suffix)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    h.update(extra.encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def email_key(raw_text):
+    """Returns (message_id, content_hash) identifying a raw email."""
+    header = raw_text.split("\n\n", 1)[0]
+    match = _MESSAGE_ID_RE.search(header)
+    message_id = match.group(1).strip() if match else ""
+    content_hash = hashlib.sha256(raw_text.encode("utf-8", errors="replace")).hexdigest()
+    return message_id, content_hash
+
+
+def body_hash(raw_text, embedder=""):
+    """Embedding reference: hash of the body plus the encoder that embedded it."""
+    parts = raw_text.split("\n\n", 1)
+    body = parts[1] if len(parts) > 1 else ""
+    h = hashlib.sha256(embedder.encode("utf-8"))
+    h.update(body.encode("utf-8", errors="replace"))
+    return h.hexdigest()
+
+
+class ResultStore:
+    """
+    ResultStore Class:
+    1. Records label, probability, header features and an embedding reference per email.
+    2. Answers lookups by (Message-ID, content hash, model version) so reruns skip scoring.
+    3. Keeps every batch so past reports can be reopened from the dashboard.
+    """
+    def __init__(self, path=DEFAULT_DB_PATH, precision=EMBEDDING_PRECISION):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown embedding precision: {precision}")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        # New embeddings are written at this precision; stored rows of any precision stay readable
+        self.precision = precision
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        self.__conn.executescript(_SCHEMA)
+        # Stores created before body token counts were recorded
+        if "tokens" not in {row[1] for row in self.__conn.execute("PRAGMA table_info(embeddings)")}:
+            self.__conn.execute("ALTER TABLE embeddings ADD COLUMN tokens INTEGER")
+        # Stores created before batches recorded where they came from
+        if "source" not in {row[1] for row in self.__conn.execute("PRAGMA table_info(batches)")}:
+            self.__conn.execute("ALTER TABLE batches ADD COLUMN source TEXT NOT NULL DEFAULT 'upload'")
+        self.__conn.commit()
+
+    # --- Scoring cache ---
+
+    def lookup(self, message_id, content_hash, model_version):
+        """Returns the stored result for this email under model_version, or None."""
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT r.label, r.probability, r.confidence, r.ip, r.domain, r.urls, "
+                "r.header_features, e.vector, e.dim, e.tokens, a.contributions FROM results r "
+                "LEFT JOIN embeddings e ON e.body_hash = r.embedding_ref "
+                "LEFT JOIN attributions a ON a.message_id = r.message_id "
+                "AND a.content_hash = r.content_hash AND a.model_version = r.model_version "
+                "WHERE r.message_id = ? AND r.content_hash = ? AND r.model_version = ?",
+                (message_id, content_hash, model_version)
+            ).fetchone()
+        if row is None:
+            return None
+        label, prob, conf, ip, domain, urls, header_json, vector, dim, tokens, contributions = row
+        return {
+            "label": label,
+            "probability": prob,
+            "confidence": conf,
+            "ip": ip,
+            "domain": domain,
+            "urls": json.loads(urls) if urls else [],
+            "header_features": json.loads(header_json),
+            "embedding": decode_vector(vector, dim) if vector is not None else None,
+            "body_tokens": tokens,
+            "attributions": json.loads(contributions) if contributions else None
+        }
+
+    def lookup_embedding(self, embedding_ref):
+        """Returns a cached embedding as float32 array, or None."""
+        with self.__lock:
+            row = self.__conn.execute(
+                "SELECT vector, dim FROM embeddings WHERE body_hash = ?", (embedding_ref,)
+            ).fetchone()
+        return decode_vector(*row) if row else None
+
+    def save(self, message_id, content_hash, model_version, label, probability, confidence,
+             ip, domain, urls, features_df, embedding_ref):
+        """Stores one scored email. features_df is the one-row frame fed to the model."""
+        header_cols = [c for c in features_df.columns if not c.startswith("emb_")]
+        emb_cols = [c for c in features_df.columns if c.startswith("emb_")]
+        self.save_many(model_version, [{
+            "message_id": message_id, "content_hash": content_hash,
+            "label": label, "probability": probability, "confidence": confidence,
+            "ip": ip, "domain": domain, "urls": urls,
+            "header_features": {c: features_df[c].iloc[0].item() for c in header_cols},
+            "embedding": features_df[emb_cols].to_numpy(dtype=np.float32).ravel(),
+            "embedding_ref": embedding_ref
+        }])
+
+    def save_many(self, model_version, records):
+        """
+        Stores a chunk of scored emails in one transaction.
+        Each record holds the result fields, a header_features dict and a float32 embedding,
+        which is stored at the store's precision.
+        """
+        now = time.time()
+        embeddings, results = [], []
+        for r in records:
+            if r["embedding"] is not None:  # pre-filtered emails are stored without one
+                vector = np.asarray(r["embedding"])
+                embeddings.append((r["embedding_ref"], len(vector), encode_vector(vector, self.precision),
+                                   r.get("body_tokens")))
+            results.append((
+                r["message_id"], r["content_hash"], model_version, r["label"],
+                float(r["probability"]), float(r["confidence"]), r["ip"], r["domain"],
+                json.dumps(list(r["urls"] or [])), json.dumps(r["header_features"]),
+                r["embedding_ref"], now
+            ))
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (body_hash, dim, vector, tokens) VALUES (?, ?, ?, ?)", embeddings
+            )
+            self.__conn.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", results
+            )
+
+    def save_attributions(self, model_version, method, records):
+        """records: iterable of (message_id, content_hash, {feature: contribution})."""
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "INSERT OR REPLACE INTO attributions VALUES (?, ?, ?, ?, ?)",
+                [(m, h, model_version, method, json.dumps(c)) for m, h, c in records]
+            )
+
+    def save_routing(self, records):
+        """records: iterable of (content_hash, {routing column: value}) from the Received chain."""
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "INSERT OR REPLACE INTO routing VALUES (?, ?)",
+                [(h, json.dumps(f)) for h, f in records]
+            )
+
+    def save_links(self, records):
+        """records: iterable of (content_hash, {link column: value}) from the body links."""
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "INSERT OR REPLACE INTO links VALUES (?, ?)",
+                [(h, json.dumps(f)) for h, f in records]
+            )
+
+    def save_attachments(self, records):
+        """records: iterable of (content_hash, {attachment column: value}) from the MIME parts."""
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "INSERT OR REPLACE INTO attachments VALUES (?, ?)",
+                [(h, json.dumps(f)) for h, f in records]
+            )
+
+    def save_sender_history(self, records):
+        """records: iterable of (content_hash, {reputation column: value}) as read before scoring."""
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "INSERT OR REPLACE INTO sender_history VALUES (?, ?)",
+                [(h, json.dumps(f)) for h, f in records]
+            )
+
+    # --- Batch history ---
+
+    def start_batch(self, model_version, source="upload"):
+        """source: "upload" for reports run from the app, "imap" for mailboxIngest polls."""
+        with self.__lock, self.__conn:
+            cur = self.__conn.execute(
+                "INSERT INTO batches (created_at, model_version, source) VALUES (?, ?, ?)",
+                (time.time(), model_version, source)
+            )
+            return cur.lastrowid
+
+    def add_to_batch(self, batch_id, position, name, message_id, content_hash):
+        self.add_many_to_batch(batch_id, [(position, name, message_id, content_hash)])
+
+    def add_many_to_batch(self, batch_id, members):
+        """members: iterable of (position, name, message_id, content_hash)."""
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "INSERT OR REPLACE INTO batch_members VALUES (?, ?, ?, ?, ?)",
+                [(batch_id, *m) for m in members]
+            )
+            self.__conn.execute(
+                "UPDATE batches SET n_emails = (SELECT COUNT(*) FROM batch_members WHERE batch_id = ?) "
+                "WHERE batch_id = ?", (batch_id, batch_id)
+            )
+
+    def list_batches(self, limit=50, source="upload"):
+        """Most recent batches of `source` first (None: every source)."""
+        with self.__lock:
+            df = pd.read_sql_query(
+                "SELECT batch_id, created_at, model_version, n_emails, source FROM batches "
+                "WHERE n_emails > 0 AND (? IS NULL OR source = ?) ORDER BY batch_id DESC LIMIT ?",
+                self.__conn, params=(source, source, limit)
+            )
+        df["created_at"] = pd.to_datetime(df["created_at"], unit="s")
+        return df
+
+    def load_batch(self, batch_id):
+        """Returns (results_df, features_df) in the shape render_dashboard expects."""
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT m.name, r.label, r.confidence, r.ip, r.urls, r.domain, "
+                "r.header_features, e.vector, e.dim, e.tokens, ro.features, li.features, at.features, sh.features "
+                "FROM batch_members m "
+                "JOIN batches b ON b.batch_id = m.batch_id "
+                "JOIN results r ON r.message_id = m.message_id AND r.content_hash = m.content_hash "
+                "AND r.model_version = b.model_version "
+                "LEFT JOIN embeddings e ON e.body_hash = r.embedding_ref "
+                "LEFT JOIN routing ro ON ro.content_hash = m.content_hash "
+                "LEFT JOIN links li ON li.content_hash = m.content_hash "
+                "LEFT JOIN attachments at ON at.content_hash = m.content_hash "
+                "LEFT JOIN sender_history sh ON sh.content_hash = m.content_hash "
+                "WHERE m.batch_id = ? ORDER BY m.position",
+                (batch_id,)
+            ).fetchall()
+        if not rows:
+            return pd.DataFrame(), pd.DataFrame()
+        results = []
+        for name, label, conf, ip, urls, domain, header_json, _, _, tokens, routing, links, attachments, history in rows:
+            header = json.loads(header_json)
+            results.append({
+                "name": name, "label": label, "confidence": conf,
+                "ip": ip, "urls": json.loads(urls) if urls else [], "domain": domain,
+                "subject_length": header["subject_length"],
+                "body_tokens": tokens,
+                **(json.loads(routing) if routing else {}),
+                **(json.loads(links) if links else {}),
+                **(json.loads(attachments) if attachments else {}),
+                **(json.loads(history) if history else {})
+            })
+        features = self.__matrix([(r[6], r[7], r[8]) for r in rows])
+        return pd.DataFrame(results), features
+
+    def load_batch_attributions(self, batch_id):
+        """Stored attributions of a batch in member order (empty rows for emails without one)."""
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT a.contributions FROM batch_members m "
+                "JOIN batches b ON b.batch_id = m.batch_id "
+                "JOIN results r ON r.message_id = m.message_id AND r.content_hash = m.content_hash "
+                "AND r.model_version = b.model_version "
+                "LEFT JOIN attributions a ON a.message_id = m.message_id AND a.content_hash = m.content_hash "
+                "AND a.model_version = b.model_version "
+                "WHERE m.batch_id = ? ORDER BY m.position",
+                (batch_id,)
+            ).fetchall()
+        return pd.DataFrame([json.loads(c) if c else {} for (c,) in rows])
+
+    # --- Ground-truth labels ---
+
+    def set_labels(self, labels, source="analyst"):
+        """labels: iterable of (content_hash, 0/1). Later corrections overwrite earlier ones."""
+        now = time.time()
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?)",
+                [(h, int(y), source, now) for h, y in labels]
+            )
+
+    def resolve_message_ids(self, message_ids):
+        """Message-ID -> content hash for already scored emails."""
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT DISTINCT message_id, content_hash FROM results WHERE message_id != ''"
+            ).fetchall()
+        wanted = set(message_ids)
+        return {m: h for m, h in rows if m in wanted}
+
+    def labeled_matrix(self, columns):
+        """
+        Stored features of every labeled email, without re-embedding.
+        Stored attachment counts are merged into the header features, so a model can be
+        retrained with ATTACHMENT_COLUMNS even if the current one did not use them.
+        Returns (content hashes, X as float32 DataFrame in `columns` order, y).
+        """
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT l.content_hash, l.label, r.header_features, e.vector, e.dim, at.features FROM labels l "
+                "JOIN results r ON r.rowid = (SELECT rowid FROM results WHERE content_hash = l.content_hash "
+                "ORDER BY scored_at DESC LIMIT 1) "
+                "JOIN embeddings e ON e.body_hash = r.embedding_ref "
+                "LEFT JOIN attachments at ON at.content_hash = l.content_hash"
+            ).fetchall()
+        hashes = [r[0] for r in rows]
+        y = np.array([r[1] for r in rows], dtype=np.int64)
+        rows = [(json.dumps({**json.loads(attachments or "{}"), **json.loads(header)}), vector, dim)
+                for _, _, header, vector, dim, attachments in rows]
+        return hashes, self.__matrix(rows, columns), y
+
+    def scored_history(self):
+        """
+        (content_hash, domain, ip, is_spam, scored_at) per email, latest model verdict, oldest first.
+        Pre-filtered verdicts (stored without an embedding) are left out.
+        """
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT content_hash, domain, ip, label = 'SPAM', MAX(scored_at) FROM results "
+                "WHERE embedding_ref IS NOT NULL GROUP BY content_hash ORDER BY 5"
+            ).fetchall()
+        return rows
+
+    def feature_matrix(self, columns, limit=None):
+        """Stored features of the most recently scored emails as a float32 DataFrame."""
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT r.header_features, e.vector, e.dim FROM results r "
+                "JOIN embeddings e ON e.body_hash = r.embedding_ref "
+                "ORDER BY r.scored_at DESC LIMIT ?", (-1 if limit is None else limit,)
+            ).fetchall()
+        return self.__matrix(rows, columns)
+
+    def embedding_precisions(self):
+        """Number of stored embeddings per precision."""
+        with self.__lock:
+            rows = self.__conn.execute(
+                "SELECT length(vector), dim, COUNT(*) FROM embeddings GROUP BY 1, 2"
+            ).fetchall()
+        counts = {}
+        for size, dim, n in rows:
+            precision = size_precision(size, dim)
+            counts[precision] = counts.get(precision, 0) + n
+        return counts
+
+    # --- Internal Utilities ---
+
+    def __matrix(self, rows, columns=None):
+        """
+        (header JSON, embedding blob, dim) rows -> float32 DataFrame, decoding every
+        embedding straight into its row of one preallocated matrix. Features missing
+        from a row's JSON are NaN.
+        """
+        if columns is None:
+            dim = next((d for _, v, d in rows if v is not None), 0)
+            columns = list(json.loads(rows[0][0])) + [f"emb_{i}" for i in range(dim)] if rows else []
+        header_cols = [c for c in columns if not c.startswith("emb_")]
+        n_header = len(header_cols)
+        X = np.zeros((len(rows), len(columns)), dtype=np.float32)
+        for i, (header_json, vector, dim) in enumerate(rows):
+            header = json.loads(header_json)
+            X[i, :n_header] = [header.get(c, np.nan) for c in header_cols]
+            if vector is not None:
+                decode_vector(vector, dim, out=X[i, n_header:])
+        return pd.DataFrame(X, columns=list(columns), copy=False)
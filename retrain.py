@@ -0,0 +1,204 @@
+"""
+Reentrenamiento del clasificador para SpamSense AI
+Reajusta la cabeza sklearn con features y embeddings almacenados y etiquetas corregidas, sin re-embeber
+"""
+
+import argparse
+import copy
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.metrics import accuracy_score, brier_score_loss, f1_score, precision_score, recall_score, roc_auc_score
+from sklearn.model_selection import train_test_split
+
+from attachmentScan import ATTACHMENT_COLUMNS
+from modelAssets import MODEL_PATH, SpamClassifier, load_bundle, model_version, save_bundle
+
+VERSIONS_DIR = os.path.join(os.path.dirname(MODEL_PATH), "versions")
+MODES = ("auto", "refit", "extend", "partial")
+PARTIAL_BATCH = 256
+
+
+def pick_mode(estimator, mode="auto"):
+    """
+    auto: partial_fit for incremental estimators, extra trees for warm-startable ensembles,
+    a full refit otherwise.
+    """
+    if mode != "auto":
+        return mode
+    if hasattr(estimator, "partial_fit"):
+        return "partial"
+    if "warm_start" in estimator.get_params() and "n_estimators" in estimator.get_params():
+        return "extend"
+    return "refit"
+
+
+def fit_candidate(estimator, X, y, mode, add_trees=20, epochs=5, seed=42):
+    """
+    New estimator trained from `estimator` on (X, y); the original is left untouched.
+    refit: same hyperparameters, trained from scratch.
+    extend: the existing trees are kept and add_trees new ones are grown on the new labels.
+    partial: partial_fit over shuffled mini-batches, continuing from the current weights.
+    """
+    if mode == "refit":
+        return clone(estimator).fit(X, y)
+    candidate = copy.deepcopy(estimator)
+    if mode == "extend":
+        if "warm_start" not in candidate.get_params():
+            raise ValueError(f"{type(estimator).__name__} cannot be extended; use --mode refit")
+        candidate.set_params(warm_start=True, n_estimators=candidate.n_estimators + add_trees)
+        candidate.fit(X, y)
+        return candidate.set_params(warm_start=False)
+    if mode == "partial":
+        if not hasattr(candidate, "partial_fit"):
+            raise ValueError(f"{type(estimator).__name__} has no partial_fit; use --mode refit")
+        rng = np.random.default_rng(seed)
+        for _ in range(epochs):
+            order = rng.permutation(len(y))
+            for start in range(0, len(order), PARTIAL_BATCH):
+                idx = order[start:start + PARTIAL_BATCH]
+                candidate.partial_fit(X.iloc[idx], y[idx], classes=np.array([0, 1]))
+        return candidate
+    raise ValueError(f"Unknown retraining mode: {mode}")
+
+
+def holdout_metrics(model, X, y):
+    """Decision metrics at the bundle's own threshold, plus ranking and probability quality."""
+    proba = model.spam_proba(X)
+    pred = model.predict(X)
+    return {
+        "accuracy": accuracy_score(y, pred),
+        "precision": precision_score(y, pred, zero_division=0),
+        "recall": recall_score(y, pred, zero_division=0),
+        "f1": f1_score(y, pred, zero_division=0),
+        "roc_auc": roc_auc_score(y, proba) if len(np.unique(y)) == 2 else float("nan"),
+        "brier": brier_score_loss(y, proba)
+    }
+
+
+def version_path(bundle, versions_dir=VERSIONS_DIR):
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    return os.path.join(versions_dir, f"spam_model_{stamp}_{bundle.metadata['mode']}.pkl")
+
+
+def list_versions(versions_dir=VERSIONS_DIR):
+    """Saved artifacts with their training metadata, newest first."""
+    if not os.path.isdir(versions_dir):
+        return pd.DataFrame()
+    rows = []
+    for name in sorted(os.listdir(versions_dir), reverse=True):
+        if name.endswith(".pkl"):
+            meta = load_bundle(os.path.join(versions_dir, name)).metadata
+            rows.append({"artifact": name, "mode": meta.get("mode"), "trained_on": meta.get("trained_on"),
+                         "holdout_f1": meta.get("holdout", {}).get("f1"), "parent": meta.get("parent")})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrain the spam classifier from stored features and labels.")
+    parser.add_argument("--labels", help="CSV of analyst labels to import first (same format as calibration.py)")
+    parser.add_argument("--mode", choices=MODES, default="auto")
+    parser.add_argument("--add-trees", type=int, default=20, help="Trees grown on the new labels (extend)")
+    parser.add_argument("--epochs", type=int, default=5, help="Passes over the labels (partial)")
+    parser.add_argument("--attachments", action="store_true",
+                        help="Add the attachment counts as model inputs (implies --mode refit)")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Fraction of labels kept for evaluation")
+    parser.add_argument("--calibration-split", type=float, default=0.25,
+                        help="Fraction of the training labels kept to calibrate the candidate and tune its threshold")
+    parser.add_argument("--method", choices=["isotonic", "platt", "none"], default="isotonic",
+                        help="Calibration method for the candidate (same as calibration.py)")
+    parser.add_argument("--max-fpr", type=float, help="Highest acceptable false-positive rate for the threshold")
+    parser.add_argument("--min-precision", type=float, help="Lowest acceptable spam precision for the threshold")
+    parser.add_argument("--max-f1-drop", type=float, default=0.0,
+                        help="Largest holdout F1 loss against the current model that still promotes")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--versions-dir", default=VERSIONS_DIR)
+    parser.add_argument("--force", action="store_true", help="Promote even if the holdout check fails")
+    parser.add_argument("--dry-run", action="store_true", help="Train and evaluate, save nothing")
+    parser.add_argument("--promote", help="Make a saved version the live model (rollback) and exit")
+    parser.add_argument("--list", action="store_true", help="List saved versions and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        print(list_versions(args.versions_dir).to_string(index=False))
+        return
+    if args.promote:
+        save_bundle(load_bundle(args.promote), args.model)
+        print(f"{args.promote} promoted to {args.model} (version {model_version(args.model)})")
+        return
+
+    from calibration import read_label_csv
+    from resultStore import ResultStore
+
+    store = ResultStore()
+    if args.labels:
+        store.set_labels(read_label_csv(store, args.labels))
+
+    current = load_bundle(args.model)
+    columns = list(current.feature_names_in_)
+    if args.attachments and "attachment_count" not in columns:
+        # Same layout EmailProcessor(attachments=True) produces: counts between headers and embedding
+        first_emb = next(i for i, c in enumerate(columns) if c.startswith("emb_"))
+        columns = columns[:first_emb] + ATTACHMENT_COLUMNS + columns[first_emb:]
+        args.mode = "refit"
+    _, X, y = store.labeled_matrix(columns)
+    complete = ~X.isna().any(axis=1).to_numpy()
+    if not complete.all():
+        print(f"Skipping {int((~complete).sum())} labeled emails stored before these features existed.")
+        X, y = X[complete].reset_index(drop=True), y[complete]
+    if len(y) == 0:
+        raise SystemExit("No labeled emails with stored features. Import labels with --labels first.")
+    if np.bincount(y, minlength=2).min() < 3:
+        raise SystemExit("Need at least three labeled emails of each class (train, calibration and holdout).")
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=args.holdout, stratify=y,
+                                                        random_state=args.seed)
+    # Scores on the estimator's own training rows are overconfident, so calibration gets its own slice
+    X_fit, X_cal, y_fit, y_cal = train_test_split(X_train, y_train, test_size=args.calibration_split,
+                                                  stratify=y_train, random_state=args.seed)
+
+    mode = pick_mode(current.estimator, args.mode)
+    started = time.perf_counter()
+    estimator = fit_candidate(current.estimator, X_fit, y_fit, mode, args.add_trees, args.epochs, args.seed)
+    seconds = time.perf_counter() - started
+
+    # The old calibrator was fit on the old estimator's scores, so the candidate gets its own before the
+    # gate: both sides are then judged as deployed, each with its calibrator and tuned threshold
+    from calibration import fit_calibration
+    calibrator, threshold, _ = fit_calibration(SpamClassifier(estimator).spam_proba(X_cal), y_cal, args.method,
+                                               args.max_fpr, args.min_precision)
+    candidate = SpamClassifier(estimator, calibrator, threshold)
+    metrics = holdout_metrics(candidate, X_test, y_test)
+    baseline = holdout_metrics(current, X_test[list(current.feature_names_in_)], y_test)
+    print(f"{len(y)} labeled emails ({int(y.sum())} spam): {len(y_fit)} train, {len(y_cal)} calibration, "
+          f"{len(y_test)} holdout; mode={mode}, trained in {seconds:.1f}s")
+    print(f"candidate: calibration={args.method} threshold={threshold:.4f}; "
+          f"current: threshold={current.threshold:.4f}")
+    print(pd.DataFrame({"current": baseline, "candidate": metrics}).round(4).to_string())
+
+    bundle = SpamClassifier(estimator, calibrator, threshold, metadata={
+        "mode": mode, "parent": model_version(args.model), "trained_on": len(y_fit),
+        "calibration": args.method, "calibrated_on": len(y_cal),
+        "holdout": {k: float(v) for k, v in metrics.items()}, "holdout_size": len(y_test),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds")
+    })
+    if args.dry_run:
+        return
+    os.makedirs(args.versions_dir, exist_ok=True)
+    path = version_path(bundle, args.versions_dir)
+    save_bundle(bundle, path)
+    print(f"Saved {path}")
+
+    if metrics["f1"] < baseline["f1"] - args.max_f1_drop and not args.force:
+        raise SystemExit(f"Not promoted: holdout F1 {metrics['f1']:.4f} < current {baseline['f1']:.4f}. "
+                         f"Use --promote {path} to promote it anyway.")
+    save_bundle(bundle, args.model)
+    print(f"Promoted to {args.model} (version {model_version(args.model)}); the app and workers reload it.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Reputación de remitentes para SpamSense AI
+Índice incremental por dominio remitente e IP de origen: conteos, ratio de spam con decaimiento exponencial y prefiltro
+"""
+
+import argparse
+import functools
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from linkAnalysis import default_link_analyzer
+
+DEFAULT_REPUTATION_PATH = os.environ.get("SPAMSENSE_REPUTATION_DB", "data/reputation.db")
+HALF_LIFE_DAYS = float(os.environ.get("SPAMSENSE_REPUTATION_HALF_LIFE_DAYS", "30"))
+# Recent spam ratio from which a known sender skips the embedding and the model (unset: off)
+PREFILTER_RATIO = float(os.environ.get("SPAMSENSE_REPUTATION_PREFILTER", "0") or 0) or None
+PREFILTER_MIN_EMAILS = int(os.environ.get("SPAMSENSE_REPUTATION_MIN_EMAILS", "20"))
+
+KINDS = ("domain", "ip")
+REPUTATION_COLUMNS = ["sender_emails", "sender_spam_ratio", "sender_recent_spam_ratio", "sender_recent_volume",
+                      "sender_days_known", "ip_emails", "ip_spam_ratio", "ip_recent_spam_ratio"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reputation (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    emails INTEGER NOT NULL,
+    spam INTEGER NOT NULL,
+    weight REAL NOT NULL,
+    spam_weight REAL NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS seen (
+    digest BLOB PRIMARY KEY
+) WITHOUT ROWID;
+"""
+
+# weight and spam_weight are exponentially decayed counts as of last_seen. An observation
+# older than last_seen is decayed itself instead, so arrival order does not matter.
+_UPSERT = """
+INSERT INTO reputation VALUES (:kind, :key, 1, :spam, 1.0, :spam, :at, :at)
+ON CONFLICT (kind, key) DO UPDATE SET
+    emails = emails + 1,
+    spam = spam + excluded.spam,
+    weight = CASE WHEN excluded.last_seen >= last_seen
+        THEN weight * decay(excluded.last_seen - last_seen) + 1
+        ELSE weight + decay(last_seen - excluded.last_seen) END,
+    spam_weight = CASE WHEN excluded.last_seen >= last_seen
+        THEN spam_weight * decay(excluded.last_seen - last_seen) + excluded.spam
+        ELSE spam_weight + excluded.spam * decay(last_seen - excluded.last_seen) END,
+    first_seen = MIN(first_seen, excluded.first_seen),
+    last_seen = MAX(last_seen, excluded.last_seen)
+"""
+
+
+def sender_key(kind, value):
+    """Index key: the registrable domain for senders (mail.x.co.uk -> x.co.uk), the address for IPs."""
+    if not value:
+        return None
+    value = value.lower()
+    return default_link_analyzer().registrable_domain(value) if kind == "domain" else value
+
+
+class ReputationIndex:
+    """
+    ReputationIndex Class:
+    1. Keeps one row per sender domain and per origin IP in SQLite (WITHOUT ROWID, a few dozen bytes each).
+    2. Folds every scored email in with one upsert per key: O(1), and each email counts once.
+    3. Reads back history as REPUTATION_COLUMNS features and flags repeat offenders for the pre-filter.
+    """
+    def __init__(self, path=DEFAULT_REPUTATION_PATH, half_life_days=HALF_LIFE_DAYS):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.half_life = half_life_days * 86400
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        self.__conn.create_function("decay", 1, self.decay, deterministic=True)
+        self.__conn.executescript(_SCHEMA)
+        self.__conn.commit()
+
+    def decay(self, seconds):
+        """Weight left after `seconds` (halved every half-life)."""
+        return math.pow(0.5, seconds / self.half_life)
+
+    def update(self, observations):
+        """
+        observations: iterable of (content_hash, sender domain, origin IP, is_spam, unix time).
+        Emails already folded in (same content hash) are skipped. Returns how many were new.
+        """
+        added = 0
+        with self.__lock, self.__conn:
+            for content_hash, domain, ip, is_spam, at in observations:
+                digest = hashlib.blake2b(content_hash.encode("ascii"), digest_size=12).digest()
+                if self.__conn.execute("INSERT OR IGNORE INTO seen VALUES (?)", (digest,)).rowcount == 0:
+                    continue
+                added += 1
+                for kind, value in (("domain", domain), ("ip", ip)):
+                    key = sender_key(kind, value)
+                    if key:
+                        self.__conn.execute(_UPSERT, {"kind": kind, "key": key, "spam": int(bool(is_spam)),
+                                                      "at": float(at)})
+        return added
+
+    def stats(self, kind, keys):
+        """{key: row dict} for the known senders (domains or IPs) among `keys`, by sender_key."""
+        keys = sorted({sender_key(kind, k) for k in keys} - {None})
+        if not keys:
+            return {}
+        rows = []
+        with self.__lock:
+            # Bounded IN lists keep every query on the primary key
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows += self.__conn.execute(
+                    "SELECT key, emails, spam, weight, spam_weight, first_seen, last_seen FROM reputation "
+                    f"WHERE kind = ? AND key IN ({','.join('?' * len(part))})", (kind, *part)
+                ).fetchall()
+        return {r[0]: dict(zip(("emails", "spam", "weight", "spam_weight", "first_seen", "last_seen"), r[1:]))
+                for r in rows}
+
+    def features(self, domains, ips, now=None):
+        """
+        REPUTATION_COLUMNS for each (sender domain, origin IP) pair, as of `now`.
+        Unknown senders have 0 emails and NaN ratios. Read these before update() so an
+        email's own verdict does not leak into its features.
+        """
+        now = time.time() if now is None else now
+        by_domain, by_ip = self.stats("domain", domains), self.stats("ip", ips)
+        out = np.full((len(domains), len(REPUTATION_COLUMNS)), np.nan)
+        out[:, [0, 5]] = 0
+        for i, (domain, ip) in enumerate(zip(domains, ips)):
+            d = by_domain.get(sender_key("domain", domain))
+            if d:
+                out[i, :5] = (d["emails"], d["spam"] / d["emails"], d["spam_weight"] / d["weight"],
+                              d["weight"] * self.decay(max(now - d["last_seen"], 0)), (now - d["first_seen"]) / 86400)
+            r = by_ip.get(sender_key("ip", ip))
+            if r:
+                out[i, 5:] = (r["emails"], r["spam"] / r["emails"], r["spam_weight"] / r["weight"])
+        return pd.DataFrame(out, columns=REPUTATION_COLUMNS)
+
+    @staticmethod
+    def offenders(features, min_ratio=PREFILTER_RATIO, min_emails=PREFILTER_MIN_EMAILS):
+        """
+        (mask, score) over a features() frame: rows whose sender domain or origin IP has at least
+        min_emails emails and a recent spam ratio >= min_ratio. score is the higher recent ratio.
+        """
+        if not min_ratio:
+            return np.zeros(len(features), dtype=bool), np.zeros(len(features))
+        domain = np.where(features["sender_emails"] >= min_emails, features["sender_recent_spam_ratio"], 0)
+        ip = np.where(features["ip_emails"] >= min_emails, features["ip_recent_spam_ratio"], 0)
+        score = np.fmax(np.nan_to_num(domain), np.nan_to_num(ip))
+        return score >= min_ratio, score
+
+    def top(self, kind="domain", limit=20, min_emails=5):
+        """Senders with the highest recent spam ratio among those with min_emails or more."""
+        with self.__lock:
+            df = pd.read_sql_query(
+                "SELECT key, emails, spam, spam_weight / weight AS recent_spam_ratio, first_seen, last_seen "
+                "FROM reputation WHERE kind = ? AND emails >= ? "
+                "ORDER BY recent_spam_ratio DESC, emails DESC LIMIT ?",
+                self.__conn, params=(kind, min_emails, limit)
+            )
+        for col in ("first_seen", "last_seen"):
+            df[col] = pd.to_datetime(df[col], unit="s")
+        return df
+
+    def rebuild(self, store):
+        """Recomputes the index from the model verdicts in a ResultStore (in scoring order, pre-filtered ones excluded)."""
+        with self.__lock, self.__conn:
+            self.__conn.execute("DELETE FROM reputation")
+            self.__conn.execute("DELETE FROM seen")
+        return self.update(store.scored_history())
+
+
+@functools.lru_cache(maxsize=1)
+def default_reputation_index():
+    """Process-wide index over SPAMSENSE_REPUTATION_DB."""
+    return ReputationIndex()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or rebuild the sender reputation index.")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild from the results already stored")
+    parser.add_argument("--top", choices=KINDS, help="List the senders with the highest recent spam ratio")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--min-emails", type=int, default=5)
+    args = parser.parse_args()
+
+    index = default_reputation_index()
+    if args.rebuild:
+        from resultStore import ResultStore
+        print(f"{index.rebuild(ResultStore())} emails folded into {index.path}")
+    if args.top:
+        print(index.top(args.top, args.limit, args.min_emails).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,25 @@
+import contextlib
+import os
+import threading
+import uuid
 import streamlit as st
-import joblib
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import re
-import requests
 from datetime import datetime, timezone
-from sentence_transformers import SentenceTransformer
 from emailProcessor import EmailProcessor
+from resultStore import ResultStore
+from resultCache import ResultCache, normalize_raw, result_key
+from modelAssets import load_bundle, load_embedding_model, model_stamp, model_version, EMBEDDING_MODEL, MODEL_PATH
+from batchPipeline import BatchPipeline
+from featureExport import export_bytes
+from analysis import analyze_email, domain_age
+from senderReputation import default_reputation_index, sender_key
+from enrichment import make_enrichment
+from featureAttribution import FeatureAttributor
+from jobQueue import JobQueue, run_worker, QUEUED, RUNNING, DONE, CANCELLED
+from pipelineProfiler import Profiler, ProfileReport, profile_path, STAGE_COLORS
 
 # Importar módulos de estilos y componentes
 from styles import COLORS, apply_custom_styles
@@ -25,61 +37,88 @@ apply_custom_styles()
 
 # ───────────────── MODELS ─────────────────
 @st.cache_resource
-def load_assets():
-    spam_model = joblib.load("model/spam_model.pkl")
-    emb_model = SentenceTransformer(
-        "all-mpnet-base-v2",
-        cache_folder="./model_cache"
-    )
-    return spam_model, emb_model
+def load_embedder():
+    return load_embedding_model()
 
-spam_model, emb_model = load_assets()
-processor = EmailProcessor(emb_model)
+# Keyed by the artifact's stamp: a bundle promoted by retrain.py is loaded on the next rerun
+@st.cache_resource(max_entries=1)
+def load_classifier(stamp):
+    return load_bundle(MODEL_PATH), model_version(MODEL_PATH)
 
-# ───────────────── IP FUNCTIONS ─────────────────
-def extract_forensics(raw_text):
-    """Extracts IP, URLs and Domain from remitter."""
-    ip_match = re.search(r'Received: from .*? \[(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\]', raw_text)
-    ip = ip_match.group(1) if ip_match else None
-    urls = list(set(re.findall(r'https?://[^\s<>"]+|www\.[^\s<>"]+', raw_text)))
-    
-    domain = None
-    from_match = re.search(r'From:.*@([a-zA-Z0-9.-]+\.[a-zA-Z]{2,})', raw_text)
-    if from_match:
-        domain = from_match.group(1)
-    return ip, urls, domain
+@st.cache_resource
+def load_result_store():
+    return ResultStore()
+
+@st.cache_resource
+def load_enrichment():
+    return make_enrichment()
+
+@st.cache_resource
+def load_reputation_index():
+    return default_reputation_index()
+
+# Shared by every session of this process; keys include the model version
+@st.cache_resource
+def load_result_cache():
+    return ResultCache()
+
+@st.cache_resource(max_entries=1)
+def load_attributor(columns, stamp):
+    spam_model, _ = load_classifier(stamp)
+    return FeatureAttributor(spam_model, columns)
+
+MODEL_STAMP = model_stamp(MODEL_PATH)
+spam_model, MODEL_VERSION = load_classifier(MODEL_STAMP)
+emb_model = load_embedder()
+processor = EmailProcessor(emb_model).for_model(spam_model)
+attributor = load_attributor(tuple(processor.columns), MODEL_STAMP)
+result_store = load_result_store()
+result_cache = load_result_cache()
+reputation_index = load_reputation_index()
+enrichment = load_enrichment()
+if enrichment.name == "offline":
+    enrichment.refresh()  # picks up refreshed tables without a restart
+if st.session_state.setdefault("model_version", MODEL_VERSION) != MODEL_VERSION:
+    st.session_state["model_version"] = MODEL_VERSION
+    st.toast(f"Model updated to version {MODEL_VERSION}", icon="🔄")
+
+# ───────────────── JOB QUEUE ─────────────────
+# Batch reports run in workers (python jobQueue.py); the app can also host some in-process
+INLINE_WORKERS = int(os.environ.get("SPAMSENSE_INLINE_WORKERS", "1"))
+JOB_POLL_SECONDS = 2
 
-@st.cache_data
+@st.cache_resource
+def load_job_queue():
+    return JobQueue()
+
+@st.cache_resource
+def start_inline_workers(n):
+    # Workers reload a retrained classifier on their own, between jobs
+    spam_model, version = load_classifier(model_stamp(MODEL_PATH))
+    inline_processor = EmailProcessor(load_embedder()).for_model(spam_model)
+    pipeline = BatchPipeline(inline_processor, spam_model, load_result_store(), version, EMBEDDING_MODEL,
+                             attributor=FeatureAttributor(spam_model, inline_processor.columns), model_path=MODEL_PATH)
+    threads = [threading.Thread(target=run_worker, kwargs={"pipeline": pipeline}, daemon=True) for _ in range(n)]
+    for t in threads:
+        t.start()
+    return threads
+
+job_queue = load_job_queue()
+if INLINE_WORKERS > 0:
+    start_inline_workers(INLINE_WORKERS)
+session_owner = st.session_state.setdefault("session_owner", uuid.uuid4().hex)
+
+# ───────────────── IP FUNCTIONS ─────────────────
 def get_domain_age_rdap(domain):
     """Checks domain age."""
-    if not domain: return "N/A"
-    try:
-        response = requests.get(f"https://rdap.net/domain/{domain}", timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            events = data.get("events", [])
-            for event in events:
-                if event.get("eventAction") == "registration":
-                    date_str = event.get("eventDate")
-                    creation_date = datetime.fromisoformat(date_str.replace("Z", "+00:00"))
-                    age = datetime.now(timezone.utc) - creation_date
-                    years = age.days // 365
-                    days = age.days % 365
-                    return f"{years}a, {days}d"
-        return "Unknown"
-    except:
-        return "Error RDAP"
-
-@st.cache_data
+    return domain_age(enrichment, domain)
+
 def get_geo_info(ip):
-    if not ip: return None
-    try:
-        res = requests.get(f"http://ip-api.com/json/{ip}?fields=status,country,city,lat,lon,isp", timeout=5)
-        return res.json() if res.json().get("status") == "success" else None
-    except: return None
+    return enrichment.geo(ip)
 
 # ───────────────── IP COMPONENTS ─────────────────
-def render_forensic_section(df_results):
+def render_forensic_section(df_results, attachments=None, lookups=None):
+    """lookups: precomputed {"geo": {ip: geo}, "age": {domain: age}} (cached single results)."""
     st.subheader("🌐 Forensic Analysis")
     
     # --- IP Process ---
@@ -88,7 +127,7 @@ def render_forensic_section(df_results):
     detected_cities = []
     
     for ip in ips:
-        geo = get_geo_info(ip)
+        geo = lookups["geo"].get(ip) if lookups else get_geo_info(ip)
         if geo:
             map_points.append({"lat": geo["lat"], "lon": geo["lon"], "IP": ip})
             detected_cities.append(f"{geo['city']} ({geo['country']})")
@@ -116,6 +155,30 @@ def render_forensic_section(df_results):
             st.dataframe(url_counts, hide_index=True, width='stretch')
         else:
             st.success("No links found in message body.")
+        if "link_count" in df_results and df_results["link_count"].sum() > 0:
+            st.caption(f"🔗 {df_results['link_count'].sum():.0f} links · "
+                       f"{df_results['distinct_link_domains'].sum():.0f} link domains · "
+                       f"off-domain {df_results['offdomain_link_ratio'].mean():.0%} · "
+                       f"IP-literal {df_results['ip_links'].sum():.0f} · "
+                       f"shorteners {df_results['shortener_links'].sum():.0f} · "
+                       f"blocklisted {df_results['blocklisted_links'].sum():.0f}")
+
+    # --- Attachments: per-file detail for a single email, counts for a batch ---
+    if attachments:
+        st.write("**Attachments**")
+        flags = ["double_extension", "macro_capable", "executable", "type_mismatch", "known_bad"]
+        st.dataframe(pd.DataFrame([{
+            "File": a.filename or "(unnamed)", "Declared": a.declared_type, "Sniffed": a.sniffed_type,
+            "Size": a.size, "SHA-256": a.sha256,
+            "Flags": ", ".join(f.replace("_", " ") for f in flags if getattr(a, f)) or "—"
+        } for a in attachments]), hide_index=True, width='stretch')
+    elif "attachment_count" in df_results and df_results["attachment_count"].sum() > 0:
+        st.caption(f"📎 {df_results['attachment_count'].sum():.0f} attachments · "
+                   f"double extension {df_results['double_extension_attachments'].sum():.0f} · "
+                   f"macro-capable {df_results['macro_attachments'].sum():.0f} · "
+                   f"executable {df_results['executable_attachments'].sum():.0f} · "
+                   f"type mismatch {df_results['type_mismatch_attachments'].sum():.0f} · "
+                   f"known bad {df_results['known_bad_attachments'].sum():.0f}")
 
     st.divider()
 
@@ -125,11 +188,17 @@ def render_forensic_section(df_results):
     
     if len(domains) > 0:
         d_cols = st.columns(min(len(domains), 3))
+        history = reputation_index.stats("domain", domains[:6])
         for i, dom in enumerate(domains):
             if i < 6: 
                 with d_cols[i % 3]:
-                    age = get_domain_age_rdap(dom)
-                    st.code(f"Domain: {dom}\nAge: {age}")
+                    age = lookups["age"].get(dom) if lookups else get_domain_age_rdap(dom)
+                    seen = history.get(sender_key("domain", dom))
+                    record = (f"{seen['emails']} emails, {seen['spam'] / seen['emails']:.0%} spam "
+                              f"(recent {seen['spam_weight'] / seen['weight']:.0%}), since "
+                              f"{datetime.fromtimestamp(seen['first_seen'], timezone.utc):%Y-%m-%d}"
+                              if seen else "not seen before")
+                    st.code(f"Domain: {dom}\nAge: {age}\nHistory: {record}")
         if len(domains) > 6:
             st.caption(f"Y {len(domains)-6} most used domains.")
     else:
@@ -139,16 +208,182 @@ def render_forensic_section(df_results):
 
 
 
+# ───────────────── SINGLE EMAIL RESULTS ─────────────────
+def analyze_single(text):
+    """Everything the single-email tab renders, computed once per message and model version."""
+    return analyze_email(text, processor, spam_model, enrichment, attributor)
+
+def render_cache_stats():
+    stats = result_cache.stats()
+    lookups = stats.hits + stats.misses
+    st.markdown("<h3>⚡ Result Cache</h3>", unsafe_allow_html=True)
+    st.caption(f"Hit rate {stats.hits / lookups:.0%} ({stats.hits}/{lookups}) · "
+               f"{stats.size}/{stats.capacity} emails cached · {stats.evictions} evicted"
+               if lookups else f"No single-email lookups yet · capacity {stats.capacity} emails")
+
+# ───────────────── STORED REPORTS ─────────────────
+def load_stored_report(batch_id):
+    """(results, feature means, features, attributions) of a stored batch, or None if empty."""
+    results, features = result_store.load_batch(batch_id)
+    if results.empty:
+        return None
+    header_cols = [c for c in features.columns if not c.startswith("emb_")]
+    attributions = result_store.load_batch_attributions(batch_id)
+    return results, features[header_cols].mean(), features, attributions if attributions.notna().all().all() else None
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_job_status(job_id):
+    """Polls a queued batch job; when it finishes the report is loaded and the page reruns."""
+    job = job_queue.status(job_id)
+    if job is None:
+        st.session_state.pop("batch_job", None)
+        return
+    if job["status"] in (QUEUED, RUNNING):
+        total = max(job["total"], 1)
+        if job["status"] == QUEUED:
+            st.info(f"⏳ Report #{job_id} queued ({job['total']} emails)")
+            if not job_queue.workers_alive():
+                st.caption("No batch workers are running. Start them with `python jobQueue.py --workers 2`.")
+        else:
+            st.progress(job["done"] / total)
+            st.text(f"Processing {job['done']}/{job['total']}: {job['current'] or ''}")
+        if job["profile"]:
+            st.caption("🔬 Profiling this run")
+        if st.button("✖ Cancel Report", key=f"cancel_{job_id}"):
+            job_queue.cancel(job_id)
+            st.rerun()
+        return
+
+    # Finished: hand over to the full page so the dashboard renders outside the fragment
+    st.session_state.pop("batch_job", None)
+    st.query_params.pop("job", None)
+    report = load_stored_report(job["batch_id"]) if job["status"] == DONE and job["batch_id"] is not None else None
+    if report is not None:
+        st.session_state["batch_report"] = report
+        st.session_state.pop("batch_profile", None)
+        if job["profile"]:
+            st.session_state["batch_profile_job"] = job_id  # the next dashboard render is profiled too
+    st.session_state["batch_notice"] = (job, report is not None)
+    st.rerun()
+
+# ───────────────── PROFILING ─────────────────
+PROFILE_TOP_N = 20
+
+def load_batch_profile(job_id, render_profile):
+    """The worker's profile of a job merged with the profile of its first dashboard render."""
+    path = profile_path(job_id)
+    if not os.path.exists(path):
+        return render_profile
+    return ProfileReport.load(path).merge(render_profile)
+
+def render_profile(profile):
+    st.divider()
+    st.subheader("🔬 Performance Profile")
+    st.caption(f"{profile.label} · {profile.duration:.2f}s wall clock · {profile.samples} stack samples. "
+               "Time in C extensions (regex, torch, sklearn) is charged to the Python function calling them.")
+    stages = profile.stages()
+    fig = px.bar(stages[::-1], x="seconds", y="stage", orientation="h", color="stage",
+                 color_discrete_map=STAGE_COLORS, custom_data=["share"])
+    fig.update_traces(hovertemplate="<b>%{y}</b><br>%{x:.3f}s (%{customdata[0]:.1%})<extra></extra>")
+    fig.update_layout(showlegend=False, height=60 + 28 * len(stages), paper_bgcolor='white', plot_bgcolor='white',
+                      margin=dict(l=20, r=20, t=20, b=40), xaxis=dict(title="Seconds", gridcolor='#E2E8F0'),
+                      yaxis=dict(title=None))
+    st.plotly_chart(fig, use_container_width=True)
+
+    top = profile.top(PROFILE_TOP_N)
+    st.dataframe(top, use_container_width=True, hide_index=True, column_config={
+        "self_share": st.column_config.NumberColumn("self %", format="percent"),
+        "total_share": st.column_config.NumberColumn("total %", format="percent"),
+        "self_s": st.column_config.NumberColumn("self (s)", format="%.3f"),
+        "total_s": st.column_config.NumberColumn("total (s)", format="%.3f"),
+    })
+
+    stamp = datetime.now().strftime("%Y%m%d_%H%M")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.download_button("🔥 Flame Graph (SVG)", profile.flame_svg(), f"spamsense_profile_{stamp}.svg",
+                           "image/svg+xml", use_container_width=True)
+    with col2:
+        st.download_button("📄 Folded Stacks", profile.folded(), f"spamsense_profile_{stamp}.folded",
+                           "text/plain", use_container_width=True)
+    with col3:
+        st.download_button("📊 Hot Functions (CSV)", top.to_csv(index=False).encode("utf-8"),
+                           f"spamsense_profile_{stamp}_top.csv", "text/csv", use_container_width=True)
+
+# ───────────────── EXPLANATIONS ─────────────────
+ATTRIBUTION_TOP_N = 8
+
+def render_attribution_chart(contributions, title):
+    """Horizontal bars of the largest contributions; positive pushes towards SPAM."""
+    top = contributions.reindex(contributions.abs().sort_values(ascending=False).index[:ATTRIBUTION_TOP_N])[::-1]
+    fig = go.Figure(go.Bar(
+        x=top.values,
+        y=top.index,
+        orientation='h',
+        marker_color=[COLORS["SPAM"] if v > 0 else COLORS["HAM"] for v in top.values],
+        hovertemplate='<b>%{y}</b><br>Contribution: %{x:+.3f}<extra></extra>'
+    ))
+    fig.update_layout(
+        title=dict(text=f"<b>{title}</b>", font=dict(size=16, color='#1E293B', family='Inter')),
+        xaxis=dict(
+            title=dict(text=f"<b>Contribution to P(spam) ({attributor.units})</b>", font=dict(size=13, color='#1E293B')),
+            tickfont=dict(size=11, color='#334155'),
+            gridcolor='#E2E8F0',
+            zeroline=True
+        ),
+        yaxis=dict(tickfont=dict(size=11, color='#334155')),
+        height=320,
+        paper_bgcolor='white',
+        plot_bgcolor='white',
+        margin=dict(l=20, r=20, t=40, b=40)
+    )
+    st.plotly_chart(fig, use_container_width=True)
+
+def render_explanations(batch_df, attributions):
+    st.markdown("### 🧭 Why These Verdicts")
+    st.caption(f"Method: {attributor.method} · red pushes towards SPAM, green towards HAM")
+    col1, col2 = st.columns(2)
+
+    with col1:
+        spam_rows = (batch_df["label"] == "SPAM").to_numpy()
+        scope = attributions[spam_rows] if spam_rows.any() else attributions
+        render_attribution_chart(scope.mean(), "Average Contribution (SPAM verdicts)")
+
+    with col2:
+        if len(batch_df) <= LARGE_BATCH_THRESHOLD:
+            row = st.selectbox("Explain email", range(len(batch_df)), format_func=lambda i: batch_df["name"].iloc[i])
+        else:
+            row = st.number_input("Explain email (row)", min_value=0, max_value=len(batch_df) - 1, value=0, step=1)
+        render_attribution_chart(attributions.iloc[row], f"{batch_df['name'].iloc[row]} → {batch_df['label'].iloc[row]}")
+
+    st.markdown("---")
+
 # ───────────────── DASHBOARD ─────────────────
-def render_dashboard(batch_df, features_df):
+# Above this many emails the dashboard switches to pre-binned / WebGL charts
+LARGE_BATCH_THRESHOLD = 2000
+HISTOGRAM_BINS = 20
+TABLE_PAGE_SIZE = 100
+LABEL_COLORS = {"SPAM": COLORS["SPAM"], "HAM": COLORS["HAM"]}
+
+def summarize_batch(batch_df):
+    """One groupby over the results: per-label confidence stats (describe() columns) and the row groups."""
+    grouped = batch_df.groupby("label", sort=True)
+    quartiles = {f"{q:.0%}": (lambda s, q=q: s.quantile(q)) for q in (0.25, 0.5, 0.75)}
+    stats = grouped["confidence"].agg(count="count", mean="mean", std="std", min="min", **quartiles, max="max")
+    return stats, dict(list(grouped))
+
+def render_dashboard(batch_df, feature_means):
     st.markdown("## 📊 Forensic Analysis Dashboard")
     st.markdown("---")
 
+    stats, groups = summarize_batch(batch_df)
+    large = len(batch_df) > LARGE_BATCH_THRESHOLD
+
     # KPIs
     total = len(batch_df)
-    spam = (batch_df["label"] == "SPAM").sum()
+    spam = int(stats["count"].get("SPAM", 0))
     ham = total - spam
-    avg_conf = batch_df["confidence"].mean()
+    avg_conf = (stats["mean"] * stats["count"]).sum() / total if total > 0 else 0
     spam_rate = (spam / total * 100) if total > 0 else 0
 
     col1, col2, col3, col4, col5 = st.columns(5)
@@ -173,10 +408,10 @@ def render_dashboard(batch_df, features_df):
     with col1:
         # Pie chart mejorado
         fig = go.Figure(data=[go.Pie(
-            labels=batch_df['label'].value_counts().index,
-            values=batch_df['label'].value_counts().values,
+            labels=stats.index,
+            values=stats["count"].values,
             hole=0.6,
-            marker=dict(colors=[COLORS["HAM"], COLORS["SPAM"]]),
+            marker=dict(colors=[LABEL_COLORS.get(label, COLORS["PRIMARY"]) for label in stats.index]),
             textinfo='label+percent',
             textfont=dict(size=14, color='white', family='Inter'),
             hovertemplate='<b>%{label}</b><br>Count: %{value}<br>Percentage: %{percent}<extra></extra>'
@@ -198,25 +433,32 @@ def render_dashboard(batch_df, features_df):
     with col2:
         # Histograma de confianza
         fig = go.Figure()
-        
-        spam_data = batch_df[batch_df['label'] == 'SPAM']['confidence']
-        ham_data = batch_df[batch_df['label'] == 'HAM']['confidence']
-        
-        fig.add_trace(go.Histogram(
-            x=spam_data,
-            name='SPAM',
-            marker_color=COLORS["SPAM"],
-            opacity=0.7,
-            nbinsx=20
-        ))
-        
-        fig.add_trace(go.Histogram(
-            x=ham_data,
-            name='HAM',
-            marker_color=COLORS["HAM"],
-            opacity=0.7,
-            nbinsx=20
-        ))
+
+        if large:
+            # Server-side binning: ship bin counts to the browser, not every point
+            edges = np.linspace(stats["min"].min(), stats["max"].max() + 1e-9, HISTOGRAM_BINS + 1)
+            centers = (edges[:-1] + edges[1:]) / 2
+            for label in ("SPAM", "HAM"):
+                if label not in groups:
+                    continue
+                counts, _ = np.histogram(groups[label]["confidence"].to_numpy(), bins=edges)
+                fig.add_trace(go.Bar(
+                    x=centers,
+                    y=counts,
+                    width=np.diff(edges),
+                    name=label,
+                    marker_color=LABEL_COLORS[label],
+                    opacity=0.7
+                ))
+        else:
+            for label in ("SPAM", "HAM"):
+                fig.add_trace(go.Histogram(
+                    x=groups[label]['confidence'] if label in groups else [],
+                    name=label,
+                    marker_color=LABEL_COLORS[label],
+                    opacity=0.7,
+                    nbinsx=HISTOGRAM_BINS
+                ))
         
         fig.update_layout(
             title=dict(
@@ -248,14 +490,21 @@ def render_dashboard(batch_df, features_df):
 
     # Tabla de resultados mejorada
     st.markdown("### 📋 Detailed Results")
-    
-    display_df = batch_df.copy()
+
+    # Only the visible page is formatted and sent to the browser
+    n_pages = max(1, -(-total // TABLE_PAGE_SIZE))
+    page = 1
+    if n_pages > 1:
+        page = st.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1, step=1)
+    start = (page - 1) * TABLE_PAGE_SIZE
+    display_df = batch_df.iloc[start:start + TABLE_PAGE_SIZE].copy()
     display_df['confidence'] = (display_df['confidence'] * 100).round(1).astype(str) + '%'
     display_df = display_df.rename(columns={
         'name': 'Email File',
         'label': 'Classification',
         'confidence': 'Confidence',
-        'subject_length': 'Subject Length'
+        'subject_length': 'Subject Length',
+        'body_tokens': 'Body Tokens'
     })
     
     st.dataframe(
@@ -270,10 +519,23 @@ def render_dashboard(batch_df, features_df):
             "Confidence": st.column_config.TextColumn(
                 "Confidence",
                 help="Model confidence score"
+            ),
+            "Body Tokens": st.column_config.NumberColumn(
+                "Body Tokens",
+                help="Encoder tokens of the normalized body (empty when a stored embedding was reused)",
+                format="%d"
             )
         }
     )
 
+    if "body_tokens" in batch_df.columns and batch_df["body_tokens"].notna().any():
+        body_tokens = batch_df["body_tokens"].dropna()
+        window = getattr(emb_model, "max_seq_length", None)
+        caption = f"Encoder input: median {body_tokens.median():.0f} tokens per body"
+        if window:
+            caption += f", {(body_tokens > window).mean():.1%} truncated at the {window}-token window"
+        st.caption(caption)
+
     st.markdown("---")
 
     # Análisis avanzado
@@ -281,18 +543,29 @@ def render_dashboard(batch_df, features_df):
 
     with col1:
         # Scatter plot mejorado
-        fig = px.scatter(
-            batch_df,
-            x='subject_length',
-            y='confidence',
-            color='label',
-            color_discrete_map={"SPAM": COLORS["SPAM"], "HAM": COLORS["HAM"]},
-            size=[10]*len(batch_df),
-            title="<b>Subject Length vs Confidence</b>"
-        )
-        
+        if large:
+            # WebGL traces keep tens of thousands of points interactive
+            fig = go.Figure()
+            for label, grp in groups.items():
+                fig.add_trace(go.Scattergl(
+                    x=grp['subject_length'],
+                    y=grp['confidence'],
+                    mode='markers',
+                    name=label,
+                    marker=dict(color=LABEL_COLORS.get(label, COLORS["PRIMARY"]), size=5, opacity=0.6)
+                ))
+        else:
+            fig = px.scatter(
+                batch_df,
+                x='subject_length',
+                y='confidence',
+                color='label',
+                color_discrete_map=LABEL_COLORS
+            )
+            fig.update_traces(marker=dict(size=10))
+
         fig.update_layout(
-            title=dict(font=dict(size=18, color='#1E293B', family='Inter')),
+            title=dict(text="<b>Subject Length vs Confidence</b>", font=dict(size=18, color='#1E293B', family='Inter')),
             xaxis=dict(
                 title=dict(text="<b>Subject Length (characters)</b>", font=dict(size=14, color='#1E293B')),
                 tickfont=dict(size=12, color='#334155'),
@@ -318,20 +591,26 @@ def render_dashboard(batch_df, features_df):
     with col2:
         # Box plot de confianza por categoría
         fig = go.Figure()
-        
-        fig.add_trace(go.Box(
-            y=batch_df[batch_df['label'] == 'SPAM']['confidence'],
-            name='SPAM',
-            marker_color=COLORS["SPAM"],
-            boxmean='sd'
-        ))
-        
-        fig.add_trace(go.Box(
-            y=batch_df[batch_df['label'] == 'HAM']['confidence'],
-            name='HAM',
-            marker_color=COLORS["HAM"],
-            boxmean='sd'
-        ))
+
+        for label in ("SPAM", "HAM"):
+            if large and label in stats.index:
+                # Precomputed quartiles from the groupby summary
+                row = stats.loc[label]
+                fig.add_trace(go.Box(
+                    x=[label],
+                    q1=[row["25%"]], median=[row["50%"]], q3=[row["75%"]],
+                    lowerfence=[row["min"]], upperfence=[row["max"]],
+                    mean=[row["mean"]], sd=[0.0 if pd.isna(row["std"]) else row["std"]],
+                    name=label,
+                    marker_color=LABEL_COLORS[label]
+                ))
+            else:
+                fig.add_trace(go.Box(
+                    y=groups[label]['confidence'] if label in groups else [],
+                    name=label,
+                    marker_color=LABEL_COLORS[label],
+                    boxmean='sd'
+                ))
         
         fig.update_layout(
             title=dict(
@@ -365,10 +644,10 @@ def render_dashboard(batch_df, features_df):
     with col1:
         # Anomalías de headers
         anomaly_data = {
-            'Return-Path Mismatch': features_df['from_returnpath_match'].mean(),
-            'Reply-To Differs': features_df['reply_to_differs_from_from'].mean(),
-            'Missing Message-ID': features_df['message_id_missing'].mean(),
-            'Random Message-ID': features_df['message_id_is_random'].mean()
+            'Return-Path Mismatch': feature_means['from_returnpath_match'],
+            'Reply-To Differs': feature_means['reply_to_differs_from_from'],
+            'Missing Message-ID': feature_means['message_id_missing'],
+            'Random Message-ID': feature_means['message_id_is_random']
         }
         
         fig = go.Figure(data=[go.Bar(
@@ -408,10 +687,21 @@ def render_dashboard(batch_df, features_df):
         routing_data = pd.DataFrame({
             'Metric': ['Avg Received Headers', 'Private IP Rate'],
             'Value': [
-                features_df['num_received_headers'].mean(),
-                features_df['received_first_ip_is_private'].mean()
+                feature_means['num_received_headers'],
+                feature_means['received_first_ip_is_private']
             ]
         })
+        if 'hop_count' in batch_df:
+            # Full Received-chain analysis from the batch pipeline
+            chain_data = pd.DataFrame({
+                'Metric': ['Private Hops / Email', 'Bogon Chain Rate', 'Clock-Skew Rate'],
+                'Value': [
+                    batch_df['private_hops'].mean(),
+                    (batch_df['bogon_hops'] > 0).mean(),
+                    (batch_df['time_skew_s'] > 0).mean()
+                ]
+            })
+            routing_data = pd.concat([routing_data, chain_data], ignore_index=True)
         
         fig = go.Figure(data=[go.Bar(
             x=routing_data['Metric'],
@@ -443,14 +733,17 @@ def render_dashboard(batch_df, features_df):
             margin=dict(l=20, r=20, t=40, b=40)
         )
         st.plotly_chart(fig, use_container_width=True)
+        if 'transit_delay_s' in batch_df and batch_df['transit_delay_s'].notna().any():
+            st.caption(f"⏱️ Median transit delay: {batch_df['transit_delay_s'].median():.0f}s · "
+                       f"max clock skew: {batch_df['time_skew_s'].max():.0f}s")
 
     with col3:
         # Content structure
         content_data = pd.DataFrame({
             'Type': ['HTML Content', 'Multipart Content'],
             'Percentage': [
-                features_df['is_html'].mean() * 100,
-                features_df['is_multipart'].mean() * 100
+                feature_means['is_html'] * 100,
+                feature_means['is_multipart'] * 100
             ]
         })
         
@@ -489,6 +782,10 @@ def render_dashboard(batch_df, features_df):
 # Sidebar
 with st.sidebar:
     sidebar_info()
+    cache_stats_slot = st.empty()  # filled after the single-email tab runs
+    st.toggle("🔬 Profile next batch report", key="profile_batch",
+              help="Records where the next report spends its time (worker run and dashboard rendering) "
+                   "and offers a flame graph to download.")
 
 # Hero Banner con imagen
 hero_banner()
@@ -512,33 +809,46 @@ with tab1:
     with col1:
         analyze_btn = st.button("🔍 Analyze Email", use_container_width=True, type="primary")
 
-    if analyze_btn:
-        if not raw.strip():
-            st.warning("⚠️ Please paste email content before analyzing.")
-        else:
-            with st.spinner("🔄 Analyzing email..."):
-                try:
-                    df = processor.transform_raw_email(raw)
-                    pred = spam_model.predict(df)[0]
-                    prob = spam_model.predict_proba(df)[0][pred]
-                    ip, urls, domain = extract_forensics(raw)
-                    single_df = pd.DataFrame([{"ip": ip, "urls": urls, "domain": domain}])
-
-                    label = "SPAM" if pred == 1 else "HAM"
-                    color = COLORS["SPAM"] if pred == 1 else COLORS["HAM"]
-                    
-                    st.markdown("---")
-                    st.markdown(result_card_html(label, prob, color), unsafe_allow_html=True)
+    text = normalize_raw(raw)
+    key = result_key(text, MODEL_VERSION) if text else None
+    # Only a click looks the message up in the shared cache (and counts as a hit or miss); the last
+    # analyzed message stays on screen across reruns from the session's own copy
+    shown = st.session_state.get("single_result")
+    if analyze_btn and not text:
+        st.warning("⚠️ Please paste email content before analyzing.")
+    elif analyze_btn or (key and shown and shown[0] == key):
+        with st.spinner("🔄 Analyzing email..."):
+            try:
+                if analyze_btn:
+                    result, cached = result_cache.get_or_compute(key, lambda: analyze_single(text))
+                    st.session_state["single_result"] = (key, result, cached)
+                else:
+                    _, result, cached = shown
+                df, pred = result["features"], result["pred"]
+
+                label = "SPAM" if pred == 1 else "HAM"
+                color = COLORS["SPAM"] if pred == 1 else COLORS["HAM"]
+                
+                st.markdown("---")
+                st.markdown(result_card_html(label, result["prob"], color), unsafe_allow_html=True)
+                if cached:
+                    st.caption(f"⚡ Cached result (model {MODEL_VERSION})")
+
+                render_forensic_section(result["forensics"], result["attachments"], result["lookups"])
+                
+                with st.expander("📋 View Technical Details"):
+                    if result["contributions"] is not None:
+                        render_attribution_chart(result["contributions"], f"Why {label}")
+                        st.caption(f"Base rate {attributor.base_value:.2f} + contributions = model score ({attributor.method})")
+                    st.dataframe(df.T, use_container_width=True)
 
-                    render_forensic_section(single_df)
-                    
-                    with st.expander("📋 View Technical Details"):
-                        st.dataframe(df.T, use_container_width=True)
 
+                    
+            except Exception as e:
+                st.error(f"❌ Error analyzing email: {str(e)}")
 
-                        
-                except Exception as e:
-                    st.error(f"❌ Error analyzing email: {str(e)}")
+with cache_stats_slot.container():
+    render_cache_stats()
 
 # ── BATCH ANALYSIS ─────────────────────
 with tab2:
@@ -557,57 +867,94 @@ with tab2:
         process_btn = st.button("📊 Generate Report", use_container_width=True, type="primary", disabled=not uploaded)
 
     if process_btn and uploaded:
-        results = []
-        all_features = []
-
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-
-        for idx, f in enumerate(uploaded):
-            status_text.text(f"Processing {idx + 1}/{len(uploaded)}: {f.name}")
-            progress_bar.progress((idx + 1) / len(uploaded))
-
-            try:
-                content = f.getvalue().decode("utf-8", errors="replace").replace("\r\n", "\n")
-                f_df = processor.transform_raw_email(content)
-                pred = spam_model.predict(f_df)[0]
-                prob = spam_model.predict_proba(f_df)[0][pred]
-                ip, urls, domain = extract_forensics(content)
-
-                results.append({
-                    "name": f.name,
-                    "label": "SPAM" if pred else "HAM",
-                    "confidence": prob,
-                    "ip": ip, "urls": urls, "domain": domain,
-                    "subject_length": f_df["subject_length"].iloc[0]
-                })
-                all_features.append(f_df)
-            except Exception as e:
-                st.warning(f"⚠️ Error processing {f.name}: {str(e)}")
-
-        progress_bar.empty()
-        status_text.empty()
-
-        if results:
-            st.success(f"✅ Successfully processed {len(results)} emails!")
-            st.markdown("---")
-            df_final_results = pd.DataFrame(results)
-            render_dashboard(
-                df_final_results,
-                pd.concat(all_features, ignore_index=True)
-            )
-
-            # RESULTS EXPORT
-            st.divider()
-            st.subheader("📁 Export Evidence")
-            export_df = df_final_results.copy()
-            export_df["urls"] = export_df["urls"].apply(lambda x: ", ".join(x))
-            csv = export_df.to_csv(index=False).encode('utf-8')
-            st.download_button("Download Full Forensic CSV", data=csv, file_name=f"forensic_report_{datetime.now().year}.csv", mime='text/csv')
-
+        # The report runs in a worker; the job id in the URL lets a refreshed page reattach
+        job_id = job_queue.submit(session_owner, ((f.name, f.getvalue()) for f in uploaded),
+                                  profile=st.session_state.get("profile_batch", False))
+        st.session_state["batch_job"] = job_id
+        st.query_params["job"] = str(job_id)
+    elif "batch_job" not in st.session_state and st.query_params.get("job", "").isdigit():
+        st.session_state["batch_job"] = int(st.query_params["job"])
+
+    if "batch_job" in st.session_state:
+        render_job_status(st.session_state["batch_job"])
+
+    notice = st.session_state.pop("batch_notice", None)
+    if notice:
+        job, loaded = notice
+        for name, error in job["errors"]:
+            st.warning(f"⚠️ Error processing {name}: {error}")
+        if loaded:
+            processed = len(st.session_state["batch_report"][0])
+            st.success(f"✅ Successfully processed {processed} emails! ({job['reused']} reused from previous runs)")
+        elif job["status"] == CANCELLED:
+            st.info(f"Report #{job['job_id']} was cancelled.")
         else:
             st.error("❌ No emails were successfully processed.")
 
+    # ── REPORT HISTORY ──
+    with st.expander("🕘 Report History"):
+        history = result_store.list_batches()
+        if history.empty:
+            st.info("No stored reports yet.")
+        else:
+            options = {
+                f"#{row.batch_id} · {row.created_at:%Y-%m-%d %H:%M} · {row.n_emails} emails": row.batch_id
+                for row in history.itertuples()
+            }
+            selected = st.selectbox("Stored reports", list(options.keys()))
+            if st.button("📂 Open Report"):
+                stored = load_stored_report(options[selected])
+                if stored is None:
+                    st.warning("⚠️ This report has no stored results.")
+                else:
+                    st.session_state["batch_report"] = stored
+                    st.session_state.pop("batch_profile", None)
+
+    if "batch_report" in st.session_state:
+        df_final_results, feature_means, features_final, attributions = st.session_state["batch_report"]
+        st.markdown("---")
+        profiled_job = st.session_state.pop("batch_profile_job", None)
+        with Profiler(label="dashboard render") if profiled_job else contextlib.nullcontext() as render_profiler:
+            render_dashboard(df_final_results, feature_means)
+            if attributions is not None and len(attributions.columns):
+                render_explanations(df_final_results, attributions)
+        if profiled_job:
+            st.session_state["batch_profile"] = load_batch_profile(profiled_job, render_profiler.report)
+
+        # RESULTS EXPORT
+        st.divider()
+        st.subheader("📁 Export Evidence")
+        export_df = df_final_results.copy()
+        export_df["urls"] = export_df["urls"].apply(lambda x: ", ".join(x))
+        csv = export_df.to_csv(index=False).encode('utf-8')
+        export_meta = {"model_version": MODEL_VERSION, "embedding_model": EMBEDDING_MODEL}
+        stamp = datetime.now().strftime("%Y%m%d_%H%M")
+
+        # Columnar exports are built once per report, not on every rerun
+        exports = st.session_state.setdefault("batch_exports", {})
+        if exports.get("report") is not df_final_results:
+            exports.clear()
+            exports["report"] = df_final_results
+            for fmt in ("parquet", "arrow"):
+                exports[fmt] = export_bytes(df_final_results, features_final, fmt, metadata=export_meta)
+
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.download_button("Download Full Forensic CSV", data=csv, file_name=f"forensic_report_{datetime.now().year}.csv", mime='text/csv')
+        with col2:
+            st.download_button(
+                "Download Features (Parquet)",
+                data=exports["parquet"],
+                file_name=f"forensic_features_{stamp}.parquet",
+                mime="application/vnd.apache.parquet"
+            )
+        with col3:
+            st.download_button(
+                "Download Features (Arrow)",
+                data=exports["arrow"],
+                file_name=f"forensic_features_{stamp}.arrow",
+                mime="application/vnd.apache.arrow.file"
+            )
 
-
-            
+        if "batch_profile" in st.session_state:
+            render_profile(st.session_state["batch_profile"])
@@ -0,0 +1,49 @@
+"""
+Pruebas de featureExport para SpamSense AI
+Exportación Parquet/Arrow de un lote con valores ausentes, sin modelos
+"""
+
+import io
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from batchPipeline import RESULT_COLUMNS
+from featureExport import export_bytes
+
+
+def _batch():
+    """Two results shaped like BatchPipeline's: the second email has no IP, no From domain and no URLs."""
+    results = pd.DataFrame([
+        {"name": "a.eml", "label": "SPAM", "confidence": 0.9, "ip": "203.0.113.5", "urls": ["http://x.com"],
+         "domain": "ex.com", "subject_length": 5, "body_tokens": 12.0, "link_count": 1.0, "prefiltered": 0},
+        {"name": "b.eml", "label": "HAM", "confidence": 0.7, "ip": None, "urls": [],
+         "domain": np.nan, "subject_length": 0, "body_tokens": 3.0, "link_count": np.nan, "prefiltered": 0},
+    ])
+    features = pd.DataFrame(np.random.default_rng(0).random((2, 6), dtype=np.float32),
+                            columns=["subject_length", "is_html"] + [f"emb_{i}" for i in range(4)])
+    return results, features
+
+
+def test_missing_values_export_as_nulls():
+    results, features = _batch()
+    table = pq.read_table(io.BytesIO(export_bytes(results, features, "parquet")))
+
+    assert table.column("ip").to_pylist() == ["203.0.113.5", None]
+    assert table.column("domain").to_pylist() == ["ex.com", None]
+    assert table.column("link_count").to_pylist() == [1.0, None]
+    assert table.column("urls").to_pylist() == [["http://x.com"], []]
+
+
+def test_export_carries_every_result_column():
+    results, features = _batch()
+    table = pa.ipc.open_file(export_bytes(results, features, "arrow", precision="int8")).read_all()
+
+    assert table.column_names[:len(RESULT_COLUMNS)] == RESULT_COLUMNS
+    # Header features already among the results are not repeated
+    assert table.column_names[len(RESULT_COLUMNS):] == ["is_html", "embedding", "embedding_scale"]
+    # Columns this batch never filled (e.g. routing) are present, all null
+    assert table.column("hop_count").null_count == 2
+    assert table.column("subject_length").to_pylist() == [5, 0]
@@ -0,0 +1,142 @@
+"""
+Pruebas de mailboxIngest para SpamSense AI
+MailboxPoller contra LocalImapServer, con un pipeline mínimo en lugar de los modelos
+"""
+
+import asyncio
+
+import pandas as pd
+
+import mailboxIngest
+from mailboxIngest import LocalImapServer, MailboxPoller, UidState, SPAM_FLAG, HAM_FLAG
+
+
+class FakePipeline:
+    """Labels "win" mail SPAM and fails on any message containing one of `poison`, like BatchPipeline errors."""
+    def __init__(self, poison=("POISON",)):
+        self.poison = list(poison)
+        self.seen = []
+
+    def reloaded(self):
+        return self
+
+    def run(self, emails, total, source="upload"):
+        rows, errors = [], []
+        for name, raw in emails:
+            text = raw.decode()
+            self.seen.append(name)
+            if any(p in text for p in self.poison):
+                errors.append((name, "cannot parse"))
+            else:
+                rows.append((name, "SPAM" if "win" in text else "HAM"))
+        return type("Report", (), {"results": pd.DataFrame(rows, columns=["name", "label"]), "errors": errors})
+
+
+def _mail(i, body):
+    return f"From: a{i}@example.com\nMessage-ID: <{i}@example.com>\nSubject: s{i}\n\n{body}"
+
+
+def _poll(server, pipeline, state, batch_size=2):
+    async def go():
+        port = await server.start()
+        try:
+            poller = MailboxPoller(pipeline, "127.0.0.1", "user", "pass", port=port, use_ssl=False,
+                                   state=state, batch_size=batch_size)
+            return await poller.poll_once()
+        finally:
+            await server.stop()
+    return asyncio.run(go())
+
+
+def test_poll_flags_new_mail_and_checkpoints(tmp_path):
+    server = LocalImapServer()
+    for i, body in enumerate(["win money", "meeting notes", "win a prize"]):
+        server.add_message("INBOX", _mail(i, body))
+    state = UidState(str(tmp_path / "state.json"))
+    pipeline = FakePipeline()
+
+    assert _poll(server, pipeline, state) == {"INBOX": 3}
+    assert server.flags["INBOX"] == {1: {SPAM_FLAG}, 2: {HAM_FLAG}, 3: {SPAM_FLAG}}
+    assert UidState(state.path).last_uid("user", "INBOX", server.uidvalidity) == 3
+
+    # Only mail newer than the checkpoint is fetched on the next poll
+    server.add_message("INBOX", _mail(3, "lunch?"))
+    pipeline.seen.clear()
+    assert _poll(server, pipeline, state) == {"INBOX": 1}
+    assert pipeline.seen == ["INBOX:4"]
+
+
+def test_failed_message_is_retried_not_skipped(tmp_path):
+    server = LocalImapServer()
+    for i, body in enumerate(["win money", "POISON", "hello", "win again"]):
+        server.add_message("INBOX", _mail(i, body))
+    state = UidState(str(tmp_path / "state.json"))
+    pipeline = FakePipeline()
+
+    # Mail after the failure is still classified; the failure waits in the retry set
+    assert _poll(server, pipeline, state) == {"INBOX": 3}
+    assert 2 not in server.flags["INBOX"]
+    assert state.last_uid("user", "INBOX", server.uidvalidity) == 4
+    assert UidState(state.path).retry_uids("user", "INBOX", server.uidvalidity) == [2]
+
+    # Once it can be classified, the next poll flags it
+    pipeline.poison = []
+    pipeline.seen.clear()
+    assert _poll(server, pipeline, state) == {"INBOX": 1}
+    assert pipeline.seen == ["INBOX:2"]
+    assert server.flags["INBOX"][2] == {HAM_FLAG}
+    assert state.retry_uids("user", "INBOX", server.uidvalidity) == []
+
+
+def test_message_is_dropped_after_max_attempts(tmp_path):
+    server = LocalImapServer()
+    server.add_message("INBOX", _mail(0, "POISON"))
+    state = UidState(str(tmp_path / "state.json"))
+    pipeline = FakePipeline()
+
+    for _ in range(mailboxIngest.MAX_ATTEMPTS):
+        assert _poll(server, pipeline, state) == {"INBOX": 0}
+    assert pipeline.seen == ["INBOX:1"] * mailboxIngest.MAX_ATTEMPTS
+    assert state.retry_uids("user", "INBOX", server.uidvalidity) == []
+    assert _poll(server, pipeline, state) == {"INBOX": 0}
+    assert len(pipeline.seen) == mailboxIngest.MAX_ATTEMPTS
+
+
+def test_uidvalidity_change_resets_state(tmp_path):
+    server = LocalImapServer()
+    server.add_message("INBOX", _mail(0, "POISON"))
+    state = UidState(str(tmp_path / "state.json"))
+    _poll(server, FakePipeline(), state)
+
+    server.uidvalidity += 1
+    assert state.last_uid("user", "INBOX", server.uidvalidity) == 0
+    assert state.retry_uids("user", "INBOX", server.uidvalidity) == []
+
+
+def test_run_forever_survives_pipeline_errors(tmp_path):
+    server = LocalImapServer()
+    server.add_message("INBOX", _mail(0, "win money"))
+    pipeline = FakePipeline()
+    crash = [RuntimeError("model store unavailable")]
+
+    def reloaded():
+        if crash:
+            raise crash.pop()
+        return pipeline
+    pipeline.reloaded = reloaded
+
+    async def go():
+        port = await server.start()
+        cycles, errors = [], []
+        poller = MailboxPoller(pipeline, "127.0.0.1", "user", "pass", port=port, use_ssl=False,
+                               state=UidState(str(tmp_path / "state.json")))
+        task = asyncio.create_task(poller.run_forever(0, on_cycle=cycles.append, on_error=errors.append))
+        while not cycles:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await server.stop()
+        return cycles, errors
+
+    cycles, errors = asyncio.run(go())
+    assert [str(e) for e in errors] == ["model store unavailable"]
+    assert cycles[0] == {"INBOX": 1}